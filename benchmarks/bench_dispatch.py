@@ -0,0 +1,62 @@
+"""
+Benchmark: makespan of pre-chunked pool.map vs. per-task dynamic dispatch.
+
+Each fake host sleeps for a skewed random duration (most hosts are fast, a few are very slow).
+
+Usage: python benchmarks/bench_dispatch.py [num_hosts] [parallelism]
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import sys
+import os
+import random
+import time
+from multiprocessing.pool import Pool
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')]
+
+from color_ssh import color_ssh
+from color_ssh.util.util import io2bytes
+
+
+def make_tasks(num_hosts, seed=0):
+    rand = random.Random(seed)
+    tasks = []
+    for i in range(num_hosts):
+        # Pareto-distributed latency: median ~0.06s, a long tail up to 1s
+        d = min(1.0, 0.03 * rand.paretovariate(1.0))
+        tasks.append(('host-%d' % i, [str('sleep'), str('%.3f' % d)], []))
+    return tasks
+
+
+def run_pool_map(tasks, parallelism):
+    """The former dispatcher: pool.map splits the tasks into chunks per worker in advance."""
+    pool = Pool(parallelism)
+    try:
+        return max(pool.map(color_ssh.run_task, tasks))
+    finally:
+        pool.close()
+
+
+def run_dispatch(tasks, parallelism):
+    return max(color_ssh.dispatch(tasks, color_ssh.Setting(parallelism=parallelism), None, None))
+
+
+def main():
+    num_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    parallelism = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    tasks = make_tasks(num_hosts)
+    ideal = sum(float(cmd[1]) for _, cmd, _ in tasks) / parallelism
+
+    out = io2bytes(sys.stdout)
+    msg = 'hosts: %d, parallelism: %d, ideal makespan: %.2f s\n' % (num_hosts, parallelism, ideal)
+    out.write(msg.encode('utf-8'))
+    for name, func in [('pool.map', run_pool_map), ('dispatch', run_dispatch)]:
+        t = time.time()
+        func(tasks, parallelism)
+        out.write(('%-10s makespan: %6.2f s\n' % (name, time.time() - t)).encode('utf-8'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
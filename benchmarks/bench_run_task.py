@@ -0,0 +1,78 @@
+"""
+Benchmark: per-host cost of colorizing with two color-cat subprocesses vs. in-process colorizing.
+
+Usage: python benchmarks/bench_run_task.py [num_hosts]
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import sys
+import os
+import io
+import time
+import subprocess
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')]
+
+from color_ssh import color_ssh
+from color_ssh.util.util import io2bytes
+
+COMMAND = [str('echo'), str('hello')]
+
+
+def run_with_color_cat(label):
+    """The former implementation: one color-cat process per stream (requires color-cat command)."""
+    devnull = io.open(os.devnull, 'wb')
+    try:
+        prefix = ['color-cat', '-l', label]
+        proc_stdout = subprocess.Popen(prefix, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+        proc_stderr = subprocess.Popen(prefix + ['-s', '+'], stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+        ret = subprocess.call(COMMAND, stdin=None, stdout=proc_stdout.stdin, stderr=proc_stderr.stdin)
+        proc_stdout.stdin.close()
+        proc_stderr.stdin.close()
+        proc_stdout.wait()
+        proc_stderr.wait()
+        return ret
+    finally:
+        devnull.close()
+
+
+def run_in_process(label):
+    return color_ssh.run_task((label, COMMAND, []))
+
+
+def measure(func, num_hosts):
+    t0, c0 = time.time(), os.times()
+    for i in range(num_hosts):
+        func('host-%d' % i)
+    t1, c1 = time.time(), os.times()
+    cpu = sum(c1[:4]) - sum(c0[:4])
+    return (t1 - t0) / num_hosts, cpu / num_hosts
+
+
+def main():
+    num_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    # discard colored output
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        results = [(name, measure(func, num_hosts))
+                   for name, func in [('color-cat', run_with_color_cat), ('in-process', run_in_process)]]
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(devnull)
+
+    out = io2bytes(sys.stdout)
+    for name, (wall, cpu) in results:
+        out.write(('%-12s wall: %8.2f ms/host  cpu: %8.2f ms/host\n' % (name, wall * 1000, cpu * 1000)).encode('utf-8'))
+    (_, (w0, c0)), (_, (w1, c1)) = results
+    saved = ((w0 - w1) * 1000, (c0 - c1) * 1000)
+    out.write(('saved        wall: %8.2f ms/host  cpu: %8.2f ms/host\n' % saved).encode('utf-8'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
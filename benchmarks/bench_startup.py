@@ -0,0 +1,74 @@
+"""
+Benchmark: startup cost of a color-cat process, which is spawned for each stream of each host.
+
+Usage: python benchmarks/bench_startup.py [num_runs]
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import sys
+import os
+import time
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path[:0] = [SRC_DIR]
+
+from color_ssh.util.util import io2bytes, percentile
+
+MAIN = 'import sys; from color_ssh import color_cat; sys.exit(color_cat.main(%r))'
+CASES = [
+    ('interpreter', 'pass'),
+    ('color-cat', MAIN % ['color-cat', '-l', 'web01']),
+    ('optparse', MAIN % ['color-cat', '-lweb01']),  # falls back to optparse
+]
+
+
+def run(code, options=()):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    proc = subprocess.Popen([sys.executable] + list(options) + ['-c', code], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    return proc.communicate(b'abc\n')
+
+
+def import_time(code):
+    """
+    :return: tuple of (number of modules, total microseconds) imported after the interpreter started
+    """
+    _, err = run(code, ['-X', 'importtime'])
+    _, base = run('pass', ['-X', 'importtime'])
+
+    def parse(data):
+        ret = {}
+        for line in data.splitlines():
+            if line.startswith(b'import time:') and b'self [us]' not in line:
+                xs = line.split(b'|')
+                ret[xs[-1].strip()] = int(xs[0].split(b':')[1])
+        return ret
+
+    base_modules = parse(base)
+    modules = dict((k, v) for k, v in parse(err).items() if k not in base_modules)
+    return len(modules), sum(modules.values())
+
+
+def main():
+    num_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    has_importtime = sys.version_info >= (3, 7)
+
+    out = io2bytes(sys.stdout)
+    for name, code in CASES:
+        times = []
+        for _ in range(num_runs):
+            t = time.time()
+            run(code)
+            times.append(time.time() - t)
+        msg = '%-12s wall: p50 %7.2f ms  p95 %7.2f ms' % (
+            name, percentile(times, 50) * 1000, percentile(times, 95) * 1000)
+        if has_importtime:
+            num_modules, us = import_time(code)
+            msg += '  imports: %3d modules %7.2f ms' % (num_modules, us / 1000.0)
+        out.write((msg + '\n').encode('utf-8'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
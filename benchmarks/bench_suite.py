@@ -0,0 +1,248 @@
+"""
+Benchmark suite: color-ssh against the fake ssh/rsync of the tests, and color-cat on synthetic inputs.
+
+Each scenario runs in a fresh process and reports hosts/sec, lines/sec, bytes/sec of the output,
+peak RSS of the main process and its children, and the peak number of processes (Linux only).
+
+Usage: python benchmarks/bench_suite.py [--scale X] [--save FILE] [--compare FILE] [scenario ...]
+"""
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+FAKE_BIN = os.path.join(BENCH_DIR, '..', 'tests', 'resources', 'fake_bin')
+sys.path[:0] = [SRC_DIR]
+
+from color_ssh.util.util import io2bytes
+
+# name -> parameters; hosts and lines are multiplied by --scale
+SCENARIOS = [
+    ('fanout', {'hosts': 300, 'par': 64, 'latency': 0.05, 'lines': 10}),
+    ('fanout-async', {'hosts': 300, 'par': 64, 'latency': 0.05, 'lines': 10, 'args': ['--engine', 'async']}),
+    ('noisy', {'hosts': 16, 'par': 16, 'latency': 0, 'lines': 20000}),
+    ('noisy-jsonl', {'hosts': 16, 'par': 16, 'latency': 0, 'lines': 20000, 'args': ['--format', 'jsonl']}),
+    ('failures', {'hosts': 200, 'par': 32, 'latency': 0.02, 'lines': 5, 'fail_percent': 20}),
+    ('upload', {'hosts': 100, 'par': 32, 'latency': 0.02, 'lines': 1, 'args': ['--upload-with', __file__]}),
+    ('color-cat', {'lines': 500000}),
+    ('color-cat-buffered', {'lines': 500000, 'args': ['-b']}),
+]
+# (title, key in the results, width, digits after the decimal point)
+METRICS = [
+    ('hosts/s', 'hosts_per_sec', 9, 1),
+    ('lines/s', 'lines_per_sec', 10, 0),
+    ('MB/s', 'mbytes_per_sec', 8, 2),
+    ('rss MB', 'rss_mb', 7, 1),
+    ('child MB', 'child_rss_mb', 8, 1),
+    ('procs', 'max_procs', 6, 0),
+    ('sec', 'elapsed', 7, 2),
+]
+
+
+class ProcessCounter(object):
+    """
+    Sample the number of descendant processes (including this one) from /proc.
+    """
+    INTERVAL = 0.01
+
+    def __init__(self):
+        self.max_procs = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        if os.path.isdir('/proc/self'):
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    @staticmethod
+    def count():
+        children = {}
+        for pid in os.listdir('/proc'):
+            if pid.isdigit():
+                try:
+                    with io.open('/proc/%s/stat' % pid, 'rb') as f:
+                        # the command name may contain spaces, the parent pid follows the state after ")"
+                        ppid = int(f.read().rsplit(b')', 1)[1].split()[1])
+                except (IOError, OSError, IndexError, ValueError):
+                    continue
+                children.setdefault(ppid, []).append(int(pid))
+
+        n = 0
+        stack = [os.getpid()]
+        while stack:
+            n += 1
+            stack.extend(children.get(stack.pop(), []))
+        return n
+
+    def _run(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.max_procs = max(self.max_procs or 0, self.count())
+
+
+def count_output(path):
+    lines = size = 0
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            lines += chunk.count(b'\n')
+            size += len(chunk)
+    return lines, size
+
+
+def run_color_ssh(params, work_dir):
+    from color_ssh import color_ssh
+
+    os.environ['PATH'] = FAKE_BIN + os.pathsep + os.environ.get('PATH', '')
+    os.environ['FAKE_SSH_LATENCY'] = str(params['latency'])
+    os.environ['FAKE_SSH_LINES'] = str(params['lines'])
+    os.environ['FAKE_SSH_FAIL_PERCENT'] = str(params.get('fail_percent', 0))
+
+    host_file = os.path.join(work_dir, 'hosts')
+    with io.open(host_file, 'w') as f:
+        f.write(''.join('host-%05d\n' % i for i in range(params['hosts'])))
+
+    args = ['color-ssh', '-p', str(params['par']), '-h', host_file] + params.get('args', []) + ['true']
+    return lambda stdout, stderr: color_ssh.main(args, stdout=stdout, stderr=stderr), params['hosts']
+
+
+def run_color_cat(params, work_dir):
+    from color_ssh import color_cat
+
+    path = os.path.join(work_dir, 'input')
+    line = b'x' * 79 + b'\n'
+    with io.open(path, 'wb') as f:
+        for _ in range(params['lines'] // 1000):
+            f.write(line * 1000)
+
+    args = ['color-cat', '-l', 'label'] + params.get('args', []) + [path]
+    return lambda stdout, stderr: color_cat.main(args, stdout=stdout, stderr=stderr), None
+
+
+def run_child(name, scale, result_path):
+    """
+    Run a scenario in this process and write the result to result_path in JSON.
+    """
+    import resource
+
+    params = dict(dict(SCENARIOS)[name])
+    for k in ['hosts', 'lines']:
+        if k in params:
+            params[k] = max(1, int(params[k] * scale))
+
+    work_dir = tempfile.mkdtemp(prefix='color-ssh-bench-')
+    out_path = os.path.join(work_dir, 'stdout')
+    try:
+        func, num_hosts = (run_color_cat if name.startswith('color-cat') else run_color_ssh)(params, work_dir)
+        with io.open(out_path, 'wb') as stdout:
+            with io.open(os.devnull, 'wb') as stderr:
+                with ProcessCounter() as counter:
+                    t = time.time()
+                    func(stdout, stderr)
+                    elapsed = time.time() - t
+        lines, size = count_output(out_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    result = {
+        'elapsed': elapsed,
+        'hosts_per_sec': None if num_hosts is None else num_hosts / elapsed,
+        'lines_per_sec': lines / elapsed,
+        'mbytes_per_sec': size / elapsed / 1e6,
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1e6,
+        'child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1e6,
+        'max_procs': counter.max_procs,
+    }
+    with io.open(result_path, 'w') as f:
+        f.write(json.dumps(result, sort_keys=True))
+
+
+def run_scenario(name, scale):
+    fd, result_path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--child', name, '--scale', str(scale),
+                               '--save', result_path])
+        with io.open(result_path) as f:
+            return json.loads(f.read())
+    finally:
+        os.remove(result_path)
+
+
+def format_header(with_baseline=False):
+    # relative changes take 8 more columns
+    extra = 8 if with_baseline else 0
+    return ' '.join(['%-20s' % 'scenario'] + ['%*s' % (width + extra, title) for title, _, width, _ in METRICS])
+
+
+def format_row(name, result, baseline=None):
+    """
+    :param baseline: result of the same scenario to show the relative changes, or None
+    """
+    cols = ['%-20s' % name]
+    for _, key, width, digits in METRICS:
+        x = result.get(key)
+        s = '%*s' % (width, '-') if x is None else '%*.*f' % (width, digits, x)
+        base = (baseline or {}).get(key)
+        if x is not None and base:
+            s += ' (%+4.0f%%)' % ((x - base) * 100.0 / base)
+        cols.append(s)
+    return ' '.join(cols)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--scale', dest='scale', default=1.0, type='float', help='multiply the hosts and lines')
+    parser.add_option('--save', dest='save', default=None, metavar='FILE', help='save the results as a baseline')
+    parser.add_option('--compare', dest='compare', default=None, metavar='FILE', help='compare with a baseline')
+    parser.add_option('--child', dest='child', default=None, help='(internal) run one scenario')
+    option, names = parser.parse_args()
+
+    if option.child:
+        run_child(option.child, option.scale, option.save)
+        return 0
+
+    names = names or [name for name, _ in SCENARIOS]
+    unknown = [name for name in names if name not in dict(SCENARIOS)]
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(unknown))
+
+    baselines = {}
+    if option.compare:
+        with io.open(option.compare) as f:
+            baselines = json.loads(f.read())['results']
+
+    out = io2bytes(sys.stdout)
+    out.write((format_header(bool(baselines)) + '\n').encode('utf-8'))
+    results = {}
+    for name in names:
+        results[name] = run_scenario(name, option.scale)
+        out.write((format_row(name, results[name], baselines.get(name)) + '\n').encode('utf-8'))
+        out.flush()
+
+    if option.save:
+        with io.open(option.save, 'w') as f:
+            f.write(json.dumps({'scale': option.scale, 'python': sys.version.split()[0], 'results': results},
+                               indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -38,5 +38,7 @@ setup(
     [console_scripts]
     color-ssh = color_ssh.color_ssh:main
     color-cat = color_ssh.color_cat:main
+    color-sshd = color_ssh.daemon:main
+    color-ssh-submit = color_ssh.daemon:submit_main
     """,
 )
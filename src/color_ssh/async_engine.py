@@ -0,0 +1,244 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import time
+import asyncio
+import itertools
+from color_ssh.color_ssh import setup_message, task_error_message, timeout_message, kill_process_group, \
+    new_session_args, TaskTimeout, TIMEOUT_EXIT_CODE
+from color_ssh.output import Output
+from color_ssh.stats import new_record, add_output
+from color_ssh.broadcast import connect
+
+__all__ = []
+
+BUFFER_SIZE = 65536
+
+
+async def _wait_writable(source):
+    """
+    Wait while the multiplexer source of a task is full, without blocking the other tasks.
+    """
+    while source is not None and source.full():
+        await asyncio.sleep(source.mux.interval)
+
+
+async def _copy(reader, out, stream, source=None):
+    """
+    Copy lines from an asyncio stream to the task output.
+    Lines longer than the buffer are handled by carrying over the partial line.
+
+    :param source: non-blocking multiplexer Source the task output writes to, or None
+    :return: tuple of (number of lines, number of bytes) read
+    """
+    if out.raw:
+        return await _copy_raw(reader, out, stream, source)
+
+    rest = b''
+    num_lines = num_bytes = 0
+    while True:
+        chunk = await reader.read(BUFFER_SIZE)
+        if not chunk:
+            break
+        num_bytes += len(chunk)
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        num_lines += len(lines)
+        if lines:
+            out.write(stream, lines)
+            await _wait_writable(source)
+    if rest:
+        out.write(stream, [rest])
+        num_lines += 1
+    return num_lines, num_bytes
+
+
+async def _copy_raw(reader, out, stream, source=None):
+    """
+    Copy an asyncio stream to a task output which takes the data as is (TaskOutput.raw).
+
+    :return: tuple of (number of lines, number of bytes) read
+    """
+    num_lines = num_bytes = 0
+    last = b'\n'
+    while True:
+        chunk = await reader.read(BUFFER_SIZE)
+        if not chunk:
+            break
+        out.write_raw(stream, chunk)
+        await _wait_writable(source)
+        num_lines += chunk.count(b'\n')
+        num_bytes += len(chunk)
+        last = chunk[-1:]
+    # the last line without a newline
+    return num_lines + (last != b'\n'), num_bytes
+
+
+async def _call(cmd, out, timeout=None, record=None, stdin_address=None, source=None):
+    # run in a new session to kill the whole process tree on timeout
+    sock = None if stdin_address is None else connect(stdin_address)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=None if sock is None else sock.fileno(), stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, **new_session_args(timeout))
+    finally:
+        if sock is not None:
+            sock.close()
+    readers = asyncio.gather(_copy(proc.stdout, out, 'stdout', source), _copy(proc.stderr, out, 'stderr', source))
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.shield(readers), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(proc.pid)
+        timed_out = True
+        await readers
+    except BaseException:
+        # cancelled: the command in its own session does not receive SIGINT from the terminal
+        if timeout is not None:
+            kill_process_group(proc.pid)
+        raise
+    ret = await proc.wait()
+
+    if record is not None:
+        add_output(record, 'stdout', readers.result()[0])
+        add_output(record, 'stderr', readers.result()[1])
+    if timed_out:
+        raise TaskTimeout(timeout, cmd)
+    return ret
+
+
+async def _run_task(task, stdout, stderr, timeout, setup_timeout, record=None, output=None, stdin_address=None,
+                    mux=None):
+    label, command, setup_commands = task
+    host = getattr(task, 'host', None) or label
+    # each task has its own source, so that a noisy host waits without blocking the event loop
+    source = None if mux is None else mux.source(block=False)
+    if source is not None:
+        stdout, stderr = source.streams()
+    out = (output or Output()).open(host, label, stdout, stderr, getattr(task, 'remote_command', None))
+
+    async def timed_call(cmd, seconds, key):
+        t = time.time()
+        ret = None
+        try:
+            ret = await _call(cmd, out, seconds, record, stdin_address if key == 'command' else None, source)
+            return ret
+        finally:
+            if record is not None:
+                if key == 'setup':
+                    record['setup'].append({'command': cmd, 'time': time.time() - t, 'ret': ret})
+                else:
+                    record['time'] = time.time() - t
+
+    async def f():
+        try:
+            for cmd in setup_commands:
+                out.message('setup', setup_message(cmd))
+
+                r = await timed_call(cmd, setup_timeout, 'setup')
+                if r != 0:
+                    raise RuntimeError('Failed to execute setup command: %s' % cmd)
+
+            return await timed_call(command, timeout, 'command')
+        except TaskTimeout as e:
+            out.message('timeout', timeout_message(e.timeout, e.cmd))
+            return TIMEOUT_EXIT_CODE
+        except Exception as e:
+            out.message('error', task_error_message(e, label, command))
+            return 1
+
+    ret = None
+    try:
+        ret = await f()
+        return ret
+    finally:
+        out.close(ret)
+        if source is not None:
+            source.close()
+
+
+async def _run_all(tasks, parallelism, stdout, stderr, callback, timeout, setup_timeout, stats, output, retrier,
+                   stdin_address, mux):
+    """
+    Start tasks as they arrive, keeping at most parallelism tasks running.
+    """
+    semaphore = asyncio.Semaphore(max(1, parallelism))
+    results = []
+
+    async def run(i, item):
+        try:
+            # items from the retrier come with their queue time and the number of retries
+            task, queued_at, attempt = item if retrier is not None else (item, time.time(), 0)
+            record = None
+            if stats is not None or retrier is not None:
+                record = new_record(task[0], task[1], getattr(task, 'target', None))
+                record['queue'] = time.time() - queued_at
+                record['attempt'] = attempt
+            r = await _run_task(task, stdout, stderr, timeout, setup_timeout, record, output, stdin_address, mux)
+            if retrier is not None and retrier.retry(item, r, record):
+                return
+            if stats is not None:
+                record['ret'] = r
+                record['total'] = time.time() - queued_at
+                stats.add(record)
+            results.append((i, r))
+            if callback:
+                callback(r)
+        finally:
+            semaphore.release()
+
+    # tasks may be a lazy iterator blocking on I/O, so read it in another thread
+    loop = asyncio.get_event_loop()
+    it = iter(tasks)
+    end = object()
+
+    running = set()
+    for i in itertools.count():
+        await semaphore.acquire()
+        task = await loop.run_in_executor(None, next, it, end)
+        if task is end:
+            semaphore.release()
+            break
+        future = asyncio.ensure_future(run(i, task))
+        running.add(future)
+        future.add_done_callback(running.discard)
+    if running:
+        await asyncio.wait(running)
+    return [r for _, r in sorted(results)]
+
+
+def run_tasks(tasks, parallelism, stdout, stderr, callback=None, timeout=None, setup_timeout=None, stats=None,
+              output=None, retrier=None, stdin_address=None, mux=None):
+    """
+    Run all tasks from a single event loop.
+
+    :param tasks: iterable of Task or (label, command, setup_commands)
+    :param parallelism: max number of ssh commands running at the same time
+    :param stdout: binary-data stdout output
+    :param stderr: binary-data stderr output
+    :param callback: function called with the return code of each task when it finishes
+    :param timeout: seconds to wait for each command
+    :param setup_timeout: seconds to wait for each setup command
+    :param stats: Stats or Journal instance to collect the statistics of each task, or None
+    :param output: Output instance
+    :param retrier: Retrier instance whose filter generated the tasks, or None
+    :param stdin_address: address of the Broadcaster to read the stdin of the commands from, or None
+    :param mux: Multiplexer instance to write the output through instead of stdout and stderr, or None
+    :return: list of return codes
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _run_all(tasks, parallelism, stdout, stderr, callback, timeout, setup_timeout, stats, output,
+                     retrier, stdin_address, mux))
+    except BaseException:
+        # e.g. KeyboardInterrupt: cancel the running tasks to kill their commands
+        if retrier is not None:
+            # release the thread waiting for the next task
+            retrier.close()
+        pending = (getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks)(loop)
+        for t in pending:
+            t.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        raise
+    finally:
+        loop.close()
@@ -0,0 +1,277 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import errno
+import shutil
+import socket
+import tempfile
+import threading
+
+__all__ = []
+
+RING_SIZE = 1 << 22
+BLOCK_SIZE = 1 << 16
+ACCEPT_INTERVAL = 0.1
+ACCEPTED = b'+'  # sent first to each connection which can read the whole input
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer keeping the last `capacity` bytes of a stream, addressed by absolute offsets.
+    """
+
+    def __init__(self, capacity=RING_SIZE):
+        self.data = bytearray(capacity)
+        self.capacity = capacity
+        self.end = 0  # offset of the next byte to be written
+
+    @property
+    def start(self):
+        """
+        :return: offset of the oldest byte kept
+        """
+        return max(0, self.end - self.capacity)
+
+    def write(self, data):
+        end = self.end + len(data)
+        data = data[-self.capacity:]
+        pos = (end - len(data)) % self.capacity
+        n = min(len(data), self.capacity - pos)
+        self.data[pos:pos + n] = data[:n]
+        self.data[:len(data) - n] = data[n:]
+        self.end = end
+
+    def read(self, offset, size):
+        """
+        :param offset: absolute offset between start and end
+        :param size: max number of bytes to read
+        :return: bytes, which may be shorter than size at the wrap-around point
+        """
+        assert self.start <= offset <= self.end, 'offset out of range: %d' % offset
+
+        pos = offset % self.capacity
+        n = min(size, self.end - offset, self.capacity - pos)
+        return bytes(self.data[pos:pos + n])
+
+
+class Broadcaster(object):
+    """
+    Read the local stdin once and stream it to every host.
+
+    Each ssh command gets a connection to a Unix socket as its stdin, served from a shared ring buffer
+    with its own read cursor. With a spool directory, the input is also written to a file there, so that
+    hosts starting late or falling behind the ring read the older part from the file, and a slow host never
+    holds back the others. Otherwise, which is meant for hosts all starting at once, the input is read no
+    faster than the slowest connected host and nothing leaves the ring until the expected number of hosts
+    have connected, or any host has finished; hosts connecting after the beginning of the input has left the
+    ring are refused. Either way, memory usage does not depend on the size of the input or the number of hosts.
+    """
+    SOCKET_NAME = 'stdin.sock'
+
+    def __init__(self, stdin, ring_size=RING_SIZE, block_size=BLOCK_SIZE, spool_dir=None, expected=0):
+        """
+        :param stdin: binary-data stdin input, which must not be read by the commands (see detach_stdin)
+        :param ring_size: bytes of the input kept in memory
+        :param block_size: max number of bytes read or sent at once, not larger than ring_size
+        :param spool_dir: directory to spool the input to, or None
+        :param expected: number of hosts to wait for before any input leaves the ring without the spool
+        """
+        self.stdin = stdin
+        self.ring = RingBuffer(ring_size)
+        self.block_size = block_size
+        self.spool_dir = spool_dir
+        self.expected = expected
+        self.accepted = 0
+        self.finished = False
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)  # the ring advanced
+        self.drained = threading.Condition(self.lock)  # a host read more of the ring
+        self.cursors = {}  # connection -> offset of the next byte to send
+        self.eof = False
+        self.stopped = False
+        self.directory = None
+        self.listener = None
+        self.spool_path = None
+        self.spool_fd = None
+        self.accept_thread = None
+
+    @property
+    def address(self):
+        return os.path.join(self.directory, self.SOCKET_NAME)
+
+    def start(self):
+        """
+        Start reading stdin and accepting connections. Must be called in the main process before the
+        worker processes start.
+
+        :return: address of the socket to pass to connect()
+        """
+        self.directory = tempfile.mkdtemp(prefix='color-ssh-')
+        if self.spool_dir is not None:
+            self.spool_fd, self.spool_path = tempfile.mkstemp(prefix='color-ssh-', suffix='.spool',
+                                                              dir=self.spool_dir)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.address)
+        self.listener.listen(128)
+        self.listener.settimeout(ACCEPT_INTERVAL)
+
+        # the reader thread is not joined since it may be blocked on stdin forever
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+        self.accept_thread = threading.Thread(target=self._accept)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+        return self.address
+
+    def stop(self):
+        """
+        Stop accepting connections and remove the temporary files. Hosts still reading are disconnected.
+        """
+        with self.lock:
+            self.stopped = True
+            self.condition.notify_all()
+            self.drained.notify_all()
+        self.accept_thread.join()
+        self.listener.close()
+        if self.spool_fd is not None:
+            os.close(self.spool_fd)
+            os.remove(self.spool_path)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _read(self):
+        read = getattr(self.stdin, 'read1', self.stdin.read)
+        try:
+            while not self.stopped:
+                data = read(self.block_size)
+                if not data:
+                    break
+                if self.spool_fd is not None:
+                    # written in full before the ring advances, so the data dropped from the ring is in the spool
+                    rest = data
+                    while rest:
+                        rest = rest[os.write(self.spool_fd, rest):]
+                with self.lock:
+                    while self.spool_fd is None and not self.stopped and self._would_drop(len(data)):
+                        self.drained.wait()
+                    self.ring.write(data)
+                    self.condition.notify_all()
+        finally:
+            with self.lock:
+                self.eof = True
+                self.condition.notify_all()
+
+    def _would_drop(self, size):
+        """
+        :return: True if writing size bytes to the ring drops data which a connected host has not read yet,
+                 or any data before the first host connects
+        """
+        if self.accepted < self.expected and not self.finished:
+            oldest = 0
+        else:
+            oldest = min(self.cursors.values()) if self.cursors else self.ring.start
+        return self.ring.end + size - self.ring.capacity > oldest
+
+    def filter(self, tasks):
+        """
+        Same interface as the other monitors (see dispatch).
+        """
+        return tasks
+
+    def record(self, ret):
+        """
+        Called when a task finishes, after which the hosts not connected yet are not waited for.
+        """
+        with self.lock:
+            self.finished = True
+            self.drained.notify()
+
+    def _accept(self):
+        while not self.stopped:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                if self.stopped:
+                    return
+                raise
+            conn.settimeout(None)
+            with self.lock:
+                accepted = self.spool_fd is not None or self.ring.start == 0
+                if accepted:
+                    self.cursors[conn] = 0
+                    self.accepted += 1
+                    self.drained.notify()
+            if not accepted:
+                # the beginning of the input is gone
+                conn.close()
+                continue
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _next(self, conn, offset, spool):
+        """
+        :param conn: connection to send the data to
+        :param offset: offset of the next byte to send
+        :param spool: binary file object reading the spool, or None
+        :return: bytes from offset, empty at the end of the input or after stop()
+        """
+        with self.lock:
+            self.cursors[conn] = offset
+            self.drained.notify()
+            while self.ring.end <= offset and not self.eof and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return b''
+            if self.ring.start <= offset:
+                return self.ring.read(offset, self.block_size)
+            size = min(self.block_size, self.ring.start - offset)
+
+        # fell behind the ring
+        spool.seek(offset)
+        return spool.read(size)
+
+    def _serve(self, conn):
+        offset = 0
+        spool = None
+        try:
+            conn.sendall(ACCEPTED)
+            if self.spool_path is not None:
+                spool = io.open(self.spool_path, 'rb')
+            while True:
+                data = self._next(conn, offset, spool)
+                if not data:
+                    break
+                conn.sendall(data)
+                offset += len(data)
+            conn.shutdown(socket.SHUT_WR)
+        except (IOError, OSError, socket.error) as e:
+            # the command exited without reading all the input
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN):
+                raise
+        finally:
+            with self.lock:
+                del self.cursors[conn]
+                self.drained.notify()
+            if spool is not None:
+                spool.close()
+            conn.close()
+
+
+def connect(address):
+    """
+    :param address: address returned by Broadcaster.start()
+    :return: socket to be passed to a command as its stdin
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        if sock.recv(len(ACCEPTED)) != ACCEPTED:
+            raise RuntimeError('The beginning of stdin is no longer buffered (use --stdin-spool to start hosts later)')
+    except BaseException:
+        sock.close()
+        raise
+    return sock
@@ -1,67 +1,292 @@
 from __future__ import division, print_function, absolute_import, unicode_literals
 
 import sys
+import os
 import io
-from optparse import OptionParser
+import zlib
 from color_ssh.setting.color import *
 from color_ssh.util.util import *
 
 __all__ = []
 
+BLOCK_SIZE = 1 << 20
+FLUSH_INTERVAL = 0.05
+DEFAULT_PALETTE = 'basic'
+PREFIX_CACHE_SIZE = 4096
+
+# colors of each palette, built on first use
+_palettes = {}
+
+
+def get_palette(name):
+    """
+    :param name: palette name (key of PALETTES)
+    :return: list of color escape sequences
+    """
+    if name not in _palettes:
+        if name not in PALETTES:
+            raise ValueError('Unknown palette: %s' % name)
+        _palettes[name] = PALETTES[name]()
+    return _palettes[name]
+
+
+def label_hash(label):
+    """
+    32-bit hash of a label, well distributed even for similar labels like "web01", "web10".
+
+    :param label: label string
+    """
+    # CRC-32 followed by the MurmurHash3 finalizer, which mixes every input bit into the low bits
+    h = zlib.crc32(arg2bytes(label)) & 0xffffffff
+    h = ((h ^ (h >> 16)) * 0x85ebca6b) & 0xffffffff
+    h = ((h ^ (h >> 13)) * 0xc2b2ae35) & 0xffffffff
+    return h ^ (h >> 16)
+
+
+@lru_cache(PREFIX_CACHE_SIZE)
+def get_prefix(label, separator, palette=DEFAULT_PALETTE):
+    """
+    Cached prefix for the label colored by the palette.
+
+    :param label: label string
+    :param separator: separator string (e.g. b'|' for stdout, b'+' for stderr)
+    :param palette: palette name
+    :return: bytes prefix
+    """
+    return Setting._make_prefix(label, Setting._get_color(label, palette), separator)
+
 
 class Setting(object):
     VERSION = 'color-cat %s' % __import__('color_ssh').__version__
     USAGE = """%prog [options...] [file ...]"""
 
-    def __init__(self, prefix=None, paths=None):
+    def __init__(self, prefix=None, paths=None, buffered=False):
         self.prefix = prefix
         self.paths = paths
+        self.buffered = buffered
+
+    # options recognized without optparse: option string -> destination (None for flags)
+    FAST_OPTIONS = {
+        '-l': 'label', '--label': 'label',
+        '-c': 'color', '--color': 'color',
+        '--palette': 'palette',
+        '-s': 'separator', '--separator': 'separator',
+        '-b': None, '--buffered': None,
+    }
 
     def parse_args(self, argv, stdout=io2bytes(sys.stdout)):
         """
+        The common forms of arguments are parsed without optparse, which takes most of the startup time.
+        Anything else (help, version, errors, abbreviations) falls back to optparse.
+
         :param argv: list of str
         :param stdout: binary-data stdout output
         """
+        parsed = self._parse_fast(argv[1:]) or self._parse_optparse(argv, stdout)
+        option, color, args = parsed
+
+        self.prefix = self._make_prefix(option['label'], color, option['separator'])
+        self.paths = [arg2bytes(arg) for arg in args] or [None]
+        self.buffered = option['buffered']
+        return self
+
+    @classmethod
+    def _default_options(cls):
+        return {'label': b'', 'color': None, 'palette': DEFAULT_PALETTE, 'separator': b'|', 'buffered': False}
+
+    @classmethod
+    def _resolve_color(cls, option):
+        """
+        :return: color escape sequence, or None if the color name is invalid
+        """
+        if option['color']:
+            return COLOR_NAMES.get(option['color'].lower())
+        return cls._get_color(option['label'], option['palette'])
+
+    @classmethod
+    def _parse_fast(cls, args):
+        """
+        :param args: list of str without the program name
+        :return: tuple of (dict of options, color, list of file paths), or None if optparse is needed
+        """
+        option = cls._default_options()
+        paths = []
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            i += 1
+            if arg == '--':
+                paths.extend(args[i:])
+                break
+            if not arg.startswith('-') or arg == '-':
+                paths.append(arg)
+                continue
+
+            name, eq, value = arg.partition('=') if arg.startswith('--') else (arg, '', None)
+            if name not in cls.FAST_OPTIONS:
+                return None
+            dest = cls.FAST_OPTIONS[name]
+            if dest is None:
+                if eq:
+                    return None
+                option['buffered'] = True
+                continue
+            if not eq:
+                if i == len(args):
+                    return None
+                value = args[i]
+                i += 1
+            option[dest] = value
+
+        if option['palette'] not in PALETTES:
+            return None
+        color = cls._resolve_color(option)
+        if color is None:
+            return None
+        return option, color, paths
+
+    def _parse_optparse(self, argv, stdout):
+        """
+        :return: tuple of (dict of options, color, list of file paths)
+        """
+        from optparse import OptionParser
+
+        defaults = self._default_options()
         parser = OptionParser(version=self.VERSION, usage=self.USAGE)
 
         parser.add_option(
-            '-l', '--label', dest='label', default=b'', type='string', metavar='LABEL',
+            '-l', '--label', dest='label', default=defaults['label'], type='string', metavar='LABEL',
             help='set label name to LABEL'
         )
         parser.add_option(
-            '-c', '--color', dest='color', default=None, type='string', metavar='COLOR',
+            '-c', '--color', dest='color', default=defaults['color'], type='string', metavar='COLOR',
             help='set output color to COLOR (available colors: %s)' % ', '.join(sorted(COLOR_NAMES.keys()))
         )
         parser.add_option(
-            '-s', '--separator', dest='separator', default=b'|', type='string', metavar='SEPARATOR',
+            '--palette', dest='palette', default=defaults['palette'], type='choice', choices=sorted(PALETTES.keys()),
+            metavar='PALETTE',
+            help='set palette to choose colors from labels to PALETTE (%s, default: %s)' % (
+                ', '.join(sorted(PALETTES.keys())), DEFAULT_PALETTE)
+        )
+        parser.add_option(
+            '-s', '--separator', dest='separator', default=defaults['separator'], type='string', metavar='SEPARATOR',
             help='set separator string to SEPARATOR (default: "|")'
         )
 
+        parser.add_option(
+            '-b', '--buffered', dest='buffered', default=defaults['buffered'], action='store_true',
+            help='read and write in large blocks, flushing only when the input is idle (for large files)'
+        )
+
         option, args = parser.parse_args(argv[1:])
+        option = dict((k, getattr(option, k)) for k in defaults)
 
         # encode each arg string to bytes if Python3
-        color = COLOR_NAMES.get(option.color.lower()) if option.color else self._get_color(option.label)
+        color = self._resolve_color(option)
         if color is None:
             stdout.write(arg2bytes(parser.format_help().encode('utf-8')))
-            stdout.write(b'\nInvalid color name: ' + arg2bytes(option.color) + b'\n')
+            stdout.write(b'\nInvalid color name: ' + arg2bytes(option['color']) + b'\n')
             parser.exit(2)
-
-        self.prefix = self._make_prefix(option.label, color, option.separator)
-        self.paths = [arg2bytes(arg) for arg in args] or [None]
-        return self
+        return option, color, args
 
     @staticmethod
-    def _get_color(label):
+    def _get_color(label, palette=DEFAULT_PALETTE):
+        colors = get_palette(palette)
+        if palette != DEFAULT_PALETTE:
+            return colors[label_hash(label) % len(colors)]
+
+        # keep the colors of the basic palette compatible with older versions
         index = 0
         for c in arg2bytes(label):
-            index = (index + (c if PY3 else ord(c))) % len(COLOR_SET)
-        return COLOR_SET[index]
+            index = (index + (c if PY3 else ord(c))) % len(colors)
+        return colors[index]
 
     @staticmethod
     def _make_prefix(label, color, separator):
         return (INVERSE + color + arg2bytes(label) + RESET + arg2bytes(separator) + RESET if label else b'') + color
 
 
+def colorize(fh, prefix, stdout):
+    """
+    Copy lines from a binary stream to stdout with the prefix.
+
+    :param fh: binary-data input stream
+    :param prefix: bytes prefix made by get_prefix
+    :param stdout: binary-data output stream
+    :return: tuple of (number of lines, number of bytes) read
+    """
+    num_lines = num_bytes = 0
+    for line in iter(fh.readline, b''):
+        stdout.write(prefix + line.rstrip(b'\n') + RESET + b'\n')
+        stdout.flush()
+        num_lines += 1
+        num_bytes += len(line)
+    return num_lines, num_bytes
+
+
+def colorize_blocks(fh, prefix, stdout, block_size=BLOCK_SIZE, flush_interval=FLUSH_INTERVAL):
+    """
+    Block-buffered version of colorize().
+
+    Reads the input in large blocks and writes all complete lines in a block with a single write.
+    The trailing partial line is carried over to the next block. Output is flushed only when no input
+    arrives within flush_interval seconds, so interactive use still sees timely output.
+
+    :param fh: binary-data input stream
+    :param prefix: bytes prefix made by get_prefix
+    :param stdout: binary-data output stream
+    :param block_size: max number of bytes to read at once
+    :param flush_interval: idle timeout in seconds before flushing the output
+    :return: tuple of (number of lines, number of bytes) read
+    """
+    import select
+
+    try:
+        fd = fh.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fd = None
+
+    def read():
+        return fh.read(block_size) if fd is None else os.read(fd, block_size)
+
+    separator = RESET + b'\n' + prefix
+    partial = []  # pieces of the trailing partial line
+    pending = False  # true if there is unflushed output
+    num_lines = num_bytes = 0
+
+    while True:
+        if pending and fd is not None and not select.select([fd], [], [], flush_interval)[0]:
+            stdout.flush()
+            pending = False
+            continue
+
+        chunk = read()
+        if not chunk:
+            break
+        num_bytes += len(chunk)
+
+        lines = chunk.split(b'\n')
+        if len(lines) == 1:
+            partial.append(chunk)
+            continue
+
+        if partial:
+            partial.append(lines[0])
+            lines[0] = b''.join(partial)
+        last = lines.pop()
+        partial = [last] if last else []
+        num_lines += len(lines)
+
+        stdout.write(prefix + separator.join(lines) + RESET + b'\n')
+        pending = True
+
+    if partial:
+        stdout.write(prefix + b''.join(partial) + RESET + b'\n')
+        num_lines += 1
+    stdout.flush()
+    return num_lines, num_bytes
+
+
 def main(argv=sys.argv, stdin=io2bytes(sys.stdin), stdout=io2bytes(sys.stdout), stderr=io2bytes(sys.stderr)):
     """
     Main function
@@ -74,9 +299,7 @@ def main(argv=sys.argv, stdin=io2bytes(sys.stdin), stdout=io2bytes(sys.stdout),
         for path in setting.paths:
             fh = stdin if path is None else io.open(path, 'rb', 0)
             try:
-                for line in iter(fh.readline, b''):
-                    stdout.write(setting.prefix + line.rstrip(b'\n') + RESET + b'\n')
-                    stdout.flush()
+                (colorize_blocks if setting.buffered else colorize)(fh, setting.prefix, stdout)
             finally:
                 if fh is not stdin:
                     fh.close()
@@ -6,12 +6,64 @@ import io
 import shlex
 import subprocess
 import re
+import threading
+import collections
+import copy
+import itertools
+import math
+import signal
+import random
+import tempfile
+import heapq
+import functools
+import time
 from optparse import OptionParser
+import multiprocessing
 from multiprocessing.pool import Pool
+from color_ssh.output import Output, FORMATS, COMPRESSIONS, DEFAULT_GROUP_MEMORY, set_lock, get_lock
+from color_ssh.stats import Stats, new_record, add_output
+from color_ssh.journal import Journal
+from color_ssh.mux import Multiplexer, FLUSH_INTERVAL, get_streams, set_streams, init_worker
+from color_ssh.broadcast import Broadcaster, connect, RING_SIZE
+from color_ssh.inventory import parse_host, expand_hosts, iter_hosts, load_inventory, default_cache_dir, Inventory, \
+    CACHE_DIR_ENV
+from color_ssh.color_cat import DEFAULT_PALETTE
+from color_ssh.setting.color import PALETTES
 from color_ssh.util.util import *
 
 __all__ = []
 
+TIMEOUT_EXIT_CODE = 124
+SSH_ERROR_EXIT_CODE = 255
+JOIN_INTERVAL = 0.1
+
+
+class Task(tuple):
+    """
+    Tuple of (label, command, setup_commands) which also knows the host name for the structured output formats,
+    the address (user, host, port) of the host and the command run on the host.
+    """
+
+    def __new__(cls, label, command, setup_commands, host=None, address=None, remote_command=None):
+        self = super(Task, cls).__new__(cls, (label, command, setup_commands))
+        self.host = host
+        self.address = address
+        self.remote_command = remote_command
+        return self
+
+    def __getnewargs__(self):
+        return tuple(self) + (self.host, self.address, self.remote_command)
+
+    @property
+    def target(self):
+        """
+        :return: list of [user, host, port, remote command], which does not depend on the ssh options,
+                 or None if unknown
+        """
+        if self.address is None or self.remote_command is None:
+            return None
+        return list(self.address) + [list(self.remote_command)]
+
 
 class Setting(object):
     VERSION = 'color-ssh %s' % __import__('color_ssh').__version__
@@ -21,18 +73,56 @@ class Setting(object):
         '       %prog [options...] -H "[user@]hostname[:port] [[user@]hostname[:port]...]" command'
     ])
     DEFAULT_PARALLELISM = 32
+    ENGINES = ['pool', 'async']
+    DISTRIBUTION_METHODS = ['count', 'size', 'dynamic']
     CMD_SSH = str('ssh')
-    CMD_UPLOAD = [str('rsync'), str('-a')]
-    CMD_MKDIR = [str('mkdir'), str('-p')]
+    CMD_UPLOAD = [str('rsync'), str('-a'), str('--relative')]
+    CMD_CONTROL_EXIT = [str('-O'), str('exit')]
+    DEFAULT_CONTROL_PATH = '~/.ssh/color-ssh-%C'
+    TEMPORARY_CONTROL_PERSIST = '60'
+    CONNECT_TIMEOUT_OPTION = 'ConnectTimeout=%d'
 
-    def __init__(self, parallelism=None, tasks=None):
+    def __init__(self, parallelism=None, tasks=None, engine=None, cleanup_commands=None, work_queue=None,
+                 upload_stages=None, batch_size=None, max_fail=None, timeout=None, setup_timeout=None,
+                 progress=False, stats=False, stats_json=None, output=None, flush_interval=0, connect_rate=None,
+                 connect_burst=1, retries=0, retry_backoff=1.0, stdin_broadcast=False, stdin_address=None,
+                 journal=None, only_failed=False, upload_tree=None, stdin_spool=None, close_connections=False):
         self.parallelism = parallelism
         self.tasks = tasks
+        self.engine = engine
+        self.cleanup_commands = cleanup_commands or {}  # filled as hosts arrive
+        self.close_connections = close_connections  # whether to close the master connections at exit
+        self.started_hosts = StartedHosts()  # updated by the engines while running
+        self.work_queue = work_queue
+        self.upload_stages = upload_stages or []
+        self.upload_tree = upload_tree or {}
+        self.batch_size = batch_size
+        self.max_fail = max_fail
+        self.timeout = timeout
+        self.setup_timeout = setup_timeout
+        self.progress = progress
+        self.stats = stats
+        self.stats_json = stats_json
+        self.output = output
+        self.flush_interval = flush_interval
+        self.connect_rate = connect_rate
+        self.connect_burst = connect_burst
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.stdin_broadcast = stdin_broadcast
+        self.stdin_spool = stdin_spool
+        self.stdin_address = stdin_address  # set by main() while the Broadcaster is running
+        self.journal = journal
+        self.only_failed = only_failed
 
-    def parse_args(self, argv, stdout=io2bytes(sys.stdout)):
+    def parse_args(self, argv, stdout=io2bytes(sys.stdout), stdin=io2bytes(sys.stdin)):
         """
+        Hosts in the host file are read and parsed lazily, so tasks may be an iterator unless all hosts
+        are needed at once (--distribute, --upload-tree).
+
         :param argv: list of str
         :param stdout: binary-data stdout output
+        :param stdin: binary-data stdin input (used for "-h -")
         """
         parser = OptionParser(version=self.VERSION, usage=self.USAGE, conflict_handler='resolve')
         parser.allow_interspersed_args = False
@@ -47,20 +137,167 @@ class Setting(object):
         )
         parser.add_option(
             '-h', '--hosts', dest='host_file', default=None, type='string', metavar='HOST_FILE',
-            help='hosts file (each line "[user@]host[:port]")'
+            help='hosts file (each line "[user@]host[:port]" with ranges like "web[01-20]" or "db{a,b}", '
+                 '"[group]" headers and "@group" references, "-" for stdin)'
         )
         parser.add_option(
             '-H', '--host', dest='host_string', default=None, type='string', metavar='HOST_STRING',
             help='additional host entries ("[user@]host[:port]")'
         )
+        parser.add_option(
+            '-g', '--group', dest='groups', default=None, type='string', metavar='GROUP[,GROUP...]',
+            help='only the hosts in the groups of the hosts file'
+        )
+        parser.add_option(
+            '--no-inventory-cache', dest='inventory_cache', default=True, action='store_false',
+            help='do not use or save the compiled hosts file for --group (saved in $%s or ~/.cache/color-ssh)' %
+                 CACHE_DIR_ENV
+        )
         parser.add_option(
             '-p', '--par', dest='parallelism', default=self.DEFAULT_PARALLELISM, type='int', metavar='PAR',
             help='max number of parallel threads (default: %d)' % self.DEFAULT_PARALLELISM
         )
+        parser.add_option(
+            '--batch', dest='batch_size', default=None, type='int', metavar='NUM',
+            help='run hosts in waves of NUM hosts'
+        )
+        parser.add_option(
+            '--batch-percent', dest='batch_percent', default=None, type='float', metavar='PERCENT',
+            help='run hosts in waves of PERCENT %% of all hosts'
+        )
+        parser.add_option(
+            '--max-fail', dest='max_fail', default=None, type='int', metavar='NUM',
+            help='stop starting new hosts when more than NUM hosts have failed'
+        )
+        parser.add_option(
+            '--timeout', dest='timeout', default=None, type='float', metavar='SECONDS',
+            help='kill the command on a host after SECONDS (exit code: %d)' % TIMEOUT_EXIT_CODE
+        )
+        parser.add_option(
+            '--setup-timeout', dest='setup_timeout', default=None, type='float', metavar='SECONDS',
+            help='kill each setup command (e.g. upload) on a host after SECONDS'
+        )
+        parser.add_option(
+            '--connect-timeout', dest='connect_timeout', default=None, type='int', metavar='SECONDS',
+            help='timeout for establishing ssh connections (ssh ConnectTimeout option)'
+        )
+        parser.add_option(
+            '--connect-rate', dest='connect_rate', default=None, type='string', metavar='RATE',
+            help='max rate of starting new hosts, e.g. "50/s", "600/m" (default: unlimited)'
+        )
+        parser.add_option(
+            '--connect-burst', dest='connect_burst', default=1, type='int', metavar='NUM',
+            help='number of hosts which may start at once under --connect-rate (default: 1)'
+        )
+        parser.add_option(
+            '--retry', dest='retries', default=0, type='int', metavar='NUM',
+            help='retry hosts up to NUM times when ssh fails to connect (exit code %d) or a setup command fails' %
+                 SSH_ERROR_EXIT_CODE
+        )
+        parser.add_option(
+            '--retry-backoff', dest='retry_backoff', default=1.0, type='float', metavar='SECONDS',
+            help='base of the randomized exponential backoff between retries (default: 1.0)'
+        )
+        parser.add_option(
+            '--resume', dest='journal', default=None, type='string', metavar='JOURNAL',
+            help='record the result of each host in JOURNAL, and skip the hosts which already succeeded in it'
+        )
+        parser.add_option(
+            '--only-failed', dest='only_failed', default=False, action='store_true',
+            help='with --resume, run only the hosts which failed in JOURNAL'
+        )
+        parser.add_option(
+            '--progress', dest='progress', default=False, action='store_true',
+            help='report the number of finished, running and failed hosts to stderr'
+        )
+        parser.add_option(
+            '--stats', dest='stats', default=False, action='store_true',
+            help='print timing percentiles and the slowest hosts to stderr at exit'
+        )
+        parser.add_option(
+            '--stats-json', dest='stats_json', default=None, type='string', metavar='FILE',
+            help='write per-host timings and output sizes to FILE in JSON'
+        )
+        parser.add_option(
+            '--format', dest='output_format', default=FORMATS[0], type='choice', choices=FORMATS, metavar='FORMAT',
+            help='output format: color (colored lines), jsonl (JSON lines with host, label, stream, line and ts), '
+                 'grouped (output of each host in one block when it finishes), '
+                 'aggregate (hosts with identical output grouped together) (default: %s)' % FORMATS[0]
+        )
+        parser.add_option(
+            '--aggregate', dest='output_format', action='store_const', const='aggregate',
+            help='print each distinct output once with the ranges of the hosts (same as --format=aggregate)'
+        )
+        parser.add_option(
+            '--palette', dest='palette', default=DEFAULT_PALETTE, type='choice', choices=sorted(PALETTES.keys()),
+            metavar='PALETTE',
+            help='palette to choose the color of each label: %s (default: %s)' % (
+                ', '.join(sorted(PALETTES.keys())), DEFAULT_PALETTE)
+        )
+        parser.add_option(
+            '--outdir', dest='outdir', default=None, type='string', metavar='DIR',
+            help='append the stdout and stderr of each host to DIR/LABEL.out and DIR/LABEL.err, '
+                 'printing one status line per host'
+        )
+        parser.add_option(
+            '--outdir-compress', dest='outdir_compress', default=None, type='choice', choices=COMPRESSIONS,
+            metavar='METHOD', help='compress the files in --outdir with METHOD: %s' % ', '.join(COMPRESSIONS)
+        )
+        parser.add_option(
+            '--group-memory', dest='group_memory', default=DEFAULT_GROUP_MEMORY, type='int', metavar='BYTES',
+            help='max bytes of the output of a host kept in memory for --format=grouped or aggregate, '
+                 'larger output is spilled to temporary files (default: %d)' % DEFAULT_GROUP_MEMORY
+        )
+        parser.add_option(
+            '--flush-interval', dest='flush_interval', default=FLUSH_INTERVAL, type='float', metavar='SECONDS',
+            help='write the lines from all hosts together at most every SECONDS, 0 to write each line '
+                 'immediately (default: %s)' % FLUSH_INTERVAL
+        )
+        parser.add_option(
+            '--engine', dest='engine', default=self.ENGINES[0], type='choice', choices=self.ENGINES, metavar='ENGINE',
+            help='execution engine: %s (default: %s)' % (', '.join(self.ENGINES), self.ENGINES[0])
+        )
         parser.add_option(
             '--distribute', dest='distribute', default=None, type='string', metavar='PREFIX',
             help='split and distribute command-line arguments to each host'
         )
+        parser.add_option(
+            '--distribute-by', dest='distribute_by', default=self.DISTRIBUTION_METHODS[0], type='choice',
+            choices=self.DISTRIBUTION_METHODS, metavar='METHOD',
+            help='how to distribute arguments: count (same number of args), size (balance file sizes), '
+                 'dynamic (each host pulls the next args when it finishes) (default: %s)' %
+                 self.DISTRIBUTION_METHODS[0]
+        )
+        parser.add_option(
+            '--cost-file', dest='cost_file', default=None, type='string', metavar='COST_FILE',
+            help='costs of args for --distribute-by=size (each line "cost arg", e.g. output of du)'
+        )
+        parser.add_option(
+            '--chunk-size', dest='chunk_size', default=1, type='int', metavar='NUM',
+            help='number of args pulled at once for --distribute-by=dynamic (default: 1)'
+        )
+        parser.add_option(
+            '--multiplex', dest='multiplex', default=False, action='store_true',
+            help='share one ssh master connection per host among setup commands and the command'
+        )
+        parser.add_option(
+            '--control-path', dest='control_path', default=self.DEFAULT_CONTROL_PATH, type='string', metavar='PATH',
+            help='ControlPath of the master connections (default: %s)' % self.DEFAULT_CONTROL_PATH.replace('%', '%%')
+        )
+        parser.add_option(
+            '--control-persist', dest='control_persist', default=None, type='string', metavar='TIME',
+            help='keep the master connections for TIME after exit (default: close at exit)'
+        )
+        parser.add_option(
+            '--stdin-broadcast', dest='stdin_broadcast', default=False, action='store_true',
+            help='read stdin once and pass it to the command on every host'
+        )
+        parser.add_option(
+            '--stdin-spool', dest='stdin_spool', default=None, type='string', metavar='DIR',
+            help='spool stdin for --stdin-broadcast to a file in DIR, so that hosts may start after the first '
+                 '%d MiB of stdin have been sent (default: the temporary directory, unless all hosts start at once)'
+                 % (RING_SIZE >> 20)
+        )
         parser.add_option(
             '--upload', dest='upload', default=False, action='store_true',
             help='upload files before executing a command (all args are regarded as paths)'
@@ -69,55 +306,229 @@ class Setting(object):
             '--upload-with', dest='upload_with', default=None, type='string', metavar='PATH',
             help='file paths to be uploaded before executing a command'
         )
+        parser.add_option(
+            '--upload-tree', dest='upload_tree', default=0, type='int', metavar='FANOUT',
+            help='upload --upload-with files to FANOUT hosts, which relay them to FANOUT hosts each, and so on '
+                 '(hosts must be able to ssh to each other, e.g. with agent forwarding)'
+        )
 
         option, args = parser.parse_args(argv[1:])
-        hosts = self._load_hosts(option.host_file) + (option.host_string.split() if option.host_string else [])
+        if option.only_failed and not option.journal:
+            raise ValueError('--only-failed requires --resume')
+        if option.outdir is not None and option.output_format != FORMATS[0]:
+            raise ValueError('--outdir cannot be used with --format=%s' % option.output_format)
+        if option.outdir is not None and option.label:
+            raise ValueError('--outdir cannot be used with --label, which would be the same for every host')
+        if option.outdir_compress is not None and option.outdir is None:
+            raise ValueError('--outdir-compress requires --outdir')
+        if option.stdin_broadcast and option.host_file == '-':
+            raise ValueError('Hosts cannot be read from stdin with --stdin-broadcast')
+        if option.stdin_spool is not None and not option.stdin_broadcast:
+            raise ValueError('--stdin-spool requires --stdin-broadcast')
+        if option.groups and not option.host_file:
+            raise ValueError('Groups require a hosts file')
+        if option.distribute and option.distribute_by == 'dynamic' and \
+                (option.batch_size is not None or option.batch_percent is not None):
+            raise ValueError('--batch cannot be used with --distribute-by=dynamic (hosts pull args as they finish)')
+        groups = option.groups.split(',') if option.groups else None
+        cache_dir = default_cache_dir() if option.inventory_cache else None
+        hosts = itertools.chain(self._load_hosts(option.host_file, stdin, groups, cache_dir),
+                                expand_hosts(option.host_string.split() if option.host_string else []))
+        head = list(itertools.islice(hosts, 1))
 
-        if len(args) < (1 if hosts else 2):
+        if len(args) < (1 if head else 2):
             print(option.__dict__)
             stdout.write(arg2bytes(parser.format_help().encode('utf-8')))
             parser.exit(2)
 
-        if not hosts:
-            hosts = args[:1]
+        if head:
+            parsed_hosts = itertools.chain(head, hosts)
+        else:
+            parsed_hosts = expand_hosts(args[:1])
             del args[0]
 
-        # parse hosts
-        parsed_hosts = [self._parse_host(h) for h in hosts]
-
         # parse upload-with option
         upload_with = [] if option.upload_with is None else shlex.split(option.upload_with)
 
+        ssh_cmd = option.ssh
+        rsh = None
+        if option.connect_timeout is not None:
+            ssh_cmd = rsh = '%s -o %s' % (ssh_cmd, self.CONNECT_TIMEOUT_OPTION % option.connect_timeout)
+
+        # connection multiplexing
+        cleanup_commands = {}
+        if option.multiplex:
+            ssh_cmd = rsh = self._multiplex_ssh_cmd(
+                ssh_cmd, option.control_path, option.control_persist or self.TEMPORARY_CONTROL_PERSIST)
+            if option.control_persist is None:
+                # close the master connections at exit
+                parsed_hosts = self._track_hosts(parsed_hosts, ssh_cmd, cleanup_commands)
+
+        # read hosts lazily only from a host file, or if these features need all the hosts at once
+        if not option.host_file or option.distribute or (option.upload_tree > 0 and upload_with):
+            parsed_hosts = list(parsed_hosts)
+
+        # upload tree
+        upload_stages = []
+        upload_tree = {}
+        if option.upload_tree > 0 and upload_with:
+            upload_stages, upload_tree = self._build_upload_stages(
+                parsed_hosts, upload_with, option.upload_tree, option.label, ssh_cmd, rsh)
+            upload_with = []
+
+        # split once, not for each host
+        ssh_args = shlex.split(ssh_cmd)
+
+        def build_task(user, host, port, command_args, upload_paths):
+            return Task(option.label or host,
+                        ssh_args + self._host_args(user, host, port) + command_args,
+                        self._build_upload_commands(user, host, port, upload_paths, rsh),
+                        host, (user, host, port), command_args)
+
         tasks = []
+        work_queue = None
         if option.distribute:
             # distribute args
             dist_prefix = shlex.split(option.distribute)
-            d = distribute(len(hosts), args)
-            for i, (user, host, port) in enumerate(parsed_hosts):
-                if d[i]:
-                    upload_paths = upload_with + d[i] if option.upload else []
-                    label = option.label or host
-                    ssh_args = self._ssh_args(option.ssh, user, host, port)
-                    tasks.append((label, ssh_args + dist_prefix + d[i],
-                                  self._build_upload_commands(user, host, port, option.ssh, upload_paths)))
+
+            def build_dist_task(parsed_host, xs):
+                user, host, port = parsed_host
+                return build_task(user, host, port, dist_prefix + xs, upload_with + xs if option.upload else [])
+
+            if option.distribute_by == 'dynamic':
+                k = max(1, option.chunk_size)
+                work_queue = (parsed_hosts, [args[i:i + k] for i in range(0, len(args), k)], build_dist_task)
+            else:
+                if option.distribute_by == 'size':
+                    costs = self._arg_costs(args, self._load_costs(option.cost_file))
+                    d = distribute_by_cost(len(parsed_hosts), args, costs)
+                else:
+                    d = distribute(len(parsed_hosts), args)
+                tasks = [build_dist_task(h, xs) for h, xs in zip(parsed_hosts, d) if xs]
         else:
-            for user, host, port in parsed_hosts:
-                tasks.append((option.label or host,
-                              self._ssh_args(option.ssh, user, host, port) + args,
-                              self._build_upload_commands(user, host, port, option.ssh, upload_with)))
+            tasks = (build_task(user, host, port, args, upload_with) for user, host, port in parsed_hosts)
+            if isinstance(parsed_hosts, list):
+                tasks = list(tasks)
 
         self.parallelism = option.parallelism
         self.tasks = tasks
+        self.engine = option.engine
+        self.cleanup_commands = cleanup_commands
+        self.close_connections = option.multiplex and option.control_persist is None
+        self.work_queue = work_queue
+        self.upload_stages = upload_stages
+        self.upload_tree = upload_tree
+        self.batch_size = option.batch_size
+        self.max_fail = option.max_fail
+        self.timeout = option.timeout
+        self.setup_timeout = option.setup_timeout
+        self.progress = option.progress
+        self.stats = option.stats
+        self.stats_json = option.stats_json
+        self.output = Output(option.output_format, option.group_memory, palette=option.palette,
+                             outdir=option.outdir, compress=option.outdir_compress)
+        self.flush_interval = option.flush_interval
+        self.connect_rate = None if option.connect_rate is None else self._parse_rate(option.connect_rate)
+        self.connect_burst = option.connect_burst
+        self.retries = max(0, option.retries)
+        self.retry_backoff = option.retry_backoff
+        self.stdin_broadcast = option.stdin_broadcast
+        self.stdin_spool = option.stdin_spool
+        self.journal = option.journal
+        self.only_failed = option.only_failed
+        if option.batch_percent is not None:
+            self.tasks = list(self.tasks)
+            self.batch_size = int(math.ceil(len(self.tasks) * option.batch_percent / 100.0))
+        if self.batch_size is not None:
+            self.batch_size = max(1, self.batch_size)
         return self
 
     @staticmethod
-    def _load_hosts(path):
+    def _load_hosts(path, stdin=None, groups=None, cache_dir=None):
+        """
+        :param path: path to the hosts file or "-" for stdin
+        :param groups: list of group names to select, or None for all the hosts
+        :param cache_dir: directory of the compiled hosts files, or None to disable caching
+        :return: generator of parsed hosts
+        """
         if not path:
-            return []
+            return
+
+        if groups is not None:
+            # groups may refer to the groups defined anywhere in the file, so read it all at once
+            if path == '-':
+                lines = ((os.fsdecode(line) if PY3 else line) for line in detach_stdin(stdin))
+                inventory = Inventory.compile(lines)
+            else:
+                inventory = load_inventory(path, cache_dir)
+            for h in inventory.select(groups):
+                yield h
+            return
+
+        # read lazily so that the first host starts before the whole file is parsed
+        if path == '-':
+            for h in iter_hosts((os.fsdecode(line) if PY3 else line) for line in detach_stdin(stdin)):
+                yield h
+            return
 
         with io.open(path) as f:
-            lines = f.readlines()
-        return list(filter(lambda x: str(x), (line.strip() for line in lines)))
+            for h in iter_hosts(f):
+                yield h
+
+    def _track_hosts(self, parsed_hosts, ssh_cmd, cleanup_commands):
+        """
+        Add the command to close the master connection of each host to cleanup_commands as hosts arrive.
+
+        :param cleanup_commands: dict of (user, host, port) -> command
+        """
+        for user, host, port in parsed_hosts:
+            if (user, host, port) not in cleanup_commands:
+                cmd = self._ssh_args(ssh_cmd, user, host, port)
+                cmd[-1:-1] = self.CMD_CONTROL_EXIT
+                cleanup_commands[(user, host, port)] = cmd
+            yield [user, host, port]
+
+    @staticmethod
+    def _load_costs(path):
+        """
+        :param path: path to the cost file (each line "cost arg")
+        :return: dict of arg -> cost
+        """
+        if not path:
+            return {}
+
+        ret = {}
+        with io.open(path) as f:
+            for line in f:
+                xs = line.strip().split(None, 1)
+                if len(xs) == 2:
+                    ret[str(xs[1])] = float(xs[0])
+        return ret
+
+    @staticmethod
+    def _arg_costs(args, costs):
+        """
+        :return: list of the cost of each arg (from the cost table, or the file size if missing)
+        """
+        def f(arg):
+            if arg in costs:
+                return costs[arg]
+            try:
+                return os.stat(arg).st_size
+            except OSError:
+                return 0
+        return [f(arg) for arg in args]
+
+    @staticmethod
+    def _parse_rate(s):
+        """
+        :param s: "NUM", "NUM/s", "NUM/m" or "NUM/h"
+        :return: number per second
+        """
+        ret = re.match(r'^(\d+(?:\.\d*)?)(?:/(s|m|h))?$', s.strip())
+        if not ret or float(ret.group(1)) <= 0:
+            raise ValueError('Illegal rate: %s' % s)
+        return float(ret.group(1)) / {None: 1, 's': 1, 'm': 60, 'h': 3600}[ret.group(2)]
 
     @staticmethod
     def _parse_host(s):
@@ -125,10 +536,7 @@ class Setting(object):
         :param s: string : [user@]host[:port]
         :return: tuple of (user, host, port)
         """
-        ret = re.match('^(?:([^:@]+)@)?([^:@]+)(?::(\d+))?$', s)
-        if not ret:
-            raise ValueError('Illegal format: %s' % s)
-        return [None if s is None else str(s) for s in ret.groups()]
+        return parse_host(s)
 
     @staticmethod
     def _build_host_string(user, host):
@@ -139,81 +547,1052 @@ class Setting(object):
 
     @staticmethod
     def _ssh_args(ssh_cmd, user, host, port):
-        return shlex.split(ssh_cmd) + (
-            [] if port is None else [str('-p'), port]) + [Setting._build_host_string(user, host)]
+        return shlex.split(ssh_cmd) + Setting._host_args(user, host, port)
 
     @staticmethod
-    def _upload_args(user, host, port, path):
-        return Setting.CMD_UPLOAD + ([] if port is None else [str('-P'), port]) + [
-            path,
-            Setting._build_host_string(user, host) + str(':') + path
-        ]
+    def _host_args(user, host, port):
+        return ([] if port is None else [str('-p'), port]) + [Setting._build_host_string(user, host)]
 
     @staticmethod
-    def _build_upload_commands(user, host, port, ssh_cmd, paths):
-        # create directories
-        dirs = list(set(x for x in [os.path.dirname(path) for path in paths] if x != '' and x != '.'))
+    def _multiplex_ssh_cmd(ssh_cmd, control_path, control_persist):
+        """
+        :return: ssh command line string which creates or reuses a master connection
+        """
+        opts = ['ControlMaster=auto', 'ControlPath=%s' % control_path, 'ControlPersist=%s' % control_persist]
+        return ' '.join([ssh_cmd] + [str('-o %s') % shell_quote(o) for o in opts])
 
-        ret = []
-        if dirs:
-            ret.append(Setting._ssh_args(ssh_cmd, user, host, port) + Setting.CMD_MKDIR + sorted(dirs))
+    @staticmethod
+    def _upload_args(user, host, port, paths, dest, rsh=None):
+        if port is not None:
+            rsh = str('%s -p %s') % (rsh or Setting.CMD_SSH, port)
+        # route rsync through the ssh command (and its master connection)
+        opts = [] if rsh is None else [str('-e'), rsh]
+        return Setting.CMD_UPLOAD + opts + paths + [Setting._build_host_string(user, host) + str(':') + dest]
 
-        # upload files
-        ret.extend([Setting._upload_args(user, host, port, path) for path in paths])
+    @staticmethod
+    def _build_upload_stages(parsed_hosts, paths, fanout, label, ssh_cmd, rsh=None):
+        """
+        Build the stages of a k-ary upload tree. The first stage uploads the files from local to the first
+        FANOUT hosts (seeds) and each subsequent stage relays them from the hosts in the previous stage.
+
+        :return: tuple of (list of stages (list of tasks which can run in parallel),
+                 dict of address -> (address of the parent or None, commands to upload the files from local))
+        """
+        hosts = []
+        for h in parsed_hosts:
+            if tuple(h) not in hosts:
+                hosts.append(tuple(h))
+
+        stages = []
+        tree = {}
+        depth = []
+        for i, (user, host, port) in enumerate(hosts):
+            parent = i // fanout - 1
+            direct = Setting._build_upload_commands(user, host, port, paths, rsh)
+            if parent < 0:
+                # local -> seed
+                depth.append(0)
+                commands = direct
+            else:
+                # parent host -> host
+                depth.append(depth[parent] + 1)
+                ssh_args = Setting._ssh_args(ssh_cmd, *hosts[parent])
+                commands = [ssh_args + [str(' ').join(shell_quote(x) for x in cmd)]
+                            for cmd in Setting._build_upload_commands(user, host, port, paths)]
+            if len(stages) <= depth[i]:
+                stages.append([])
+            stages[depth[i]].append(Task(label or host, commands[-1], commands[:-1], host, hosts[i]))
+            tree[hosts[i]] = (hosts[parent] if parent >= 0 else None, direct)
+        return stages, tree
+
+    @staticmethod
+    def _build_upload_commands(user, host, port, paths, rsh=None):
+        """
+        Build one rsync command for relative paths and one for absolute paths.
+        Since rsync runs with --relative, parent directories are created on the remote side.
+        """
+        uniq = []
+        for path in paths:
+            if path not in uniq:
+                uniq.append(path)
+
+        ret = []
+        for dest, xs in [(str(''), [p for p in uniq if not os.path.isabs(p)]),
+                         (str('/'), [p for p in uniq if os.path.isabs(p)])]:
+            if xs:
+                ret.append(Setting._upload_args(user, host, port, xs, dest, rsh))
         return ret
 
 
-def run_task(args):
+def starts_at_once(setting):
+    """
+    :return: True if the commands start on all the hosts at once, which need not spool the broadcast stdin
+    """
+    tasks = setting.tasks
+    return setting.work_queue is None and isinstance(tasks, list) and len(tasks) <= setting.parallelism and \
+        setting.batch_size is None and setting.connect_rate is None and setting.retries == 0 and \
+        not any(task[2] for task in tasks)
+
+
+def detach_stdin(stdin):
+    """
+    Move stdin to a new file descriptor and replace it with /dev/null,
+    so that the ssh commands will not consume the data read by color-ssh.
+
+    :param stdin: binary-data stdin input
+    :return: binary-data input
+    """
+    try:
+        fd = stdin.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return stdin
+
+    new_fd = os.dup(fd)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, fd)
+    os.close(devnull)
+    return io.open(new_fd, 'rb')
+
+
+def setup_message(cmd):
+    return 'setup: %s' % cmd
+
+
+def task_error_message(e, label, command):
+    return '%s: %s\nlabel=%s, command=%s\n' % (e.__class__.__name__, e, label, command)
+
+
+def timeout_message(timeout, cmd):
+    return 'timed out after %s seconds: %s' % (timeout, cmd)
+
+
+def kill_process_group(pid):
+    """
+    Kill the process group led by pid (commands with a timeout run in their own process group).
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def new_session_args(timeout):
+    """
+    Keyword arguments of Popen to run a command with a timeout in a new session (and process group), so that
+    the whole process tree can be killed on timeout. start_new_session is safer than preexec_fn in a process
+    with threads.
+
+    :return: dict of keyword arguments
+    """
+    if timeout is None:
+        return {}
+    return {'start_new_session': True} if PY3 else {'preexec_fn': os.setsid}
+
+
+# state of a worker process (see init_pool_worker)
+_interruptible = False
+_interrupted = False
+
+
+def _interrupt(signum, frame):
+    global _interruptible, _interrupted
+    _interrupted = True
+    if _interruptible:
+        _interruptible = False
+        raise KeyboardInterrupt
+
+
+def init_pool_worker(initializer, args):
+    """
+    Initializer of the worker processes. Ctrl-C interrupts only the running task, which kills its commands and
+    returns, and the worker skips the remaining tasks. Workers never die in the middle of taking a task or
+    sending a result, which would hang the pool.
+
+    :param initializer: function to initialize the worker further
+    :param args: arguments of initializer
+    """
+    signal.signal(signal.SIGINT, _interrupt)
+    initializer(*args)
+
+
+def run_interruptible(func, args):
+    """
+    Run a task in a worker process, where Ctrl-C interrupts it.
+
+    :return: return value of func, or None if the worker has been interrupted
+    """
+    global _interruptible
+    _interruptible = True
+    try:
+        if _interrupted:
+            return None
+        return func(args)
+    finally:
+        _interruptible = False
+
+
+class TaskTimeout(Exception):
+    def __init__(self, timeout, cmd):
+        super(TaskTimeout, self).__init__('timed out after %s seconds: %s' % (timeout, cmd))
+        self.timeout = timeout
+        self.cmd = cmd
+
+
+def run_task(args, timeout=None, setup_timeout=None, stats=None, output=None, stdin_address=None, procs=None):
+    """
+    :param args: Task or tuple of (label, command, setup_commands)
+    :param timeout: seconds to wait for the command
+    :param setup_timeout: seconds to wait for each setup command
+    :param stats: dict made by stats.new_record to fill timings and output counts in, or None
+    :param output: Output instance (default: colored lines)
+    :param stdin_address: address of the Broadcaster to read the stdin of the command from, or None
+    :param procs: set to hold the running commands in, for another thread to kill them, or None
+    :return: return code of the command (TIMEOUT_EXIT_CODE when timed out)
+    """
     label, command, setup_commands = args
+    host = getattr(args, 'host', None) or label
 
     # We don't pass stdout/stderr file descriptors since this function runs in the forked processes.
-    stdout = io2bytes(sys.stdout)
-    stderr = io2bytes(sys.stderr)
-
-    prefix = ['color-cat', '-l', label]
+    # Colorize the output in this process instead of spawning two color-cat processes per host.
+    stdout, stderr = get_streams()
+    out = (output or Output()).open(host, label, stdout, stderr, getattr(args, 'remote_command', None))
 
     def exc_func(e):
-        msg = '%s: %s\nlabel=%s, command=%s\n' % (e.__class__.__name__, e, label, command)
-        stderr.write(msg.encode('utf-8', 'ignore'))
+        out.message('error', task_error_message(e, label, command))
+
+    def call(cmd, seconds, broadcast=False):
+        # run in a new session to kill the whole process tree on timeout
+        sock = connect(stdin_address) if broadcast else None
+        try:
+            proc = subprocess.Popen(cmd, stdin=None if sock is None else sock.fileno(), stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, **new_session_args(seconds))
+        finally:
+            if sock is not None:
+                sock.close()
+        if procs is not None:
+            procs.add(proc)
+        timer = None
+        timed_out = threading.Event()
+        if seconds is not None:
+            def kill():
+                timed_out.set()
+                kill_process_group(proc.pid)
+
+            timer = threading.Timer(seconds, kill)
+            timer.daemon = True
+            timer.start()
+
+        stderr_counts = []
+
+        def copy_stderr():
+            stderr_counts.append(out.copy(proc.stderr, 'stderr'))
+
+        t = threading.Thread(target=copy_stderr)
+        t.daemon = True
+        t.start()
+        try:
+            try:
+                stdout_counts = out.copy(proc.stdout, 'stdout')
+            except BaseException:
+                # the command in its own session does not receive SIGINT from the terminal
+                if seconds is not None:
+                    kill_process_group(proc.pid)
+                raise
+            finally:
+                t.join()
+                proc.stdout.close()
+                proc.stderr.close()
+            ret = proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if procs is not None:
+                procs.discard(proc)
+
+        if stats is not None:
+            add_output(stats, 'stdout', stdout_counts)
+            add_output(stats, 'stderr', stderr_counts[0] if stderr_counts else (0, 0))
+        if timed_out.is_set():
+            raise TaskTimeout(seconds, cmd)
+        return ret
+
+    def timed_call(cmd, seconds, key):
+        t = time.time()
+        ret = None
+        try:
+            ret = call(cmd, seconds, key == 'command' and stdin_address is not None)
+            return ret
+        finally:
+            if stats is not None:
+                if key == 'setup':
+                    stats['setup'].append({'command': cmd, 'time': time.time() - t, 'ret': ret})
+                else:
+                    stats['time'] = time.time() - t
 
     @exception_handler(exc_func)
     def f():
-        proc_stdout = subprocess.Popen(prefix, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
-        proc_stderr = subprocess.Popen(prefix + ['-s', '+'], stdin=subprocess.PIPE, stdout=stderr, stderr=stderr)
+        try:
+            for cmd in setup_commands:
+                out.message('setup', setup_message(cmd))
+
+                r = timed_call(cmd, setup_timeout, 'setup')
+                if r != 0:
+                    raise RuntimeError('Failed to execute setup command: %s' % cmd)
+
+            return timed_call(command, timeout, 'command')
+        except TaskTimeout as e:
+            out.message('timeout', timeout_message(e.timeout, e.cmd))
+            return TIMEOUT_EXIT_CODE
+
+    ret = None
+    try:
+        ret = f()
+        return ret
+    finally:
+        out.close(ret)
+
+
+def run_task_with_stats(args, timeout=None, setup_timeout=None, output=None, stdin_address=None, procs=None):
+    """
+    Run a task and collect its statistics.
+
+    :param args: tuple of (task, time when the task was taken by the dispatcher[, number of retries])
+    :return: tuple of (return code, stats record)
+    """
+    task, queued_at = args[:2]
+    record = new_record(task[0], task[1], getattr(task, 'target', None))
+    record['attempt'] = args[2] if len(args) > 2 else 0
+
+    start = time.time()
+    record['queue'] = start - queued_at
+    ret = run_task(task, timeout, setup_timeout, record, output, stdin_address, procs)
+    record['ret'] = ret
+    record['total'] = time.time() - queued_at
+    return ret, record
+
+
+def run_attempt(args, timeout=None, setup_timeout=None, output=None, stdin_address=None):
+    """
+    Run a task yielded by Retrier.
+
+    :param args: tuple of (task, time when the task was taken by the dispatcher, number of retries)
+    :return: tuple of (args, return code, stats record)
+    """
+    ret, record = run_task_with_stats(args, timeout, setup_timeout, output, stdin_address)
+    return args, ret, record
+
+
+def run_work_queue(work_queue, parallelism, timeout=None, setup_timeout=None, stats=None, output=None, mux=None,
+                   limiter=None, retrier=None, stdin_address=None, max_fail=None, progress=False,
+                   stderr=None, started=None):
+    """
+    Run batches of args on hosts dynamically. Each host pulls the next batch when it finishes the previous one,
+    and no host pulls a batch after more than max_fail batches have failed, or after Ctrl-C.
+
+    :param work_queue: tuple of (parsed hosts, batches, function to build a task from a parsed host and a batch)
+    :param parallelism: max number of hosts running at the same time
+    :param timeout: seconds to wait for each command
+    :param setup_timeout: seconds to wait for each setup command
+    :param stats: Stats or Journal instance to collect the statistics of each batch, or None
+    :param output: Output instance
+    :param mux: Multiplexer instance to write the output through, or None
+    :param limiter: RateLimiter instance to wait for before starting each batch, or None
+    :param retrier: Retrier instance to decide retries of failed connections, or None
+    :param stdin_address: address of the Broadcaster to read the stdin of the commands from, or None
+    :param max_fail: max number of failed batches before skipping the rest, or None
+    :param progress: report the number of finished, running and failed batches to stderr
+    :param stderr: binary-data stderr output
+    :param started: StartedHosts instance to record the hosts which took a batch, or None
+    :return: list of return codes
+    """
+    hosts, batches, build_task = work_queue
+    breaker = CircuitBreaker(max_fail)
+    monitors = [breaker]
+    if progress:
+        monitors.append(Progress(stderr, len(batches)))
+    batches = collections.deque((batch, 0) for batch in batches)
+    ret = []
+    # the workers share the queue and the monitors
+    lock = threading.Lock()
+    stopped = threading.Event()  # set on Ctrl-C
+    procs = set()  # commands running in the workers
+
+    def take():
+        """
+        :return: tuple of (batch, number of retries), or None if no batches are left to run
+        """
+        with lock:
+            while batches and not stopped.is_set():
+                batch, attempt = batches.popleft()
+                if attempt > 0:
+                    # retries were counted when they started first
+                    return batch, attempt
+                xs = [batch]
+                for m in monitors:
+                    xs = m.filter(xs)
+                for x in xs:
+                    return x, attempt
+            return None
+
+    def record(r):
+        if r == 130:
+            # the commands without a timeout share the terminal, and got Ctrl-C before the main thread
+            stopped.set()
+        with lock:
+            ret.append(r)
+            for m in monitors:
+                m.record(r)
+
+    def run(task, batch, attempt):
+        """
+        :return: seconds for the host to back off before taking the next batch
+        """
+        if limiter is not None:
+            limiter.acquire()
+        if stats is None and retrier is None:
+            record(run_task(task, timeout, setup_timeout, output=output, stdin_address=stdin_address, procs=procs))
+            return 0
+
+        r, rec = run_task_with_stats((task, time.time(), attempt), timeout, setup_timeout, output, stdin_address,
+                                     procs)
+        rec['batch'] = batch
+        if retrier is not None and r != 130 and not stopped.is_set():
+            with retrier.condition:
+                delay = retrier.should_retry(task, attempt, r, rec)
+            if delay is not None:
+                # give the batch to any host, and keep this host away for a while
+                batches.appendleft((batch, attempt + 1))
+                return delay
+        if stats is not None:
+            stats.add(rec)
+        record(r)
+        return 0
+
+    def worker(host):
+        source = None if mux is None else mux.source()
+        if source is not None:
+            set_streams(*source.streams())
+        try:
+            while True:
+                item = take()
+                if item is None:
+                    return
+                batch, attempt = item
+                task = build_task(host, batch)
+                if started is not None:
+                    started.add(task)
+                delay = run(task, batch, attempt)
+                if delay:
+                    # a host backing off does not delay Ctrl-C
+                    stopped.wait(delay)
+        finally:
+            if source is not None:
+                source.close()
+
+    threads = [threading.Thread(target=worker, args=(h,)) for h in hosts[:max(1, parallelism)]]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                # joining with a timeout, which Ctrl-C can interrupt in Python 2
+                t.join(JOIN_INTERVAL)
+    except KeyboardInterrupt:
+        # the workers skip the remaining batches; kill the commands of the running ones, as a worker process of
+        # dispatch does, including any setup command starting meanwhile
+        stopped.set()
+        for t in threads:
+            while t.is_alive():
+                for proc in list(procs):
+                    kill_process_group(proc.pid)
+                t.join(JOIN_INTERVAL)
+        raise
+    if stderr is not None:
+        breaker.report(stderr, 'batches')
+    return ret
+
+
+def run_cleanup(commands, parallelism=1):
+    """
+    Run cleanup commands (e.g. closing master connections) ignoring their results.
+
+    :param parallelism: max number of commands running at the same time
+    """
+    running = collections.deque()
+    with io.open(os.devnull, 'wb') as devnull:
+        for cmd in commands:
+            if len(running) >= max(1, parallelism):
+                running.popleft().wait()
+            try:
+                running.append(subprocess.Popen(cmd, stdin=None, stdout=devnull, stderr=devnull))
+            except OSError:
+                pass
+        for proc in running:
+            proc.wait()
+
+
+class CircuitBreaker(object):
+    """
+    Count failed tasks and stop scheduling new tasks when the failures exceed the threshold.
+    """
+
+    def __init__(self, max_fail=None):
+        self.max_fail = max_fail
+        self.failures = 0
+        self.skipped = 0
+
+    def record(self, ret):
+        if ret != 0:
+            self.failures += 1
+
+    def is_open(self):
+        return self.max_fail is not None and self.failures > self.max_fail
+
+    def report(self, stderr, unit='hosts'):
+        if self.skipped:
+            msg = 'color-ssh: %d %s failed (max-fail: %d), %d %s skipped\n' % (
+                self.failures, unit, self.max_fail, self.skipped, unit)
+            stderr.write(msg.encode('utf-8'))
+            stderr.flush()
+
+    def filter(self, tasks):
+        """
+        :return: generator of tasks, which skips all the remaining tasks once the breaker opens
+        """
+        for task in tasks:
+            if self.is_open():
+                self.skipped += 1
+            else:
+                yield task
+
+
+class StartedHosts(object):
+    """
+    Record the hosts whose tasks are taken by the dispatcher, e.g. to close only the master connections opened.
+    """
+
+    def __init__(self):
+        self.addresses = set()
+
+    def add(self, task):
+        address = getattr(task, 'address', None)
+        if address is not None:
+            self.addresses.add(tuple(address))
+
+    def filter(self, tasks):
+        """
+        :return: generator of tasks, which records the tasks taken
+        """
+        for task in tasks:
+            self.add(task)
+            yield task
+
+
+class Retrier(object):
+    """
+    Reschedule tasks which failed to connect (ssh exit code 255 or a failed setup command)
+    after a jittered exponential backoff. Waiting tasks do not occupy worker slots.
+    """
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, retries, backoff=1.0, stderr=None, clock=time.time, rand=random.random):
+        """
+        :param retries: max number of retries for each task
+        :param backoff: base seconds of the backoff, doubled every retry
+        :param stderr: binary-data stderr output to report retries
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.stderr = stderr
+        self.clock = clock
+        self.rand = rand
+        self.condition = threading.Condition()
+        self.waiting = []  # heap of (due time, sequence number, task, attempt)
+        self.running = 0
+        self.retried = []  # hosts retried at least once
+        self.counter = itertools.count()
+        self.closed = False
 
-        for cmd in setup_commands:
-            proc_stderr.stdin.write(('setup: %s\n' % cmd).encode('utf-8', 'ignore'))
+    @staticmethod
+    def is_retryable(ret, record):
+        return ret == SSH_ERROR_EXIT_CODE or any(x.get('ret') not in (0, None) for x in record['setup'])
+
+    def delay(self, attempt):
+        # "full jitter": uniformly random between zero and the exponential backoff
+        return self.rand() * min(self.MAX_BACKOFF, self.backoff * 2 ** attempt)
+
+    def filter(self, tasks):
+        """
+        :return: generator of (task, time when the task is taken, number of retries),
+                 which also yields the retries when they are due, and finishes when no tasks may be retried
+        """
+        for task in tasks:
+            if self.closed:
+                return
+            for x in self._pop(wait=False):
+                yield x
+            yield self._start(task, 0)
+
+        while True:
+            xs = self._pop(wait=True)
+            if not xs:
+                return
+            for x in xs:
+                yield x
 
-            r = subprocess.call(cmd, stdin=None, stdout=proc_stdout.stdin, stderr=proc_stderr.stdin)
-            if r != 0:
-                raise RuntimeError('Failed to execute setup command: %s' % cmd)
+    def retry(self, item, ret, record):
+        """
+        Called when a task finishes.
+
+        :param item: tuple yielded by filter()
+        :return: True if the task is rescheduled
+        """
+        task, _, attempt = item
+        with self.condition:
+            self.running -= 1
+            delay = self.should_retry(task, attempt, ret, record)
+            if delay is not None:
+                heapq.heappush(self.waiting, (self.clock() + delay, next(self.counter), task, attempt + 1))
+            self.condition.notify_all()
+        return delay is not None
+
+    def close(self):
+        """
+        Stop yielding tasks, e.g. on Ctrl-C, when the results of the running tasks never arrive.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def should_retry(self, task, attempt, ret, record):
+        """
+        Decide whether to retry a finished task and note the retry.
+
+        :return: seconds to wait before the retry, or None not to retry
+        """
+        if attempt >= self.retries or not self.is_retryable(ret, record):
+            return None
+
+        delay = self.delay(attempt)
+        if attempt == 0:
+            self.retried.append(getattr(task, 'host', None) or task[0])
+        if self.stderr is not None:
+            msg = 'color-ssh: retrying %s in %.1f seconds (%d/%d)\n' % (task[0], delay, attempt + 1, self.retries)
+            self.stderr.write(msg.encode('utf-8', 'ignore'))
+            self.stderr.flush()
+        return delay
+
+    def report(self):
+        if self.retried and self.stderr is not None:
+            msg = 'color-ssh: retried %d hosts: %s\n' % (len(self.retried), format_host_ranges(self.retried))
+            self.stderr.write(msg.encode('utf-8', 'ignore'))
+            self.stderr.flush()
+
+    def _start(self, task, attempt):
+        with self.condition:
+            self.running += 1
+        return task, time.time(), attempt
+
+    def _pop(self, wait):
+        """
+        :param wait: wait until a retry is due, unless nothing is running or waiting
+        :return: list of items due
+        """
+        with self.condition:
+            while True:
+                if self.closed:
+                    return []
+                ret = []
+                now = self.clock()
+                while self.waiting and self.waiting[0][0] <= now:
+                    _, _, task, attempt = heapq.heappop(self.waiting)
+                    ret.append((task, attempt))
+                if ret or not wait or (not self.waiting and self.running == 0):
+                    break
+                self.condition.wait(self.waiting[0][0] - now if self.waiting else None)
+        return [self._start(task, attempt) for task, attempt in ret]
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the rate of starting new tasks (i.e. new ssh connections).
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        """
+        :param rate: number of tasks per second
+        :param burst: max number of tasks started at once after being idle
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait for a token. Tokens are reserved in order, so concurrent callers are spaced out evenly.
+
+        :return: seconds waited
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = max(0.0, -self.tokens / self.rate)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def record(self, ret):
+        pass
+
+    def filter(self, tasks):
+        """
+        :return: generator of tasks, which waits for a token before yielding each task
+        """
+        for task in tasks:
+            self.acquire()
+            yield task
+
+
+class Progress(object):
+    """
+    Report the number of finished, running and failed tasks to stderr.
+    """
+    INTERVAL = 1.0
 
-        ret = subprocess.call(command, stdin=None, stdout=proc_stdout.stdin, stderr=proc_stderr.stdin)
+    def __init__(self, stderr, total=None):
+        self.stderr = stderr
+        self.total = total
+        self.started = 0
+        self.done = 0
+        self.failures = 0
+        self.last_report = None
 
-        proc_stdout.stdin.close()
-        proc_stderr.stdin.close()
+    def record(self, ret):
+        self.done += 1
+        if ret != 0:
+            self.failures += 1
 
-        proc_stdout.wait()
-        proc_stderr.wait()
+        now = time.time()
+        if self.last_report is None or now - self.last_report >= self.INTERVAL or self.done == self.total:
+            self.report()
+            self.last_report = now
+
+    def filter(self, tasks):
+        """
+        :return: generator of tasks, which counts tasks taken by the dispatcher
+        """
+        for task in tasks:
+            self.started += 1
+            yield task
+
+    def report(self):
+        done = '%d' % self.done if self.total is None else '%d/%d' % (self.done, self.total)
+        msg = 'color-ssh: done %s, running %d, failed %d\n' % (done, self.started - self.done, self.failures)
+        self.stderr.write(msg.encode('utf-8'))
+        self.stderr.flush()
+
+
+def dispatch(tasks, setting, stdout, stderr, monitors=(), stats=None, mux=None, retrier=None):
+    """
+    Run tasks in parallel with the engine in the setting.
+    Each worker takes the next task as soon as it finishes the previous one.
+
+    :param monitors: objects which filter tasks before they start and record the return code of each task
+                     (CircuitBreaker, RateLimiter, Progress)
+    :param stats: Stats or Journal instance to collect the statistics of each task, or None
+    :param mux: Multiplexer instance to write the output through, or None
+    :param retrier: Retrier instance to reschedule failed connections, or None
+    :return: list of return codes
+    """
+    # tasks may be a lazy iterator, whose length is unknown until all hosts arrive
+    n = min(len(tasks), setting.parallelism) if isinstance(tasks, list) else setting.parallelism
+    callback = None
+    filters = list(monitors)
+    if setting.close_connections:
+        filters.append(setting.started_hosts)
+    if retrier is not None:
+        # retries go through the rate limiter as well, but the other monitors see each task once
+        limiters = [m for m in filters if isinstance(m, RateLimiter)]
+        filters = [m for m in filters if m not in limiters] + [retrier] + limiters
+    for m in filters:
+        tasks = m.filter(tasks)
+    if monitors:
+
+        def callback(r):
+            for m in monitors:
+                m.record(r)
+
+    if setting.engine == 'async':
+        from color_ssh.async_engine import run_tasks
+
+        return run_tasks(tasks, setting.parallelism, stdout, stderr, callback, setting.timeout,
+                         setting.setup_timeout, stats, setting.output, retrier, setting.stdin_address, mux)
+
+    kwargs = {'timeout': setting.timeout, 'setup_timeout': setting.setup_timeout, 'output': setting.output,
+              'stdin_address': setting.stdin_address}
+    func = functools.partial(run_task, **kwargs)
+    if retrier is not None:
+        # the retrier yields (task, queue time, number of retries)
+        func = functools.partial(run_attempt, **kwargs)
+    elif stats is not None:
+        # the queue time starts when the task is taken from the iterator
+        tasks = ((task, time.time()) for task in tasks)
+        func = functools.partial(run_task_with_stats, **kwargs)
+
+    ret = []
+
+    def handle(r):
+        if retrier is not None:
+            item, r, record = r
+            if retrier.retry(item, r, record):
+                return
+        elif stats is not None:
+            r, record = r
+        if stats is not None:
+            stats.add(record)
+        ret.append(r)
+        if callback:
+            callback(r)
+
+    if n <= 1:
+        source = None if mux is None else mux.source()
+        if source is not None:
+            set_streams(*source.streams())
+        try:
+            for task in tasks:
+                handle(func(task))
+            return ret
+        finally:
+            if source is not None:
+                set_streams(None)
+                source.close()
+
+    # keep the number of tasks in flight bounded
+    semaphore = threading.Semaphore(n * 2)
+
+    interrupted = threading.Event()
+
+    def feed():
+        # take the next task after a slot is available, so that the breaker sees the latest results
+        it = iter(tasks)
+        while True:
+            semaphore.acquire()
+            if interrupted.is_set():
+                return
+            try:
+                yield next(it)
+            except StopIteration:
+                return
+
+    if mux is None:
+        pool = Pool(n, init_pool_worker, (set_lock, (get_lock(),)))
+    else:
+        # each worker process sends its output through its own pipe, so that a noisy host blocks only its worker
+        pipes = [multiprocessing.Pipe(duplex=False) for _ in range(n)]
+        indexes = multiprocessing.Queue()
+        for i in range(n):
+            indexes.put(i)
+        pool = Pool(n, init_pool_worker, (init_worker, (get_lock(), [w for _, w in pipes], indexes)))
+        readers = [mux.add_connection(r) for r, _ in pipes]
+        for _, w in pipes:
+            w.close()
+
+    try:
+        for r in pool.imap_unordered(functools.partial(run_interruptible, func), feed()):
+            semaphore.release()
+            handle(r)
         return ret
+    except KeyboardInterrupt:
+        # let the workers kill the commands of the running tasks and skip the rest; terminating the pool instead
+        # hangs if a worker dies holding the lock of the result queue
+        interrupted.set()
+        semaphore.release()
+        if retrier is not None:
+            retrier.close()
+        for p in multiprocessing.active_children():
+            os.kill(p.pid, signal.SIGINT)
+        pool.close()
+        pool.join()
+        raise
+    except BaseException:
+        if retrier is not None:
+            retrier.close()
+        if mux is not None:
+            # do not wait for the remaining tasks before joining the workers
+            pool.terminate()
+        raise
+    finally:
+        pool.close()
+        if mux is not None:
+            # the pipes are closed when the worker processes exit
+            pool.join()
+            for t in readers:
+                t.join()
 
-    return f()
+
+def run_waves(setting, stdout, stderr, stats=None, mux=None, limiter=None, retrier=None, broadcaster=None):
+    """
+    Run the tasks in waves of setting.batch_size (or all at once), and stop when too many tasks failed.
+
+    :param stats: Stats or Journal instance to collect the statistics of each task, or None
+    :param mux: Multiplexer instance to write the output through, or None
+    :param limiter: RateLimiter instance, or None
+    :param retrier: Retrier instance, or None
+    :param broadcaster: Broadcaster instance to tell when each task finishes, or None
+    :return: list of return codes
+    """
+    breaker = CircuitBreaker(setting.max_fail)
+    monitors = [breaker]
+    if limiter is not None:
+        monitors.append(limiter)
+    if broadcaster is not None:
+        monitors.append(broadcaster)
+    if setting.progress:
+        monitors.append(Progress(stderr, len(setting.tasks) if isinstance(setting.tasks, list) else None))
+
+    ret = []
+    if setting.batch_size is None:
+        ret.extend(dispatch(setting.tasks, setting, stdout, stderr, monitors, stats, mux, retrier))
+    else:
+        for wave in split_every(setting.batch_size, setting.tasks):
+            if breaker.is_open():
+                breaker.skipped += len(wave)
+            else:
+                ret.extend(dispatch(wave, setting, stdout, stderr, monitors, stats, mux, retrier))
+
+    breaker.report(stderr)
+    return ret
+
+
+def run_upload_tree(setting, stdout, stderr, monitors=(), mux=None):
+    """
+    Run the stages of the upload tree. The children of a host which failed to receive the files get them from
+    local instead, and each host which failed uploads the files from local again as a setup command of its own
+    task, so that no host runs the command without the files.
+
+    :param monitors: objects which filter tasks before they start (RateLimiter)
+    :param mux: Multiplexer instance to write the output through, or None
+    :return: set of the addresses of the hosts which failed to receive the files
+    """
+    # the uploads are limited by the timeout of the setup commands, as the uploads of each host are
+    stage_setting = copy.copy(setting)
+    stage_setting.timeout = setting.setup_timeout
+    failed = set()
+    for stage in setting.upload_stages:
+        tasks = []
+        for task in stage:
+            parent, direct = setting.upload_tree[task.address]
+            if parent in failed:
+                task = Task(task[0], direct[-1], direct[:-1], task.host, task.address)
+            tasks.append(task)
+        addresses = dict((tuple(task[1]), task.address) for task in tasks)
+        results = Stats()
+        dispatch(tasks, stage_setting, stdout, stderr, monitors, results, mux)
+        failed.update(addresses[tuple(r['command'])] for r in results.records if r['ret'] != 0)
+
+    def upload_directly(task):
+        if task.address not in failed:
+            return task
+        return Task(task[0], task[1], setting.upload_tree[task.address][1] + list(task[2]), task.host, task.address,
+                    task.remote_command)
+
+    if failed:
+        if setting.work_queue is not None:
+            hosts, batches, build_task = setting.work_queue
+            setting.work_queue = hosts, batches, lambda host, batch: upload_directly(build_task(host, batch))
+        else:
+            setting.tasks = [upload_directly(task) for task in setting.tasks]
+    return failed
 
 
-def main(argv=sys.argv, stdout=io2bytes(sys.stdout), stderr=io2bytes(sys.stderr)):
+def main(argv=sys.argv, stdin=io2bytes(sys.stdin), stdout=io2bytes(sys.stdout), stderr=io2bytes(sys.stderr)):
     """
     Main function
     """
 
     @exception_handler(lambda e: stderr.write(('%s: %s\n' % (e.__class__.__name__, e)).encode('utf-8', 'ignore')))
     def f():
-        setting = Setting().parse_args(argv, stdout)
-        n = min(len(setting.tasks), setting.parallelism)
-        if n <= 1:
-            ret = map(run_task, setting.tasks)
-        else:
-            pool = Pool(n)
-            ret = pool.map(run_task, setting.tasks)
-        return max(ret)
+        setting = Setting().parse_args(argv, stdout, stdin)
+        stats = Stats() if setting.stats or setting.stats_json else None
+        journal = None
+        if setting.journal:
+            # the journal receives the record of each host in place of the stats, and passes it on
+            journal = Journal(setting.journal, setting.only_failed, stats)
+            if setting.work_queue is not None:
+                hosts, batches, build_task = setting.work_queue
+                setting.work_queue = hosts, journal.filter_batches(batches), build_task
+            else:
+                tasks = journal.filter(setting.tasks)
+                setting.tasks = list(tasks) if isinstance(setting.tasks, list) else tasks
+            journal.open()
+        recorder = stats if journal is None else journal
+        setting.output.start()
+
+        # blocks of the grouped format are kept contiguous by the output lock instead
+        mux = None
+        if setting.flush_interval > 0 and setting.output.output_format != 'grouped':
+            mux = Multiplexer(stdout, stderr, setting.flush_interval)
+            mux.start()
+            setting.output.buffered = True
+        limiter = None
+        if setting.connect_rate is not None:
+            limiter = RateLimiter(setting.connect_rate, setting.connect_burst)
+        retrier = None
+        if setting.retries > 0:
+            retrier = Retrier(setting.retries, setting.retry_backoff, stderr)
+        # detach stdin first so that the upload commands do not read it
+        broadcast_stdin = detach_stdin(stdin) if setting.stdin_broadcast else None
+        broadcaster = None
+        try:
+            ret = []
+            try:
+                if setting.upload_stages:
+                    run_upload_tree(setting, stdout, stderr, [limiter] if limiter else (), mux)
+                if broadcast_stdin is not None:
+                    # hosts starting late read the beginning of stdin from the spool
+                    if setting.stdin_spool is None and starts_at_once(setting):
+                        broadcaster = Broadcaster(broadcast_stdin, expected=len(setting.tasks))
+                    else:
+                        spool_dir = setting.stdin_spool or tempfile.gettempdir()
+                        broadcaster = Broadcaster(broadcast_stdin, spool_dir=spool_dir)
+                    setting.stdin_address = broadcaster.start()
+                if setting.work_queue is not None:
+                    ret.extend(run_work_queue(setting.work_queue, setting.parallelism, setting.timeout,
+                                              setting.setup_timeout, recorder, setting.output, mux, limiter,
+                                              retrier, setting.stdin_address, setting.max_fail, setting.progress,
+                                              stderr, setting.started_hosts))
+                else:
+                    ret.extend(run_waves(setting, stdout, stderr, recorder, mux, limiter, retrier, broadcaster))
+            finally:
+                if journal is not None:
+                    journal.close()
+                if setting.stdin_address is not None:
+                    broadcaster.stop()
+                    setting.stdin_address = None
+                if mux is not None:
+                    mux.stop()
+                setting.output.finish(stdout, stderr)
+
+            if retrier is not None:
+                retrier.report()
+            if journal is not None:
+                journal.report(stderr)
+            if setting.stats:
+                stats.report(stderr)
+            if setting.stats_json:
+                stats.dump(setting.stats_json)
+            # every host may have been skipped by the journal
+            return max(ret) if ret else 0
+        finally:
+            # only the hosts which started may have master connections
+            addresses = setting.started_hosts.addresses
+            run_cleanup([cmd for address, cmd in setting.cleanup_commands.items() if address in addresses],
+                        setting.parallelism)
 
     return f()
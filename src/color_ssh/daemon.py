@@ -0,0 +1,422 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import sys
+import os
+import json
+import errno
+import select
+import time
+import signal
+import socket
+
+__all__ = []
+
+DEFAULT_SOCKET = '~/.ssh/color-sshd.sock'
+SOCKET_ENV = 'COLOR_SSHD_SOCKET'
+DEFAULT_CONTROL_PERSIST = '10m'
+DEFAULT_MAX_JOBS = 64
+POLL_INTERVAL = 0.1
+MAX_REQUEST_SIZE = 1 << 20
+REQUEST_TIMEOUT = 10.0
+STDIO_FDS = [0, 1, 2]
+
+
+def socket_path(path=None):
+    """
+    :param path: path given by the user, or None for $COLOR_SSHD_SOCKET or the default
+    :return: absolute path of the daemon socket
+    """
+    return os.path.abspath(os.path.expanduser(path or os.environ.get(SOCKET_ENV) or DEFAULT_SOCKET))
+
+
+def _send_fds(sock, data, fds):
+    import array
+
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array(str('i'), fds))])
+
+
+def _recv_chunk(conn):
+    """
+    :return: tuple of (data, list of file descriptors passed with the data)
+    """
+    import array
+
+    fds = array.array(str('i'))
+    msg, ancdata, _, _ = conn.recvmsg(MAX_REQUEST_SIZE, socket.CMSG_LEN(len(STDIO_FDS) * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return msg, list(fds)
+
+
+#
+# Client
+#
+def submit(argv, path=None, fds=STDIO_FDS):
+    """
+    Run color-ssh in the daemon with the stdin, stdout and stderr of this process.
+
+    :param argv: color-ssh arguments without the program name
+    :param path: path to the daemon socket
+    :param fds: file descriptors passed as stdin, stdout and stderr
+    :return: exit code
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path(path))
+        request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+        _send_fds(sock, json.dumps(request).encode('utf-8') + b'\n', fds)
+
+        # the output goes to the passed file descriptors directly, only the exit code comes back
+        data = b''
+        while True:
+            chunk = sock.recv(64)
+            if not chunk:
+                break
+            data += chunk
+        return int(data) if data.strip() else 1
+    finally:
+        sock.close()
+
+
+def submit_main(argv=sys.argv):
+    """
+    Main function of color-ssh-submit. Imports as few modules as possible to start quickly.
+    """
+    if len(argv) > 2 and argv[1] == '--socket':
+        path, args = argv[2], argv[3:]
+    else:
+        path, args = None, argv[1:]
+
+    try:
+        return submit(args, path)
+    except KeyboardInterrupt:
+        # the daemon kills the job when the connection is closed
+        return 130
+    except socket.error as e:
+        sys.stderr.write('color-ssh-submit: cannot connect to color-sshd at %s: %s\n' % (socket_path(path), e))
+        return 1
+
+
+#
+# Server
+#
+class Daemon(object):
+    """
+    Run color-ssh jobs submitted through a Unix socket.
+
+    Each job runs in a process forked from the daemon, which has already imported everything, with the stdin,
+    stdout and stderr of the client. Jobs share ssh master connections kept alive by ControlPersist, so
+    they skip both the Python startup and the ssh handshakes.
+    """
+
+    def __init__(self, path, control_persist=DEFAULT_CONTROL_PERSIST, max_jobs=DEFAULT_MAX_JOBS, stderr=None):
+        """
+        :param path: path to the socket
+        :param control_persist: time to keep the master connections after each job (ssh ControlPersist)
+        :param max_jobs: max number of jobs running at the same time, others wait in the socket backlog
+        :param stderr: binary-data output of the daemon log
+        """
+        self.path = path
+        self.control_persist = control_persist
+        self.max_jobs = max_jobs
+        self.stderr = stderr
+        self.listener = None
+        self.wakeup = None  # pipe written on SIGCHLD
+        self.jobs = {}  # pid -> client connection
+        self.requests = {}  # client connection whose request is incomplete -> (time accepted, chunks, fds)
+        self.stopped = False
+
+    def job_args(self, argv):
+        """
+        :return: color-ssh arguments for the job, reusing the master connections
+        """
+        return ['color-ssh', '--multiplex', '--control-persist', self.control_persist] + list(argv)
+
+    def start(self):
+        if os.path.exists(self.path):
+            # remove a stale socket, but do not steal the socket of a running daemon
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise RuntimeError('color-sshd is already running: %s' % self.path)
+            except socket.error:
+                os.remove(self.path)
+            finally:
+                probe.close()
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.listener.listen(128)
+
+        # wake up the select loop as soon as a job exits
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1])
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    def serve_forever(self):
+        try:
+            while not self.stopped:
+                self.serve_once(POLL_INTERVAL)
+        finally:
+            self.close()
+
+    def serve_once(self, timeout):
+        """
+        Accept a job if any, and reap the finished jobs. Runs in a single thread so that forking is safe.
+        Requests are read as they arrive, so that a slow client never blocks the others.
+        """
+        readers = list(self.jobs.values()) + list(self.requests) + [self.wakeup[0]]
+        if len(self.jobs) < self.max_jobs:
+            readers.append(self.listener)
+        try:
+            readable, _, _ = select.select(readers, [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        for r in readable:
+            if r is self.listener:
+                self._accept()
+            elif r is self.wakeup[0]:
+                try:
+                    os.read(r, 4096)
+                except OSError:
+                    pass
+            elif r in self.requests:
+                self._read_request(r)
+            else:
+                # the client never sends anything after the request, so this is a disconnection
+                pid = [k for k, v in self.jobs.items() if v is r][0]
+                self._kill(pid)
+
+        now = time.time()
+        for conn, (accepted, _, _) in list(self.requests.items()):
+            if now - accepted > REQUEST_TIMEOUT:
+                self._drop_request(conn, 'request timed out')
+        self._reap()
+
+    def close(self):
+        for conn in list(self.requests):
+            self._drop_request(conn)
+        for pid in list(self.jobs):
+            self._kill(pid)
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        if self.wakeup is not None:
+            signal.set_wakeup_fd(-1)
+            for fd in self.wakeup:
+                os.close(fd)
+            self.wakeup = None
+
+    def _log(self, msg):
+        if self.stderr is not None:
+            self.stderr.write(('color-sshd: %s\n' % msg).encode('utf-8', 'ignore'))
+            self.stderr.flush()
+
+    def _accept(self):
+        conn, _ = self.listener.accept()
+        self.requests[conn] = (time.time(), [], [])
+
+    def _read_request(self, conn):
+        """
+        Read the next part of a request, and start the job when the request is complete.
+        """
+        _, chunks, fds = self.requests[conn]
+        try:
+            data, received = _recv_chunk(conn)
+        except socket.error as e:
+            self._drop_request(conn, 'bad request: %s' % e)
+            return
+        chunks.append(data)
+        fds.extend(received)
+        if data and not data.endswith(b'\n'):
+            if sum(len(x) for x in chunks) > MAX_REQUEST_SIZE:
+                self._drop_request(conn, 'bad request: too large')
+            return
+
+        try:
+            request = json.loads(b''.join(chunks).decode('utf-8'))
+        except ValueError as e:
+            self._drop_request(conn, 'bad request: %s' % e)
+            return
+        if len(fds) != len(STDIO_FDS):
+            self._drop_request(conn, 'bad request: %d file descriptors' % len(fds))
+            return
+        del self.requests[conn]
+        self._start_job(request, fds, conn)
+
+    def _drop_request(self, conn, msg=None):
+        _, _, fds = self.requests.pop(conn)
+        if msg is not None:
+            self._log(msg)
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+
+    def _start_job(self, request, fds, conn):
+        for f in [sys.stdout, sys.stderr]:
+            f.flush()
+        pid = os.fork()
+        if pid == 0:
+            os._exit(self._run_job(request, fds, conn))
+
+        try:
+            # also set in the parent so that _kill() never misses a job that has just started
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        for fd in fds:
+            os.close(fd)
+        self.jobs[pid] = conn
+
+    def _run_job(self, request, fds, conn):
+        """
+        Run a job in the forked process.
+
+        :return: exit code
+        """
+        try:
+            from color_ssh import color_ssh
+            from color_ssh.util.util import io2bytes
+
+            # own process group, killed as a whole when the client disconnects
+            os.setpgid(0, 0)
+            signal.set_wakeup_fd(-1)
+            for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGCHLD]:
+                signal.signal(sig, signal.SIG_DFL)
+            self.listener.close()
+            for fd in self.wakeup:
+                os.close(fd)
+            for c in self.jobs.values():
+                c.close()
+            for c, (_, _, xs) in self.requests.items():
+                c.close()
+                for fd in xs:
+                    os.close(fd)
+            conn.close()
+
+            for fd, target in zip(fds, STDIO_FDS):
+                os.dup2(fd, target)
+                os.close(fd)
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+
+            ret = color_ssh.main(self.job_args(request['argv']), stdin=io2bytes(sys.stdin),
+                                 stdout=io2bytes(sys.stdout), stderr=io2bytes(sys.stderr))
+            for f in [sys.stdout, sys.stderr]:
+                f.flush()
+            return ret
+        except SystemExit as e:
+            # option errors from color-ssh
+            return e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            try:
+                os.write(2, ('color-sshd: %s: %s\n' % (e.__class__.__name__, e)).encode('utf-8', 'ignore'))
+            finally:
+                return 1
+
+    def _kill(self, pid):
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _reap(self):
+        while self.jobs:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            conn = self.jobs.pop(pid, None)
+            if conn is None:
+                continue
+            ret = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+            try:
+                conn.sendall(('%d\n' % ret).encode('ascii'))
+            except socket.error:
+                pass
+            conn.close()
+
+
+def warm(daemon, host_file):
+    """
+    Open the master connections to the hosts in advance. Runs in a child process like the jobs, so that the
+    daemon itself never has threads or worker pools when it forks.
+
+    :return: exit code
+    """
+    from color_ssh import color_ssh
+
+    pid = os.fork()
+    if pid == 0:
+        os._exit(color_ssh.main(daemon.job_args(['-h', host_file, 'true'])))
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+
+
+def main(argv=sys.argv, stderr=None):
+    """
+    Main function of color-sshd
+    """
+    from optparse import OptionParser
+    from color_ssh.util.util import io2bytes, exception_handler
+
+    stderr = stderr or io2bytes(sys.stderr)
+    parser = OptionParser(usage='%prog [options...]')
+    parser.add_option(
+        '--socket', dest='socket', default=None, type='string', metavar='PATH',
+        help='path to the socket (default: $%s or %s)' % (SOCKET_ENV, DEFAULT_SOCKET)
+    )
+    parser.add_option(
+        '--control-persist', dest='control_persist', default=DEFAULT_CONTROL_PERSIST, type='string', metavar='TIME',
+        help='keep the master connection to each host for TIME after its last job (default: %s)' %
+             DEFAULT_CONTROL_PERSIST
+    )
+    parser.add_option(
+        '--max-jobs', dest='max_jobs', default=DEFAULT_MAX_JOBS, type='int', metavar='NUM',
+        help='max number of jobs running at the same time (default: %d)' % DEFAULT_MAX_JOBS
+    )
+    parser.add_option(
+        '--warm', dest='warm', default=None, type='string', metavar='HOST_FILE',
+        help='open the master connections to the hosts in HOST_FILE at startup'
+    )
+    option, _ = parser.parse_args(argv[1:])
+
+    @exception_handler(lambda e: stderr.write(('%s: %s\n' % (e.__class__.__name__, e)).encode('utf-8', 'ignore')))
+    def f():
+        if not hasattr(socket.socket, 'sendmsg'):
+            raise RuntimeError('color-sshd requires Python 3.3 or later')
+
+        # import everything the jobs need once
+        from color_ssh import color_ssh, async_engine  # noqa
+
+        daemon = Daemon(socket_path(option.socket), option.control_persist, option.max_jobs, stderr)
+
+        def stop(signum, frame):
+            daemon.stopped = True
+
+        # before the socket appears, so that SIGTERM always removes it
+        signal.signal(signal.SIGTERM, stop)
+        daemon.start()
+        if option.warm and warm(daemon, option.warm) != 0:
+            daemon._log('failed to connect to some hosts in %s' % option.warm)
+        daemon.serve_forever()
+        return 0
+
+    return f()
@@ -0,0 +1,357 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import re
+import hashlib
+import marshal
+import itertools
+import tempfile
+import time
+import collections
+from color_ssh.util.util import PY3
+
+__all__ = []
+
+CACHE_VERSION = 1
+CACHE_DIR_ENV = 'COLOR_SSH_CACHE_DIR'
+CACHE_MIN_HOSTS = 1000  # smaller inventories are parsed faster than loaded from the cache
+RACY_SECONDS = 2  # files modified more recently may change again without changing the modification time
+
+_HOST_PATTERN = re.compile(r'^(?:([^:@]+)@)?([^:@]+)(?::(\d+))?$')
+_GROUP_PATTERN = re.compile(r'^\[([A-Za-z_][\w.-]*)\]$')
+
+
+def parse_host(s):
+    """
+    :param s: string : [user@]host[:port]
+    :return: list of [user, host, port]
+    """
+    ret = _HOST_PATTERN.match(s)
+    if not ret:
+        raise ValueError('Illegal format: %s' % s)
+    return [None if x is None else str(x) for x in ret.groups()]
+
+
+def expand_host(s):
+    """
+    Expand pdsh-style ranges and brace alternatives in a host entry.
+
+    e.g. "web[01-03,10]" -> web01, web02, web03, web10
+         "db{a,b}[1-2]" -> dba1, dba2, dbb1, dbb2
+
+    :param s: host entry string
+    :return: iterator of host strings
+    """
+    if '[' not in s and '{' not in s:
+        return iter([s])
+    return (''.join(xs) for xs in itertools.product(*_split_pattern(s)))
+
+
+def expand_hosts(entries):
+    """
+    :param entries: iterable of host entry strings
+    :return: generator of parsed hosts [user, host, port]
+    """
+    for entry in entries:
+        for h in expand_host(entry):
+            yield parse_host(h)
+
+
+def _split_pattern(s):
+    """
+    :return: list of the choices for each part of the pattern
+    """
+    parts = []
+    i = 0
+    while i < len(s):
+        if s[i] == '[':
+            j = s.find(']', i)
+            if j < 0:
+                raise ValueError('Illegal format: %s' % s)
+            parts.append(_expand_ranges(s[i + 1:j], s))
+            i = j + 1
+        elif s[i] == '{':
+            j = _find_closing_brace(s, i)
+            parts.append([h for alt in _split_top_level(s[i + 1:j]) for h in expand_host(alt)])
+            i = j + 1
+        elif s[i] in ']}':
+            raise ValueError('Illegal format: %s' % s)
+        else:
+            j = i
+            while j < len(s) and s[j] not in '[]{}':
+                j += 1
+            parts.append([s[i:j]])
+            i = j
+    return parts
+
+
+def _expand_ranges(body, s):
+    """
+    :param body: comma-separated numbers and ranges (e.g. "001-120,130"),
+                 zero-padded to the width of the start if it has leading zeros
+    """
+    ret = []
+    for item in body.split(','):
+        m = re.match(r'^(\d+)(?:-(\d+))?$', item)
+        if not m or (m.group(2) is not None and int(m.group(2)) < int(m.group(1))):
+            raise ValueError('Illegal range: %s' % s)
+        start, end = m.group(1), m.group(2) or m.group(1)
+        width = len(start) if start.startswith('0') else 0
+        ret.extend('%0*d' % (width, n) for n in range(int(start), int(end) + 1))
+    return ret
+
+
+def _find_closing_brace(s, i):
+    depth = 0
+    for j in range(i, len(s)):
+        if s[j] == '{':
+            depth += 1
+        elif s[j] == '}':
+            depth -= 1
+            if depth == 0:
+                return j
+    raise ValueError('Illegal format: %s' % s)
+
+
+def _split_top_level(s):
+    """
+    Split a brace body by the commas outside of nested braces and brackets.
+    """
+    ret = ['']
+    depth = 0
+    for c in s:
+        if c == ',' and depth == 0:
+            ret.append('')
+            continue
+        depth += {'{': 1, '[': 1, '}': -1, ']': -1}.get(c, 0)
+        ret[-1] += c
+    return ret
+
+
+def _scan(lines):
+    """
+    Read the lines of a host file: host entries, "[group]" headers, "@group" references and "#" comments.
+
+    :return: generator of (group name or None, host entry or "@group")
+    """
+    group = None
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        m = _GROUP_PATTERN.match(line)
+        if m:
+            group = m.group(1)
+            yield group, None
+        elif line.startswith('@') and group is None:
+            raise ValueError('Group reference outside of a group: %s' % line)
+        else:
+            yield group, str(line)
+
+
+def iter_hosts(lines):
+    """
+    Parse a host file lazily, ignoring the groups.
+
+    :return: generator of parsed hosts [user, host, port]
+    """
+    return expand_hosts(entry for _, entry in _scan(lines) if entry is not None and not entry.startswith('@'))
+
+
+class Inventory(object):
+    """
+    Parsed host file with its named groups.
+
+    A host file lists one entry per line, which may contain ranges. Lines after a "[name]" header belong to
+    the group, which may also include other groups by "@name".
+
+        web[001-500]
+        [db]
+        db{a,b}[1-3]
+        [all-prod]
+        @db
+        prod-web[01-10]
+    """
+
+    def __init__(self, hosts, groups):
+        """
+        :param hosts: list of parsed hosts [user, host, port] in the order of the file
+        :param groups: dict of group name -> list of indices of hosts
+        """
+        self.hosts = hosts
+        self.groups = groups
+
+    @classmethod
+    def compile(cls, lines):
+        hosts = []
+        members = collections.OrderedDict()  # group name -> list of host indices or group names
+        for group, entry in _scan(lines):
+            if entry is None:
+                members.setdefault(group, [])
+            elif entry.startswith('@'):
+                members[group].append(entry[1:])
+            else:
+                for h in expand_host(entry):
+                    if group is not None:
+                        members[group].append(len(hosts))
+                    hosts.append(parse_host(h))
+
+        groups = {}
+
+        def resolve(name, path):
+            if name not in members:
+                raise ValueError('Unknown group: %s' % name)
+            if name in path:
+                raise ValueError('Circular group reference: %s' % ' -> '.join(path + [name]))
+            if name not in groups:
+                ret = []
+                for x in members[name]:
+                    ret.extend([x] if isinstance(x, int) else resolve(x, path + [name]))
+                groups[name] = _unique(ret)
+            return groups[name]
+
+        for name in members:
+            resolve(name, [])
+        return cls(hosts, groups)
+
+    def select(self, names=None):
+        """
+        :param names: list of group names, or None for all the hosts
+        :return: list of parsed hosts [user, host, port]
+        """
+        if names is None:
+            return self.hosts
+
+        unknown = [name for name in names if name not in self.groups]
+        if unknown:
+            raise ValueError('Unknown group: %s' % ', '.join(unknown))
+        return [self.hosts[i] for i in _unique(i for name in names for i in self.groups[name])]
+
+    def dump(self, path, key):
+        """
+        Save the compiled inventory atomically.
+
+        Hosts are stored in columns: the host names in one string, and the users and ports only where given.
+        Groups are stored as ranges of indices, as they are mostly contiguous in the file.
+
+        :param key: identity of the source file from file_key()
+        """
+        names = '\n'.join(h for _, h, _ in self.hosts)
+        users = dict((i, u) for i, (u, _, _) in enumerate(self.hosts) if u is not None)
+        ports = dict((i, p) for i, (_, _, p) in enumerate(self.hosts) if p is not None)
+        groups = dict((name, _to_ranges(xs)) for name, xs in self.groups.items())
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with io.open(fd, 'wb') as f:
+                f.write(marshal.dumps((CACHE_VERSION, key, names, users, ports, groups)))
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, key):
+        """
+        :return: Inventory instance, or None if the cache is missing, broken or stale
+        """
+        try:
+            # marshal.loads() is much faster than marshal.load() on a file
+            with io.open(path, 'rb') as f:
+                data = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        # a truncated or corrupt file may still be valid marshal data of another shape
+        try:
+            version, cached_key, names, users, ports, groups = data
+            if version != CACHE_VERSION or cached_key != key:
+                return None
+
+            hosts = [[None, str(h), None] for h in names.split('\n')] if names else []
+            for i, u in users.items():
+                hosts[i][0] = u
+            for i, p in ports.items():
+                hosts[i][2] = p
+            return cls(hosts, dict((name, _from_ranges(r)) for name, r in groups.items()))
+        except (AttributeError, IndexError, TypeError, ValueError):
+            return None
+
+
+def _to_ranges(xs):
+    """
+    :param xs: list of integers
+    :return: flat list of [start, stop, start, stop, ...] of the runs of consecutive integers
+    """
+    ret = []
+    for x in xs:
+        if ret and ret[-1] == x:
+            ret[-1] = x + 1
+        else:
+            ret.extend([x, x + 1])
+    return ret
+
+
+def _from_ranges(ranges):
+    ret = []
+    for i in range(0, len(ranges), 2):
+        ret.extend(range(ranges[i], ranges[i + 1]))
+    return ret
+
+
+def _unique(xs):
+    seen = set()
+    return [x for x in xs if not (x in seen or seen.add(x))]
+
+
+def file_key(path):
+    """
+    :return: identity of the file contents: (size, mtime in nanoseconds, inode)
+    """
+    st = os.stat(path)
+    return st.st_size, getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)), st.st_ino
+
+
+def default_cache_dir():
+    xdg = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(xdg, 'color-ssh')
+
+
+def cache_path(cache_dir, path):
+    """
+    :return: path to the compiled inventory of the host file
+    """
+    name = os.path.abspath(path)
+    digest = hashlib.sha1(name.encode('utf-8', 'surrogateescape') if PY3 else name).hexdigest()
+    return os.path.join(cache_dir, 'inventory-%s' % digest)
+
+
+def load_inventory(path, cache_dir=None):
+    """
+    Load a host file, using the compiled inventory in cache_dir if the file has not changed.
+
+    :param path: path to the host file
+    :param cache_dir: directory of the compiled inventories, or None to disable caching
+    :return: Inventory instance
+    """
+    if cache_dir is None:
+        with io.open(path) as f:
+            return Inventory.compile(f)
+
+    key = file_key(path)
+    cached = cache_path(cache_dir, path)
+    ret = Inventory.load(cached, key)
+    if ret is None:
+        with io.open(path) as f:
+            ret = Inventory.compile(f)
+        # the file may have been modified while reading
+        settled = time.time() - key[1] / 1e9 > RACY_SECONDS and file_key(path) == key
+        if len(ret.hosts) >= CACHE_MIN_HOSTS and settled:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir, 0o700)
+                ret.dump(cached, key)
+            except (IOError, OSError):
+                pass  # the cache is optional
+    return ret
@@ -0,0 +1,190 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import json
+import time
+import threading
+
+__all__ = []
+
+FLUSH_RECORDS = 64
+FLUSH_INTERVAL = 1.0
+
+
+class Journal(object):
+    """
+    Append-only file of the result of each host, to skip the hosts which already succeeded when resuming.
+
+    Each line is a JSON object: {"target", "label", "ret", "ts"}, where target is [user, host, port, remote command]
+    so that the ssh options may change when resuming, with "batch" instead of "target" for the batches of
+    --distribute-by dynamic, which may run on any host. Lines are written in batches, each of which is fsynced
+    by flush_records records or flush_interval seconds, so a crash loses at most the last batch and those hosts
+    simply run again.
+
+    Journal takes the place of Stats for the engines, and passes the records on to the Stats if any.
+    """
+
+    def __init__(self, path, only_failed=False, stats=None, flush_records=FLUSH_RECORDS,
+                 flush_interval=FLUSH_INTERVAL, clock=time.time):
+        """
+        :param path: path to the journal file, created if it does not exist
+        :param only_failed: run only the hosts which failed, instead of all the hosts which have not succeeded
+        :param stats: Stats instance to collect the records as well, or None
+        :param flush_records: max number of records written in one batch
+        :param flush_interval: max seconds between the first record in a batch and its fsync
+        """
+        self.path = path
+        self.only_failed = only_failed
+        self.stats = stats
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.results = self.load(path)
+        self.skipped = 0
+        self.pending = []
+        self.pending_since = None
+        self.condition = threading.Condition()
+        self.fd = None
+        self.thread = None
+        self.closed = False
+
+    @staticmethod
+    def key(record):
+        if 'batch' in record:
+            return 'batch', tuple(record['batch'])
+        if record.get('target'):
+            user, host, port, command = record['target']
+            return 'target', user, host, port, tuple(command)
+        # tasks whose host is unknown
+        return 'command', tuple(record['command'])
+
+    @classmethod
+    def task_key(cls, task):
+        return cls.key({'target': getattr(task, 'target', None), 'command': task[1]})
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: dict of key -> the last return code
+        """
+        ret = {}
+        if not os.path.exists(path):
+            return ret
+        with io.open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                    ret[cls.key(record)] = record['ret']
+                except (ValueError, KeyError, TypeError):
+                    pass  # a line torn by a crash
+        return ret
+
+    def should_run(self, key):
+        r = self.results.get(key)
+        if self.only_failed:
+            return r not in (0, None)
+        return r != 0
+
+    def filter(self, tasks):
+        """
+        :return: generator of the tasks to run
+        """
+        for task in tasks:
+            if self.should_run(self.task_key(task)):
+                yield task
+            else:
+                self.skipped += 1
+
+    def filter_batches(self, batches):
+        """
+        :return: list of the batches of the work queue to run
+        """
+        ret = [batch for batch in batches if self.should_run(('batch', tuple(batch)))]
+        self.skipped += len(batches) - len(ret)
+        return ret
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            # make the new file itself durable
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        else:
+            with io.open(self.path, 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    # terminate a line torn by a crash
+                    os.write(self.fd, b'\n')
+
+        # flush the records in time even while no other host finishes
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, record):
+        """
+        Called when a task finishes. Same interface as Stats.
+        """
+        d = {'label': record['label'], 'ret': record['ret'], 'ts': self.clock()}
+        if 'batch' in record:
+            d['batch'] = record['batch']
+        elif record.get('target'):
+            d['target'] = record['target']
+        else:
+            d['command'] = record['command']
+        line = json.dumps(d, sort_keys=True).encode('utf-8') + b'\n'
+
+        with self.condition:
+            if self.stats is not None:
+                self.stats.add(record)
+            self.pending.append(line)
+            if self.pending_since is None:
+                self.pending_since = self.clock()
+                self.condition.notify_all()
+            if len(self.pending) >= self.flush_records or self.clock() - self.pending_since >= self.flush_interval:
+                self._flush()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.condition:
+            self._flush()
+        os.close(self.fd)
+        self.fd = None
+
+    def report(self, stderr):
+        if self.skipped:
+            what = 'not failed' if self.only_failed else 'already succeeded'
+            msg = 'color-ssh: skipped %d hosts %s in %s\n' % (self.skipped, what, self.path)
+            stderr.write(msg.encode('utf-8', 'ignore'))
+            stderr.flush()
+
+    def _run(self):
+        with self.condition:
+            while not self.closed:
+                if self.pending_since is None:
+                    self.condition.wait()
+                    continue
+                wait = self.pending_since + self.flush_interval - self.clock()
+                if wait > 0:
+                    self.condition.wait(wait)
+                else:
+                    self._flush()
+
+    def _flush(self):
+        if self.pending:
+            data = b''.join(self.pending)
+            while data:
+                data = data[os.write(self.fd, data):]
+            os.fsync(self.fd)
+        self.pending = []
+        self.pending_since = None
@@ -0,0 +1,251 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import sys
+import threading
+from color_ssh.util.util import io2bytes
+
+__all__ = []
+
+STREAMS = ['stdout', 'stderr']
+FLUSH_INTERVAL = 0.05
+BATCH_SIZE = 1 << 16  # write out early when this many bytes are pending
+SOURCE_LIMIT = 1 << 18  # writers of a source block while this many bytes of the source are pending
+
+# binary-data outputs of the tasks running in the current thread
+_local = threading.local()
+
+
+def set_streams(stdout=None, stderr=None):
+    """
+    Set the outputs of the tasks running in the current thread. Reset to sys.stdout and sys.stderr by None.
+    """
+    _local.streams = (stdout, stderr) if stdout is not None else None
+
+
+def get_streams():
+    """
+    :return: tuple of binary-data (stdout, stderr) for the tasks running in the current thread
+    """
+    streams = getattr(_local, 'streams', None)
+    return streams or (io2bytes(sys.stdout), io2bytes(sys.stderr))
+
+
+def init_worker(lock, connections, indexes):
+    """
+    Initializer of the worker processes: send the output to the multiplexer in the main process.
+
+    :param lock: output lock (see output.set_lock)
+    :param connections: list of writable multiprocessing.Connection objects, one for each worker
+    :param indexes: multiprocessing.Queue of the indexes of connections not used by any worker yet
+    """
+    from color_ssh.output import set_lock
+
+    set_lock(lock)
+    conn = connections[indexes.get()]
+    set_streams(ConnectionStream(conn, 0), ConnectionStream(conn, 1))
+
+
+class ConnectionStream(object):
+    """
+    File-like object sending data to the multiplexer in another process.
+    """
+
+    def __init__(self, connection, index):
+        self.connection = connection
+        self.header = (b'0', b'1')[index]
+
+    def write(self, data):
+        # blocks while the multiplexer does not read the connection
+        self.connection.send_bytes(self.header + data)
+
+    def flush(self):
+        pass
+
+
+class SourceStream(object):
+    """
+    File-like object writing to one of the streams of a source.
+    """
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+
+    def write(self, data):
+        self.source.write(self.index, data)
+
+    def flush(self):
+        pass
+
+
+class Source(object):
+    """
+    Output of one writer (a thread, a worker process or a task of an event loop) to the multiplexer.
+    """
+
+    def __init__(self, mux, block=True):
+        self.mux = mux
+        self.block = block
+        self.chunks = []  # list of (stream index, complete lines)
+        self.partial = [b'', b'']  # trailing partial line of each stream
+        self.pending = 0
+        self.closed = False
+
+    def full(self):
+        """
+        :return: True if the writer should wait before writing more, which a non-blocking source does not do
+        """
+        return self.pending >= self.mux.source_limit and not self.mux.stopped
+
+    def streams(self):
+        """
+        :return: tuple of file-like objects (stdout, stderr)
+        """
+        return SourceStream(self, 0), SourceStream(self, 1)
+
+    def write(self, index, data):
+        self.mux._put(self, index, data)
+
+    def close(self):
+        self.mux._put(self, None, b'')
+
+
+class Multiplexer(object):
+    """
+    Single writer of the output from all the hosts.
+
+    Only complete lines are written, so lines from different hosts never tear however long they are.
+    Lines pending from all the sources are coalesced into one write per stream every interval,
+    or as soon as batch_size bytes are pending. Writers of a source block while the source has
+    source_limit bytes pending, which slows down noisy hosts only.
+    """
+
+    def __init__(self, stdout, stderr, interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE, source_limit=SOURCE_LIMIT):
+        """
+        :param stdout: binary-data stdout output
+        :param stderr: binary-data stderr output
+        :param interval: max seconds to keep the lines pending
+        :param batch_size: number of pending bytes to write out without waiting for the interval
+        :param source_limit: max number of pending bytes of each source
+        """
+        self.outputs = [stdout, stderr]
+        self.interval = interval
+        self.batch_size = batch_size
+        self.source_limit = source_limit
+        self.condition = threading.Condition()
+        self.sources = []
+        self.pending = 0
+        self.stopped = False
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Write out all the pending lines and stop the writer thread.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def source(self, block=True):
+        """
+        :param block: whether writers block while the source is full; otherwise they wait for full() to be False
+                      by themselves, e.g. in an event loop
+        :return: new Source instance
+        """
+        s = Source(self, block)
+        with self.condition:
+            self.sources.append(s)
+        return s
+
+    def add_connection(self, connection):
+        """
+        Read the output sent by ConnectionStream in another thread.
+
+        :param connection: readable multiprocessing.Connection object
+        :return: reader thread, which finishes when all the writable ends are closed
+        """
+        source = self.source()
+
+        def read():
+            try:
+                while True:
+                    data = connection.recv_bytes()
+                    source.write(int(data[:1]), data[1:])
+            except (EOFError, OSError):
+                pass
+            finally:
+                connection.close()
+                source.close()
+
+        t = threading.Thread(target=read)
+        t.daemon = True
+        t.start()
+        return t
+
+    def _put(self, source, index, data):
+        with self.condition:
+            if index is None:
+                # close the source, writing out the partial lines
+                chunks = [(i, x + b'\n') for i, x in enumerate(source.partial) if x]
+                source.partial = [b'', b'']
+                source.closed = True
+            else:
+                while source.block and source.pending >= self.source_limit and not self.stopped:
+                    self.condition.wait()
+
+                # keep the trailing partial line until the rest arrives
+                data = source.partial[index] + data
+                pos = data.rfind(b'\n') + 1
+                source.partial[index] = data[pos:]
+                chunks = [(index, data[:pos])] if pos else []
+
+            n = sum(len(x) for _, x in chunks)
+            source.chunks.extend(chunks)
+            source.pending += n
+            self.pending += n
+            if self.pending >= self.batch_size or source.closed:
+                self.condition.notify_all()
+
+    def _drain(self):
+        """
+        :return: list of bytes to write to each output
+        """
+        with self.condition:
+            ret = [[], []]
+            for s in self.sources:
+                for i, x in s.chunks:
+                    ret[i].append(x)
+                s.chunks = []
+                s.pending = 0
+            self.sources = [s for s in self.sources if not s.closed]
+            self.pending = 0
+            self.condition.notify_all()
+        return [b''.join(xs) for xs in ret]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and self.pending < self.batch_size:
+                    self.condition.wait(self.interval)
+                stopped = self.stopped
+
+            data = self._drain()
+            for out, x in zip(self.outputs, data):
+                if x:
+                    out.write(x)
+                    out.flush()
+            if stopped and not any(data):
+                return
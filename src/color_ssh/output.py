@@ -0,0 +1,449 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import collections
+import multiprocessing
+from color_ssh import color_cat
+from color_ssh.setting.color import RESET
+from color_ssh.util.util import PY3, arg2bytes, format_host_ranges
+
+__all__ = []
+
+FORMATS = ['color', 'jsonl', 'grouped', 'aggregate']
+DEFAULT_GROUP_MEMORY = 1 << 20
+COMPRESSIONS = ['gzip', 'bz2', 'xz']
+FILE_BUFFER_SIZE = 1 << 18  # write buffer of each output file
+COPY_BLOCK_SIZE = 1 << 16
+
+# lock shared by all the worker processes to keep records and groups contiguous
+_lock = None
+
+
+def set_lock(lock):
+    """
+    Set the output lock. Used as the initializer of the worker processes.
+    """
+    global _lock
+    _lock = lock
+
+
+def get_lock():
+    return _lock
+
+
+def make_prefixes(label, palette=color_cat.DEFAULT_PALETTE):
+    """
+    :param label: label string
+    :param palette: palette name
+    :return: tuple of (prefix for stdout, prefix for stderr)
+    """
+    return color_cat.get_prefix(label, b'|', palette), color_cat.get_prefix(label, b'+', palette)
+
+
+class Output(object):
+    """
+    Output format of the tasks. Instances are picklable and passed to the worker processes.
+    """
+
+    def __init__(self, output_format=FORMATS[0], group_memory=DEFAULT_GROUP_MEMORY, buffered=False,
+                 palette=color_cat.DEFAULT_PALETTE, outdir=None, compress=None):
+        """
+        :param output_format: one of FORMATS
+        :param group_memory: max bytes of the output of a host kept in memory for the grouped format
+        :param buffered: read the output in blocks instead of lines for the color format
+                         (used when the lines are written out by the multiplexer anyway)
+        :param palette: palette name to color the labels
+        :param outdir: directory to write the output of each host to, printing only a status line per host
+        :param compress: one of COMPRESSIONS to compress the files in outdir, or None
+        """
+        assert output_format in FORMATS, 'Unknown output format: %s' % output_format
+        assert compress is None or compress in COMPRESSIONS, 'Unknown compression: %s' % compress
+
+        self.output_format = output_format
+        self.group_memory = group_memory
+        self.buffered = buffered
+        self.palette = palette
+        self.outdir = outdir
+        self.compress = compress
+        self.directory = None  # working directory for the aggregate format
+
+    def start(self):
+        """
+        Prepare for running tasks. Must be called in the main process before the worker processes start.
+        """
+        if self.output_format in ['jsonl', 'grouped']:
+            set_lock(multiprocessing.Lock())
+        if self.output_format == 'aggregate':
+            self.directory = tempfile.mkdtemp(prefix='color-ssh-')
+        if self.outdir is not None and not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+
+    def finish(self, stdout, stderr):
+        """
+        Clean up after all the tasks finished, printing the aggregated output if any.
+        """
+        set_lock(None)
+        if self.directory is not None:
+            try:
+                Aggregation(self.directory, self.palette).report(stdout, stderr)
+            finally:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+
+    def open(self, host, label, stdout, stderr, command=None):
+        """
+        :param host: host name
+        :param label: label string
+        :param stdout: binary-data stdout output
+        :param stderr: binary-data stderr output
+        :param command: list of the remote command args, which tell the tasks of a host apart, or None
+        :return: TaskOutput instance for one task
+        """
+        if self.outdir is not None:
+            return FileTaskOutput(label, stdout, stderr, self.outdir, self.compress, self.palette)
+        if self.output_format == 'jsonl':
+            return JsonTaskOutput(host, label, stdout)
+        if self.output_format == 'grouped':
+            return GroupedTaskOutput(label, stdout, stderr, self.group_memory, self.palette)
+        if self.output_format == 'aggregate':
+            return AggregateTaskOutput(host, label, stdout, stderr, self.directory, self.group_memory, self.palette,
+                                       command)
+        return ColorTaskOutput(label, stdout, stderr, self.buffered, self.palette)
+
+
+class TaskOutput(object):
+    """
+    Output of one task, discarding everything by default. Formats override the methods they need.
+    write() may be called from the stdout and stderr reader threads at the same time.
+    """
+    raw = False  # True if the output takes blocks of data as is with write_raw() instead of lines
+
+    def write(self, stream, lines):
+        """
+        Write lines of the command, passed to write_raw() with newlines by default.
+
+        :param stream: 'stdout' or 'stderr'
+        :param lines: list of bytes without newlines
+        """
+        self.write_raw(stream, b''.join(line + b'\n' for line in lines))
+
+    def message(self, kind, text):
+        """
+        Write a message from color-ssh itself. Ignored by default.
+
+        :param kind: 'setup', 'timeout' or 'error'
+        :param text: message string
+        """
+        pass
+
+    def copy(self, fh, stream):
+        """
+        Copy lines from a binary stream.
+
+        :return: tuple of (number of lines, number of bytes) read
+        """
+        num_lines = num_bytes = 0
+        for line in iter(fh.readline, b''):
+            self.write(stream, [line.rstrip(b'\n')])
+            num_lines += 1
+            num_bytes += len(line)
+        return num_lines, num_bytes
+
+    def write_raw(self, stream, data):
+        """
+        Write data of the command as is. Discarded by default.
+
+        :param stream: 'stdout' or 'stderr'
+        :param data: bytes which may end in the middle of a line
+        """
+        pass
+
+    def close(self, ret=None):
+        """
+        :param ret: return code of the task, or None if unknown
+        """
+        pass
+
+
+def _format_lines(prefix, lines):
+    return b''.join(prefix + line + RESET + b'\n' for line in lines)
+
+
+def _format_message(prefix, kind, text):
+    if kind == 'error':
+        return text.encode('utf-8', 'ignore')
+    return prefix + text.encode('utf-8', 'ignore') + RESET + b'\n'
+
+
+class ColorTaskOutput(TaskOutput):
+    """
+    Lines with colored labels, written as soon as they arrive.
+    """
+
+    def __init__(self, label, stdout, stderr, buffered=False, palette=color_cat.DEFAULT_PALETTE):
+        self.outputs = dict(zip(['stdout', 'stderr'], zip(make_prefixes(label, palette), [stdout, stderr])))
+        self.buffered = buffered
+
+    def write(self, stream, lines):
+        prefix, out = self.outputs[stream]
+        out.write(_format_lines(prefix, lines))
+        out.flush()
+
+    def message(self, kind, text):
+        prefix, out = self.outputs['stderr']
+        out.write(_format_message(prefix, kind, text))
+        out.flush()
+
+    def copy(self, fh, stream):
+        prefix, out = self.outputs[stream]
+        return (color_cat.colorize_blocks if self.buffered else color_cat.colorize)(fh, prefix, out)
+
+
+class JsonTaskOutput(TaskOutput):
+    """
+    One JSON object per line: {"host", "label", "stream", "line", "ts"}. Everything is written to stdout.
+    """
+
+    def __init__(self, host, label, stdout):
+        self.host = host
+        self.label = label
+        self.stdout = stdout
+
+    def _record(self, stream, line, ts):
+        d = {'host': self.host, 'label': self.label, 'stream': stream, 'line': line, 'ts': ts}
+        return json.dumps(d, sort_keys=True, ensure_ascii=False).encode('utf-8') + b'\n'
+
+    def _write(self, data):
+        # each record must not be mixed with records from other processes
+        if _lock is None:
+            self.stdout.write(data)
+            self.stdout.flush()
+        else:
+            with _lock:
+                self.stdout.write(data)
+                self.stdout.flush()
+
+    def write(self, stream, lines):
+        ts = time.time()
+        self._write(b''.join(self._record(stream, line.decode('utf-8', 'replace'), ts) for line in lines))
+
+    def message(self, kind, text):
+        ts = time.time()
+        self._write(b''.join(self._record(kind, line, ts) for line in text.rstrip('\n').split('\n')))
+
+
+class GroupedTaskOutput(TaskOutput):
+    """
+    Colored lines of each host buffered until the task finishes, then written in one contiguous block.
+    Buffers larger than group_memory are spilled to temporary files.
+    """
+
+    def __init__(self, label, stdout, stderr, group_memory, palette=color_cat.DEFAULT_PALETTE):
+        self.prefixes = dict(zip(['stdout', 'stderr'], make_prefixes(label, palette)))
+        self.stdout = stdout
+        self.stderr = stderr
+        self.buffers = dict((k, tempfile.SpooledTemporaryFile(max_size=group_memory)) for k in ['stdout', 'stderr'])
+
+    def write(self, stream, lines):
+        self.buffers[stream].write(_format_lines(self.prefixes[stream], lines))
+
+    def message(self, kind, text):
+        self.buffers['stderr'].write(_format_message(self.prefixes['stderr'], kind, text))
+
+    def close(self, ret=None):
+        def f():
+            for k, out in [('stdout', self.stdout), ('stderr', self.stderr)]:
+                buf = self.buffers[k]
+                buf.seek(0)
+                shutil.copyfileobj(buf, out)
+                out.flush()
+                buf.close()
+
+        if _lock is None:
+            f()
+        else:
+            with _lock:
+                f()
+
+
+class AggregateTaskOutput(TaskOutput):
+    """
+    Output of each host hashed incrementally and saved once per distinct output, to be printed by Aggregation.
+    Messages from color-ssh itself are written immediately.
+    """
+    INDEX_FILE = 'index'
+
+    def __init__(self, host, label, stdout, stderr, directory, group_memory, palette=color_cat.DEFAULT_PALETTE,
+                 command=None):
+        assert directory is not None, 'Output.start() must be called before opening an aggregated output.'
+
+        self.color = ColorTaskOutput(label, stdout, stderr, palette=palette)
+        self.host = host
+        # the attempts of a task share the key, and the batches of a host in the work queue do not
+        self.key = hashlib.sha1(b'\0'.join(arg2bytes(x) for x in command or [])).hexdigest()
+        self.directory = directory
+        self.buffers = dict((k, tempfile.SpooledTemporaryFile(max_size=group_memory, dir=directory))
+                            for k in ['stdout', 'stderr'])
+        self.hashes = dict((k, hashlib.sha1()) for k in ['stdout', 'stderr'])
+
+    def write(self, stream, lines):
+        data = b''.join(line + b'\n' for line in lines)
+        self.hashes[stream].update(data)
+        self.buffers[stream].write(data)
+
+    def message(self, kind, text):
+        self.color.message(kind, text)
+
+    def close(self, ret=None):
+        # hash each stream separately since stdout and stderr are read concurrently
+        digest = hashlib.sha1(self.hashes['stdout'].digest() + self.hashes['stderr'].digest()).hexdigest()
+
+        for k, buf in self.buffers.items():
+            path = os.path.join(self.directory, '%s.%s' % (digest, k))
+            if not os.path.exists(path):
+                # write to a temporary file and rename it, as other processes may write the same output
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                with io.open(fd, 'wb') as f:
+                    buf.seek(0)
+                    shutil.copyfileobj(buf, f)
+                os.rename(tmp, path)
+            buf.close()
+
+        # a single write in append mode is not mixed with the records from other processes
+        fd = os.open(os.path.join(self.directory, self.INDEX_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, ' '.join([digest, self.key]).encode('ascii') + b' ' + arg2bytes(self.host) + b'\n')
+        finally:
+            os.close(fd)
+
+
+def _open_file(path, compress):
+    """
+    Open a file to append to, compressed on the fly if required. Compressed streams are appended as separate
+    members, which the decompressors read as one.
+
+    :return: tuple of (binary file object to write, underlying file object to close after it)
+    """
+    raw = io.open(path, 'ab', buffering=FILE_BUFFER_SIZE)
+    if compress == 'gzip':
+        import gzip
+        return gzip.GzipFile(fileobj=raw, mode='ab', compresslevel=6), raw
+    if compress == 'bz2':
+        import bz2
+        return bz2.BZ2File(raw, 'ab'), raw
+    if compress == 'xz':
+        import lzma
+        return lzma.LZMAFile(raw, 'ab'), raw
+    return raw, None
+
+
+class FileTaskOutput(TaskOutput):
+    """
+    Output of each host written as is to "<label>.out" and "<label>.err" in a directory, and a status line
+    with the return code and the size of the output printed when the task finishes.
+    Memory usage is bounded by the file buffers whatever the size of the output.
+    Messages from color-ssh itself are written to the terminal.
+    """
+    raw = True
+    EXTENSIONS = {'stdout': '.out', 'stderr': '.err'}
+    COMPRESSED_EXTENSIONS = {None: '', 'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+
+    def __init__(self, label, stdout, stderr, directory, compress=None, palette=color_cat.DEFAULT_PALETTE):
+        self.color = ColorTaskOutput(label, stdout, stderr, palette=palette)
+        self.paths = dict((k, self.path(directory, label, k, compress)) for k in self.EXTENSIONS)
+        self.compress = compress
+        self.files = {}
+        self.counts = dict((k, [0, 0]) for k in self.EXTENSIONS)  # newlines and bytes of each stream
+        self.last = dict((k, b'\n') for k in self.EXTENSIONS)  # last byte of each stream
+
+    @classmethod
+    def path(cls, directory, label, stream, compress=None):
+        # labels are host names by default, but may contain anything
+        name = label.replace(os.sep, '_')
+        if name.startswith('.'):
+            name = '_' + name[1:]
+        return os.path.join(directory, name + cls.EXTENSIONS[stream] + cls.COMPRESSED_EXTENSIONS[compress])
+
+    def _file(self, stream):
+        # opened on the first write, so that hosts without output on a stream leave no file
+        if stream not in self.files:
+            self.files[stream] = _open_file(self.paths[stream], self.compress)
+        return self.files[stream][0]
+
+    def write_raw(self, stream, data):
+        self._file(stream).write(data)
+        self.counts[stream][0] += data.count(b'\n')
+        self.counts[stream][1] += len(data)
+        self.last[stream] = data[-1:] or self.last[stream]
+
+    def message(self, kind, text):
+        self.color.message(kind, text)
+
+    def copy(self, fh, stream):
+        num_lines = num_bytes = 0
+        last = b'\n'
+        for data in iter(lambda: fh.read(COPY_BLOCK_SIZE), b''):
+            self.write_raw(stream, data)
+            num_lines += data.count(b'\n')
+            num_bytes += len(data)
+            last = data[-1:]
+        # the last line without a newline
+        return num_lines + (last != b'\n'), num_bytes
+
+    def close(self, ret=None):
+        for f, raw in self.files.values():
+            f.close()
+            if raw is not None:
+                raw.close()
+        self.files = {}
+
+        status = 'exit %s' % ('?' if ret is None else ret)
+        for k in ['stdout', 'stderr']:
+            lines = self.counts[k][0] + (self.last[k] != b'\n')
+            status += ', %s %d lines / %d bytes' % (k, lines, self.counts[k][1])
+        self.color.write('stdout', [status.encode('utf-8')])
+
+
+class Aggregation(object):
+    """
+    Hosts grouped by their output.
+    """
+
+    def __init__(self, directory, palette=color_cat.DEFAULT_PALETTE):
+        self.directory = directory
+        self.palette = palette
+
+    def groups(self):
+        """
+        :return: list of (digest, list of hosts), larger groups first
+        """
+        # only the last attempt of each task counts, so that a retried host is not in two groups
+        latest = collections.OrderedDict()
+        path = os.path.join(self.directory, AggregateTaskOutput.INDEX_FILE)
+        if os.path.exists(path):
+            with io.open(path, 'rb') as f:
+                for line in f:
+                    digest, key, host = line.rstrip(b'\n').split(b' ', 2)
+                    latest.pop((host, key), None)
+                    latest[(host, key)] = digest.decode('ascii')
+
+        ret = collections.OrderedDict()
+        for (host, _), digest in latest.items():
+            ret.setdefault(digest, []).append(os.fsdecode(host) if PY3 else host)
+        return sorted(ret.items(), key=lambda x: -len(x[1]))
+
+    def report(self, stdout, stderr):
+        """
+        Print each distinct output once labeled with the host ranges.
+        """
+        for digest, hosts in self.groups():
+            label = format_host_ranges(hosts)
+            for k, out, prefix in zip(['stdout', 'stderr'], [stdout, stderr], make_prefixes(label, self.palette)):
+                with io.open(os.path.join(self.directory, '%s.%s' % (digest, k)), 'rb') as f:
+                    color_cat.colorize_blocks(f, prefix, out)
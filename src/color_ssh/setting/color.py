@@ -46,3 +46,29 @@ COLOR_NAMES = {
     'gray': GRAY,
     'white': WHITE,
 }
+
+
+# Palettes for labels: name -> function returning the list of colors
+
+def _xterm256_colors():
+    # colors of the 6x6x6 cube, skipping dark ones hard to read on a dark background and pale ones on a light one
+    return [('\033[38;5;%dm' % (16 + 36 * r + 6 * g + b)).encode('ascii')
+            for r in range(6) for g in range(6) for b in range(6) if 3 <= max(r, g, b) and min(r, g, b) <= 2]
+
+
+def _truecolor_colors(steps=360):
+    # fully saturated hues at the same brightness
+    ret = []
+    for i in range(steps):
+        h = 6.0 * i / steps
+        x = int(round(200 * (1 - abs(h % 2 - 1))))
+        rgb = [(200, x, 0), (x, 200, 0), (0, 200, x), (0, x, 200), (x, 0, 200), (200, 0, x)][int(h)]
+        ret.append(('\033[38;2;%d;%d;%dm' % rgb).encode('ascii'))
+    return ret
+
+
+PALETTES = {
+    'basic': lambda: COLOR_SET,
+    '256': _xterm256_colors,
+    'truecolor': _truecolor_colors,
+}
@@ -0,0 +1,106 @@
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import io
+import json
+from color_ssh.util.util import percentile
+
+__all__ = []
+
+PERCENTILES = [50, 95, 99]
+PHASES = ['queue', 'setup', 'time', 'total']
+PHASE_NAMES = {'queue': 'queue', 'setup': 'setup', 'time': 'command', 'total': 'total'}
+STREAMS = ['stdout', 'stderr']
+
+
+def new_record(label, command, target=None):
+    """
+    :param target: list of [user, host, port, remote command], or None if unknown
+    :return: dict of per-host statistics (must be picklable to be returned from the worker processes)
+    """
+    return {
+        'label': label,
+        'command': command,
+        'target': target,
+        'ret': None,
+        'attempt': 0,  # number of retries before this result
+        'queue': 0.0,  # seconds between being taken by the dispatcher and starting
+        'setup': [],  # list of {command, time, ret} for each setup command (ret is None on errors)
+        'time': 0.0,  # seconds of the command
+        'total': 0.0,  # seconds including queueing and setup
+        'stdout_lines': 0,
+        'stdout_bytes': 0,
+        'stderr_lines': 0,
+        'stderr_bytes': 0,
+    }
+
+
+def add_output(record, stream, counts):
+    """
+    :param stream: 'stdout' or 'stderr'
+    :param counts: tuple of (lines, bytes)
+    """
+    record[stream + '_lines'] += counts[0]
+    record[stream + '_bytes'] += counts[1]
+
+
+class Stats(object):
+    """
+    Collect per-host statistics and summarize them.
+    """
+    NUM_SLOWEST = 10
+
+    def __init__(self, records=None):
+        self.records = records or []
+
+    def add(self, record):
+        self.records.append(record)
+
+    @staticmethod
+    def _phase_time(record, phase):
+        if phase == 'setup':
+            return sum(x['time'] for x in record['setup'])
+        return record[phase]
+
+    def summary(self):
+        ret = {
+            'hosts': len(self.records),
+            'failed': sum(1 for r in self.records if r['ret'] != 0),
+            'retried': sum(1 for r in self.records if r.get('attempt')),
+        }
+        if not self.records:
+            return ret
+
+        for phase in PHASES:
+            xs = [self._phase_time(r, phase) for r in self.records]
+            ret[phase] = dict(('p%d' % p, percentile(xs, p)) for p in PERCENTILES)
+            ret[phase]['max'] = max(xs)
+        for stream in STREAMS:
+            for unit in ['lines', 'bytes']:
+                key = '%s_%s' % (stream, unit)
+                ret[key] = sum(r[key] for r in self.records)
+        ret['slowest'] = [r['label'] for r in self.slowest()]
+        return ret
+
+    def slowest(self, n=NUM_SLOWEST):
+        return sorted(self.records, key=lambda r: -r['total'])[:n]
+
+    def report(self, stderr):
+        s = self.summary()
+        lines = ['color-ssh: stats for %d hosts (failed: %d, retried: %d)' % (s['hosts'], s['failed'], s['retried'])]
+        if self.records:
+            for phase in PHASES:
+                lines.append('  %-8s %s  max %.3fs' % (PHASE_NAMES[phase], '  '.join(
+                    'p%d %.3fs' % (p, s[phase]['p%d' % p]) for p in PERCENTILES), s[phase]['max']))
+            lines.append('  %-8s %s' % ('output', ', '.join(
+                '%s %d lines / %d bytes' % (x, s[x + '_lines'], s[x + '_bytes']) for x in STREAMS)))
+            lines.append('color-ssh: slowest hosts')
+            for r in self.slowest():
+                lines.append('  %s  total %.3fs (queue %.3fs, setup %.3fs, command %.3fs) ret=%s' % (
+                    r['label'], r['total'], r['queue'], self._phase_time(r, 'setup'), r['time'], r['ret']))
+        stderr.write(('\n'.join(lines) + '\n').encode('utf-8', 'ignore'))
+        stderr.flush()
+
+    def dump(self, path):
+        data = json.dumps({'summary': self.summary(), 'hosts': self.records}, indent=2, sort_keys=True)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(data if isinstance(data, type('')) else data.decode('utf-8'))
@@ -4,7 +4,8 @@ import sys
 import os
 import errno
 
-__all__ = ['PY3', 'arg2bytes', 'io2bytes', 'distribute', 'exception_handler']
+__all__ = ['PY3', 'arg2bytes', 'io2bytes', 'shell_quote', 'distribute', 'distribute_by_cost', 'split_every',
+           'percentile', 'format_host_ranges', 'exception_handler', 'lru_cache']
 
 PY3 = sys.version_info >= (3,)
 
@@ -17,6 +18,19 @@ def io2bytes(fd):
     return fd.buffer if hasattr(fd, 'buffer') else fd
 
 
+def shell_quote(s):
+    """
+    Quote a string for a POSIX shell command line.
+    """
+    import shlex
+
+    if hasattr(shlex, 'quote'):
+        return shlex.quote(s)
+    # Python < 3.3 (pipes is removed in Python 3.13, which has shlex.quote)
+    import pipes
+    return pipes.quote(s)
+
+
 def distribute(num_workers, tasks):
     """
     Split tasks and distribute to each worker.
@@ -40,14 +54,123 @@ def distribute(num_workers, tasks):
     return ret
 
 
+def distribute_by_cost(num_workers, tasks, costs):
+    """
+    Split tasks and distribute to each worker balancing the total cost of each worker.
+    Uses the greedy LPT (longest processing time first) rule.
+
+    :param num_workers: int
+    :param tasks: list
+    :param costs: list of the cost of each task
+    :return: [[task]] (list of the list of tasks, each in the original order)
+    """
+    assert 0 <= num_workers, 'num_workers must be non-negative integer.'
+    assert len(tasks) == len(costs), 'tasks and costs must have the same length.'
+
+    import heapq
+
+    if num_workers == 0:
+        return []
+
+    heap = [(0, i) for i in range(num_workers)]
+    indices = [[] for _ in range(num_workers)]
+    for j in sorted(range(len(tasks)), key=lambda j: -costs[j]):
+        load, i = heapq.heappop(heap)
+        indices[i].append(j)
+        heapq.heappush(heap, (load + costs[j], i))
+    return [[tasks[j] for j in sorted(xs)] for xs in indices]
+
+
+def split_every(n, iterable):
+    """
+    Split an iterable into lists of n elements lazily.
+
+    :param n: positive int
+    :param iterable: iterable
+    :return: generator of lists
+    """
+    assert 0 < n, 'n must be positive integer.'
+
+    import itertools
+
+    it = iter(iterable)
+    while True:
+        xs = list(itertools.islice(it, n))
+        if not xs:
+            return
+        yield xs
+
+
+def percentile(xs, p):
+    """
+    Nearest-rank percentile.
+
+    :param xs: non-empty list of numbers
+    :param p: percentage (0-100)
+    :return: element of xs
+    """
+    assert xs, 'xs must not be empty.'
+
+    ys = sorted(xs)
+    k = int(-(-p * len(ys) // 100))  # ceil
+    return ys[max(0, min(len(ys), k) - 1)]
+
+
+def format_host_ranges(hosts):
+    """
+    Compress host names into ranges of their last numbers (e.g. "web[001-120,130]").
+
+    :param hosts: list of host names
+    :return: comma-separated string
+    """
+    import re
+
+    groups = {}
+    plain = []
+    for host in set(hosts):
+        m = re.match(r'^(.*?)(\d+)(\D*)$', host)
+        if m:
+            groups.setdefault((m.group(1), m.group(3)), []).append((int(m.group(2)), m.group(2)))
+        else:
+            plain.append(host)
+
+    def is_next(prev, x):
+        # "099" -> "100" and "9" -> "10" are continuous, but "9" -> "010" is not
+        padded = x[1].startswith('0') or prev[1].startswith('0')
+        return x[0] == prev[0] + 1 and (len(x[1]) == len(prev[1]) or not padded)
+
+    ret = [(h,) for h in plain]
+    for (prefix, suffix), xs in groups.items():
+        xs.sort()
+        ranges = [[xs[0], xs[0]]]
+        for x in xs[1:]:
+            if is_next(ranges[-1][1], x):
+                ranges[-1][1] = x
+            else:
+                ranges.append([x, x])
+
+        if len(xs) == 1:
+            ret.append((prefix, xs[0][0], prefix + xs[0][1] + suffix))
+        else:
+            body = ','.join(a[1] if a == b else '%s-%s' % (a[1], b[1]) for a, b in ranges)
+            ret.append((prefix, xs[0][0], '%s[%s]%s' % (prefix, body, suffix)))
+    return ','.join(x[-1] for x in sorted(ret))
+
+
 #
 # Decorators
 #
+def _wraps(wrapper, func):
+    # same as functools.wraps, which is slow to import for short-lived processes like color-cat
+    for k in ['__module__', '__name__', '__doc__']:
+        setattr(wrapper, k, getattr(func, k, None))
+    wrapper.__dict__.update(func.__dict__)
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
 def exception_handler(exception_func):
     def f(func):
-        import functools
-
-        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
@@ -63,5 +186,42 @@ def exception_handler(exception_func):
                 exception_func(e)
                 return 1
 
-        return wrapper
+        return _wraps(wrapper, func)
+    return f
+
+
+def lru_cache(maxsize):
+    """
+    Memoize a function of hashable positional arguments, keeping the maxsize most recently used results.
+    (functools.lru_cache is not available in Python 2)
+    """
+    def f(func):
+        state = {}  # the cache and its lock are created on the first call to keep the import fast
+
+        def init():
+            import threading
+            import collections
+
+            state.setdefault('lock', threading.Lock())
+            state.setdefault('cache', collections.OrderedDict())
+
+        def wrapper(*args):
+            if not state:
+                init()
+            lock, cache = state['lock'], state['cache']
+            with lock:
+                if args in cache:
+                    ret = cache.pop(args)
+                    cache[args] = ret
+                    return ret
+            ret = func(*args)
+            with lock:
+                cache[args] = ret
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return ret
+
+        wrapper.cache_clear = lambda: state.get('cache', {}).clear()
+        wrapper.cache_size = lambda: len(state.get('cache', {}))
+        return _wraps(wrapper, func)
     return f
@@ -0,0 +1,80 @@
+# encoding: utf-8
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import threading
+import six
+from mog_commons.unittest import TestCase
+from color_ssh.async_engine import run_tasks
+from color_ssh.mux import Multiplexer
+
+
+class TestAsyncEngine(TestCase):
+    def test_run_tasks(self):
+        def f(bs):
+            return b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33m' + bs + b'\x1b[0m\n'
+
+        def g(bs):
+            return b'\x1b[7m\x1b[33mlab\x1b[0m+\x1b[0m\x1b[33m' + bs + b'\x1b[0m\n'
+
+        path = os.path.join('tests', 'resources', 'test_color_ssh_01.sh')
+        out, err = six.BytesIO(), six.BytesIO()
+        ret = run_tasks([('lab', ['bash', path, 'abc', 'def'], [])] * 3, 2, out, err)
+        self.assertEqual(ret, [0, 0, 0])
+        self.assertEqual(sorted(out.getvalue()),
+                         sorted((f(b'abc') + f(b'foo') + f('あいうえお'.encode('utf-8')) + f(b'\xff\xfe')) * 3))
+        self.assertEqual(sorted(err.getvalue()),
+                         sorted((g(b'def') + g(b'bar') + g('かきくけこ'.encode('utf-8')) + g(b'\xfd\xfc')) * 3))
+
+    def test_run_tasks_exit_code(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        ret = run_tasks([('a', ['sh', '-c', 'exit 3'], []), ('b', ['true'], [])], 32, out, err)
+        self.assertEqual(ret, [3, 0])
+
+    def test_run_tasks_partial_line(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        ret = run_tasks([('', ['printf', 'abc\\ndef'], [])], 1, out, err)
+        self.assertEqual(ret, [0])
+        self.assertEqual(out.getvalue(), b'\x1b[31mabc\x1b[0m\n\x1b[31mdef\x1b[0m\n')
+
+    def test_run_tasks_error(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        ret = run_tasks([('lab', ['echo', 'x'], [['true'], ['false']]),
+                         ('lab', ['./tests/resources/not_exist_command'], [])], 32, out, err)
+        self.assertEqual(ret, [1, 1])
+        self.assertEqual(out.getvalue(), b'')
+        self.assertTrue(b"RuntimeError: Failed to execute setup command: ['false']\nlabel=lab" in err.getvalue())
+        self.assertTrue(b'No such file or directory' in err.getvalue())
+
+    def test_run_tasks_noisy_host(self):
+        released = threading.Event()
+
+        class StuckOutput(six.BytesIO):
+            # a terminal which does not read the output for a while
+            def write(self, data):
+                released.wait()
+                return six.BytesIO.write(self, data)
+
+        finished = []
+
+        def callback(r):
+            finished.append((r, released.is_set()))
+            if r == 3:
+                released.set()
+
+        out, err = StuckOutput(), StuckOutput()
+        timer = threading.Timer(5, released.set)
+        timer.start()
+        try:
+            with Multiplexer(out, err, interval=0.01, source_limit=1000) as mux:
+                ret = run_tasks([('a', ['sh', '-c', 'yes | head -n 100000'], []),
+                                 ('b', ['sh', '-c', 'sleep 0.2; echo ok; exit 3'], [])], 2, out, err, callback, mux=mux)
+        finally:
+            timer.cancel()
+        self.assertEqual(ret, [0, 3])
+
+        # the quiet host finishes while the noisy host is waiting for the output
+        self.assertEqual(finished, [(3, False), (0, True)])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len([x for x in lines if x.endswith(b'mok\x1b[0m')]), 1)
+        self.assertEqual(len([x for x in lines if x.endswith(b'my\x1b[0m')]), 100000)
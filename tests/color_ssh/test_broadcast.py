@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import time
+import tempfile
+import threading
+from mog_commons.unittest import TestCase
+from color_ssh.broadcast import RingBuffer, Broadcaster, connect
+
+
+class TestRingBuffer(TestCase):
+    def test_write_read(self):
+        ring = RingBuffer(8)
+        ring.write(b'abcde')
+        self.assertEqual((ring.start, ring.end), (0, 5))
+        self.assertEqual(ring.read(1, 3), b'bcd')
+
+        # wraps around
+        ring.write(b'fghij')
+        self.assertEqual((ring.start, ring.end), (2, 10))
+        self.assertEqual(ring.read(2, 100), b'cdefgh')
+        self.assertEqual(ring.read(8, 100), b'ij')
+        self.assertEqual(ring.read(10, 100), b'')
+        self.assertRaises(AssertionError, ring.read, 1, 1)
+
+        # longer than the capacity
+        ring.write(b'0123456789')
+        self.assertEqual((ring.start, ring.end), (12, 20))
+        self.assertEqual(ring.read(12, 100) + ring.read(16, 100), b'23456789')
+
+
+class TestBroadcaster(TestCase):
+    @staticmethod
+    def _receive(sock, ret, delay=0):
+        try:
+            chunks = []
+            while True:
+                data = sock.recv(1000)
+                if not data:
+                    break
+                chunks.append(data)
+                time.sleep(delay)
+            ret.append(b''.join(chunks))
+        finally:
+            sock.close()
+
+    def _start_receivers(self, address, ret, delays):
+        # connected before starting, so that none of them starts late
+        threads = [threading.Thread(target=self._receive, args=(connect(address), ret, delay)) for delay in delays]
+        for t in threads:
+            t.start()
+        return threads
+
+    def test_broadcast(self):
+        r, w = os.pipe()
+        payload = os.urandom(100000)
+        b = Broadcaster(io.open(r, 'rb'), ring_size=4096, block_size=1024)
+        address = b.start()
+        try:
+            ret = []
+            # the input is read at the pace of the slowest host
+            threads = self._start_receivers(address, ret, [0, 0, 0.0001])
+            with io.open(w, 'wb') as f:
+                f.write(payload)
+
+            # hosts starting after the ring wrapped around are refused
+            self.assertRaises(RuntimeError, connect, address)
+            for t in threads:
+                t.join()
+            self.assertEqual(ret, [payload] * 3)
+            self.assertEqual(len(b.ring.data), 4096)
+        finally:
+            b.stop()
+        self.assertFalse(os.path.exists(b.directory))
+
+    def test_broadcast_expected(self):
+        r, w = os.pipe()
+        payload = os.urandom(100000)
+        b = Broadcaster(io.open(r, 'rb'), ring_size=4096, block_size=1024, expected=2)
+        address = b.start()
+        try:
+            ret = []
+            first = self._start_receivers(address, ret, [0])
+
+            def write():
+                with io.open(w, 'wb') as f:
+                    f.write(payload)
+
+            writer = threading.Thread(target=write)
+            writer.start()
+
+            # nothing leaves the ring until the other host connects
+            time.sleep(0.2)
+            self.assertEqual(b.ring.start, 0)
+            second = self._start_receivers(address, ret, [0])
+            for t in first + second + [writer]:
+                t.join()
+            self.assertEqual(ret, [payload] * 2)
+        finally:
+            b.stop()
+
+    def test_broadcast_spool(self):
+        d = tempfile.mkdtemp()
+        r, w = os.pipe()
+        payload = os.urandom(100000)
+        b = Broadcaster(io.open(r, 'rb'), ring_size=4096, block_size=1024, spool_dir=d)
+        address = b.start()
+        try:
+            ret = []
+            early = self._start_receivers(address, ret, [0, 0, 0])
+            with io.open(w, 'wb') as f:
+                f.write(payload)
+
+            # hosts starting after the ring wrapped around read the beginning from the spool
+            late = self._start_receivers(address, ret, [0])
+            for t in early + late:
+                t.join()
+            self.assertEqual(ret, [payload] * 4)
+            self.assertEqual(len(os.listdir(d)), 1)
+        finally:
+            b.stop()
+        self.assertEqual(os.listdir(d), [])
+        os.rmdir(d)
+
+    def test_disconnect(self):
+        r, w = os.pipe()
+        b = Broadcaster(io.open(r, 'rb'), ring_size=4096, block_size=1024)
+        address = b.start()
+        try:
+            # a host which exits without reading its input does not hold back the others
+            dead = connect(address)
+            ret = []
+            threads = self._start_receivers(address, ret, [0])
+            dead.close()
+            with io.open(w, 'wb') as f:
+                f.write(b'x' * 100000)
+            for t in threads:
+                t.join()
+            self.assertEqual(ret, [b'x' * 100000])
+        finally:
+            b.stop()
@@ -1,7 +1,10 @@
 # encoding: utf-8
 from __future__ import division, print_function, absolute_import, unicode_literals
 
+import sys
 import os
+import io
+import subprocess
 import six
 from mog_commons.unittest import TestCase
 from color_ssh import color_cat
@@ -80,6 +83,35 @@ class TestSetting(TestCase):
         self._check(self._parse(['-l', 'abc', '-s', b'\xff\xfe']),
                     Setting(b'\x1b[7m\x1b[31mabc\x1b[0m\xff\xfe\x1b[0m\x1b[31m', [None]))
 
+    def test_parse_args_palette(self):
+        self._check(self._parse(['-l', '1', '--palette', 'basic']),
+                    Setting(b'\x1b[7m\x1b[31m1\x1b[0m|\x1b[0m\x1b[31m', [None]))
+
+        color = Setting._get_color('web01', '256')
+        self.assertTrue(color.startswith(b'\x1b[38;5;'))
+        self._check(self._parse(['-l', 'web01', '--palette', '256']),
+                    Setting(b'\x1b[7m' + color + b'web01\x1b[0m|\x1b[0m' + color, [None]))
+        self.assertTrue(Setting._get_color('web01', 'truecolor').startswith(b'\x1b[38;2;'))
+
+        # explicit colors take precedence
+        self._check(self._parse(['-c', 'blue', '--palette', 'truecolor']), Setting(b'\x1b[34m', [None]))
+
+    def test_parse_args_fast(self):
+        for args in [
+            ['-l', 'abc', 'x', '-s', '+', '--', '-c', 'y'],
+            ['--label=abc', '-b', 'x', '--separator=+', '-', '--palette', '256'],
+            ['-c', 'blue', '-l', '-s'],
+            ['--color', '', '-l', 'abc'],
+            ['-l', 'あいう', 'えお'],
+        ]:
+            option, color, paths = Setting._parse_fast(args)
+            expected = Setting._parse_optparse(Setting(), ['color-cat'] + args, six.BytesIO())
+            self.assertEqual((option, color, paths), expected)
+
+        # falls back to optparse
+        for args in [['-lx'], ['--lab', 'x'], ['-l'], ['-c', 'xxx'], ['--palette', 'xxx'], ['--help'], ['-b=1']]:
+            self.assertEqual(Setting._parse_fast(args), None)
+
     def test_parse_args_error(self):
         with self.withBytesOutput() as (out, err):
             self.assertSystemExit(2, Setting().parse_args, ['color-cat', '-l', '1', '-c', 'xxx'], out)
@@ -101,6 +133,63 @@ class TestSetting(TestCase):
         self.assertEqual(err.getvalue(), b'')
 
 
+class TestPalette(TestCase):
+    def test_get_palette(self):
+        self.assertEqual(len(color_cat.get_palette('basic')), 7)
+        self.assertEqual(len(color_cat.get_palette('256')), 162)
+        self.assertEqual(len(color_cat.get_palette('truecolor')), 360)
+        self.assertRaises(ValueError, color_cat.get_palette, 'xxx')
+
+    def test_label_hash(self):
+        self.assertEqual(color_cat.label_hash('web01'), color_cat.label_hash(b'web01'))
+
+        # similar labels get distinct colors
+        labels = ['web%02d' % i for i in range(1, 100)]
+        for palette, min_colors in [('256', 70), ('truecolor', 80)]:
+            self.assertGreaterEqual(len(set(Setting._get_color(x, palette) for x in labels)), min_colors)
+
+    def test_get_prefix(self):
+        color_cat.get_prefix.cache_clear()
+        p = color_cat.get_prefix('abc', b'|')
+        self.assertEqual(p, b'\x1b[7m\x1b[31mabc\x1b[0m|\x1b[0m\x1b[31m')
+        self.assertTrue(color_cat.get_prefix('abc', b'|') is p)
+        self.assertEqual(color_cat.get_prefix('abc', b'+'), b'\x1b[7m\x1b[31mabc\x1b[0m+\x1b[0m\x1b[31m')
+        self.assertEqual(color_cat.get_prefix.cache_size(), 2)
+
+
+class TestStartup(TestCase):
+    # modules color-cat may import in addition to the interpreter's own
+    ALLOWED_MODULES = ['__future__', 'errno', 'zlib', 'select']
+
+    def _imported_modules(self, code, stdin=b''):
+        """
+        :return: set of module names imported by the code, measured by "python -X importtime"
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(color_cat.__file__)))
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        _, err = proc.communicate(stdin)
+        self.assertEqual(proc.returncode, 0)
+        return set(line.split(b'|')[-1].strip().decode('ascii')
+                   for line in err.splitlines() if line.startswith(b'import time:'))
+
+    def test_import_time(self):
+        if sys.version_info < (3, 7):
+            return  # -X importtime is not available
+
+        code = 'import sys; from color_ssh import color_cat; sys.exit(color_cat.main(%r))'
+        baseline = self._imported_modules('pass')
+        for args in [['color-cat'], ['color-cat', '-l', 'web01', '-s', '+'], ['color-cat', '--label=x', '-b']]:
+            modules = self._imported_modules(code % args, b'abc\n') - baseline
+            extra = sorted(m for m in modules if not m.startswith('color_ssh') and m not in self.ALLOWED_MODULES)
+            self.assertEqual(extra, [], 'color-cat %s imported %s' % (' '.join(args[1:]), ', '.join(extra)))
+
+        # optparse is still used for the rest
+        modules = self._imported_modules(code % ['color-cat', '-lweb01']) - baseline
+        self.assertIn('optparse', modules)
+
+
 class TestMain(TestCase):
     def test_main(self):
         with self.withBytesOutput() as (out, err):
@@ -121,3 +210,40 @@ class TestMain(TestCase):
             self.assertEqual(ret, 1)
         self.assertEqual(out.getvalue(), b'')
         self.assertTrue(b'No such file or directory' in err.getvalue())
+
+    def test_colorize(self):
+        out = six.BytesIO()
+        self.assertEqual(color_cat.colorize(six.BytesIO(b'abc\n\ndef\nxyz'), b'P', out), (4, 12))
+        self.assertEqual(out.getvalue(), b'Pabc\x1b[0m\nP\x1b[0m\nPdef\x1b[0m\nPxyz\x1b[0m\n')
+
+    def test_colorize_blocks(self):
+        data = b'abc\n\ndef\nxyz\n' + b'x' * 10 + b'\n' + b'y' * 7
+        expected = b''.join([b'Pabc\x1b[0m\nP\x1b[0m\nPdef\x1b[0m\nPxyz\x1b[0m\n',
+                             b'P' + b'x' * 10 + b'\x1b[0m\n', b'P' + b'y' * 7 + b'\x1b[0m\n'])
+
+        for block_size in [1, 2, 3, 5, 8, 100]:
+            out = six.BytesIO()
+            self.assertEqual(color_cat.colorize_blocks(six.BytesIO(data), b'P', out, block_size=block_size),
+                             (6, len(data)))
+            self.assertEqual(out.getvalue(), expected)
+
+        # read from a file descriptor
+        r, w = os.pipe()
+        os.write(w, data)
+        os.close(w)
+        out = six.BytesIO()
+        with io.open(r, 'rb', 0) as fh:
+            color_cat.colorize_blocks(fh, b'P', out, block_size=4)
+        self.assertEqual(out.getvalue(), expected)
+
+    def test_main_buffered(self):
+        with self.withBytesOutput() as (out, err):
+            args = ['color-cat', '-b',
+                    os.path.join('tests', 'resources', 'test_01.txt'),
+                    os.path.join('tests', 'resources', 'test_02.txt')]
+            ret = color_cat.main(args, stdout=out, stderr=err)
+            self.assertEqual(ret, 0)
+        self.assertEqual(out.getvalue(),
+                         b'\x1b[31mfoo\x1b[0m\n\x1b[31mbar\x1b[0m\n\x1b[31mbaz\x1b[0m\n'
+                         b'\x1b[31m123\x1b[0m\n\x1b[31m456\x1b[0m\n\x1b[31m789\x1b[0m\n')
+        self.assertEqual(err.getvalue(), b'')
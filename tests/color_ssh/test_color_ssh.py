@@ -3,7 +3,14 @@ from __future__ import division, print_function, absolute_import, unicode_litera
 
 import sys
 import os
+import io
+import json
+import gzip
 import tempfile
+import time
+import shutil
+import signal
+import subprocess
 import six
 from contextlib import contextmanager
 from mog_commons.unittest import TestCase
@@ -14,8 +21,9 @@ from color_ssh.util.util import PY3
 
 class TestSetting(TestCase):
     def _check(self, setting, tasks):
-        self.assertEqual(setting.tasks, tasks)
-        for _, cmd, setup in setting.tasks:
+        actual = list(setting.tasks)
+        self.assertEqual(actual, tasks)
+        for _, cmd, setup in actual:
             self.assertTrue(all(isinstance(c, str) for c in cmd))
             for xs in setup:
                 self.assertTrue(all(isinstance(c, str) for c in xs))
@@ -95,6 +103,26 @@ class TestSetting(TestCase):
         self.assertEqual(self._parse(['-H', 'server-11 root@server-12', '-p3', 'pwd']).parallelism, 3)
         self.assertEqual(self._parse(['-H', 'server-11 root@server-12', '--par', '15', 'pwd']).parallelism, 15)
 
+        # format
+        self.assertEqual(self._parse(['server-1', 'pwd']).output.output_format, 'color')
+        self.assertEqual(self._parse(['--format', 'jsonl', 'server-1', 'pwd']).output.output_format, 'jsonl')
+        setting = self._parse(['--format=grouped', '--group-memory', '10', 'server-1', 'pwd'])
+        self.assertEqual((setting.output.output_format, setting.output.group_memory), ('grouped', 10))
+        self.assertEqual([t.host for t in self._parse(['-l', 'lab', '-H', 'server-1 root@server-2:22', 'pwd']).tasks],
+                         ['server-1', 'server-2'])
+
+        # palette
+        self.assertEqual(self._parse(['server-1', 'pwd']).output.palette, 'basic')
+        self.assertEqual(self._parse(['--palette', 'truecolor', 'server-1', 'pwd']).output.palette, 'truecolor')
+
+        # flush interval
+        self.assertEqual(self._parse(['server-1', 'pwd']).flush_interval, 0.05)
+        self.assertEqual(self._parse(['--flush-interval', '0', 'server-1', 'pwd']).flush_interval, 0)
+
+        # engine
+        self.assertEqual(self._parse(['server-1', 'pwd']).engine, 'pool')
+        self.assertEqual(self._parse(['--engine', 'async', 'server-1', 'pwd']).engine, 'async')
+
         # distribute
         self._check(self._parse(['-H', 'server-11 root@server-12', '--distribute', 'echo "foo bar"', 'x', 'y', 'z']), [
             ('server-11', ['ssh', 'server-11', 'echo', 'foo bar', 'x', 'y'], []),
@@ -107,19 +135,23 @@ class TestSetting(TestCase):
                 '-H', 'server-11 root@server-12', '--distribute', 'echo "foo bar"', '--upload', 'dir1/x', 'dir1/y', 'z'
             ]), [
                 ('server-11', ['ssh', 'server-11', 'echo', 'foo bar', 'dir1/x', 'dir1/y'], [
-                    ['ssh', 'server-11', 'mkdir', '-p', 'dir1'],
-                    ['rsync', '-a', 'dir1/x', 'server-11:dir1/x'],
-                    ['rsync', '-a', 'dir1/y', 'server-11:dir1/y']
+                    ['rsync', '-a', '--relative', 'dir1/x', 'dir1/y', 'server-11:'],
                 ]),
                 ('server-12', ['ssh', 'root@server-12', 'echo', 'foo bar', 'z'],
-                 [['rsync', '-a', 'z', 'root@server-12:z']]),
+                 [['rsync', '-a', '--relative', 'z', 'root@server-12:']]),
             ])
 
         # upload-with
         self._check(self._parse(['--upload-with=dir1/x', 'server-1', 'pwd']),
                     [('server-1', ['ssh', 'server-1', 'pwd'], [
-                        ['ssh', 'server-1', 'mkdir', '-p', 'dir1'],
-                        ['rsync', '-a', 'dir1/x', 'server-1:dir1/x'],
+                        ['rsync', '-a', '--relative', 'dir1/x', 'server-1:'],
+                    ])])
+
+        # upload absolute paths and duplicated paths
+        self._check(self._parse(['--upload-with', '/dir1/x dir2/y /dir1/x', 'server-1:1022', 'pwd']),
+                    [('server-1', ['ssh', '-p', '1022', 'server-1', 'pwd'], [
+                        ['rsync', '-a', '--relative', '-e', 'ssh -p 1022', 'dir2/y', 'server-1:'],
+                        ['rsync', '-a', '--relative', '-e', 'ssh -p 1022', '/dir1/x', 'server-1:/'],
                     ])])
 
         self._check(
@@ -128,28 +160,242 @@ class TestSetting(TestCase):
                 '-H', 'server-11 root@server-12', '--distribute', 'echo "foo bar"', '--upload', 'dir1/x', 'dir1/y', 'z'
             ]), [
                 ('server-11', ['ssh', 'server-11', 'echo', 'foo bar', 'dir1/x', 'dir1/y'], [
-                    ['ssh', 'server-11', 'mkdir', '-p', 'dir1', 'dir2', 'dir3'],
-                    ['rsync', '-a', 'dir2/c', 'server-11:dir2/c'],
-                    ['rsync', '-a', 'dir2/d', 'server-11:dir2/d'],
-                    ['rsync', '-a', 'dir3/e', 'server-11:dir3/e'],
-                    ['rsync', '-a', 'dir1/x', 'server-11:dir1/x'],
-                    ['rsync', '-a', 'dir1/y', 'server-11:dir1/y']
+                    ['rsync', '-a', '--relative', 'dir2/c', 'dir2/d', 'dir3/e', 'dir1/x', 'dir1/y', 'server-11:'],
                 ]),
                 ('server-12', ['ssh', 'root@server-12', 'echo', 'foo bar', 'z'], [
-                    ['ssh', 'root@server-12', 'mkdir', '-p', 'dir2', 'dir3'],
-                    ['rsync', '-a', 'dir2/c', 'root@server-12:dir2/c'],
-                    ['rsync', '-a', 'dir2/d', 'root@server-12:dir2/d'],
-                    ['rsync', '-a', 'dir3/e', 'root@server-12:dir3/e'],
-                    ['rsync', '-a', 'z', 'root@server-12:z']
+                    ['rsync', '-a', '--relative', 'dir2/c', 'dir2/d', 'dir3/e', 'z', 'root@server-12:'],
                 ]),
             ])
 
+    def test_parse_args_batch(self):
+        hosts = ' '.join('server-%d' % i for i in range(10))
+        self.assertEqual(self._parse(['-H', hosts, 'pwd']).batch_size, None)
+        self.assertEqual(self._parse(['-H', hosts, '--batch', '3', 'pwd']).batch_size, 3)
+        self.assertEqual(self._parse(['-H', hosts, '--batch-percent', '25', 'pwd']).batch_size, 3)
+        self.assertEqual(self._parse(['-H', hosts, '--batch-percent', '1', 'pwd']).batch_size, 1)
+        self.assertEqual(self._parse(['-H', hosts, '--max-fail', '2', 'pwd']).max_fail, 2)
+
+    def test_parse_args_timeout(self):
+        setting = self._parse(['--timeout', '3.5', '--setup-timeout', '10', 'server-1', 'pwd'])
+        self.assertEqual(setting.timeout, 3.5)
+        self.assertEqual(setting.setup_timeout, 10)
+
+        self._check(self._parse(['--connect-timeout', '5', '--upload-with', 'x', 'server-1:1022', 'pwd']), [
+            ('server-1', ['ssh', '-o', 'ConnectTimeout=5', '-p', '1022', 'server-1', 'pwd'], [
+                ['rsync', '-a', '--relative', '-e', 'ssh -o ConnectTimeout=5 -p 1022', 'x', 'server-1:'],
+            ]),
+        ])
+
+    def test_parse_args_connect_rate(self):
+        setting = self._parse(['server-1', 'pwd'])
+        self.assertEqual((setting.connect_rate, setting.connect_burst), (None, 1))
+        setting = self._parse(['--connect-rate', '50/s', '--connect-burst', '5', 'server-1', 'pwd'])
+        self.assertEqual((setting.connect_rate, setting.connect_burst), (50, 5))
+        self.assertEqual(self._parse(['--connect-rate', '0.5', 'server-1', 'pwd']).connect_rate, 0.5)
+        self.assertEqual(self._parse(['--connect-rate', '600/m', 'server-1', 'pwd']).connect_rate, 10)
+        self.assertEqual(self._parse(['--connect-rate', '36/h', 'server-1', 'pwd']).connect_rate, 0.01)
+        for rate in ['0', '0/s', 'x', '50/d', '-1']:
+            self.assertRaises(ValueError, self._parse, ['--connect-rate', rate, 'server-1', 'pwd'])
+
+    def test_parse_args_retry(self):
+        setting = self._parse(['server-1', 'pwd'])
+        self.assertEqual((setting.retries, setting.retry_backoff), (0, 1.0))
+        setting = self._parse(['--retry', '3', '--retry-backoff', '0.5', 'server-1', 'pwd'])
+        self.assertEqual((setting.retries, setting.retry_backoff), (3, 0.5))
+
+    def test_parse_args_stdin_broadcast(self):
+        self.assertFalse(self._parse(['server-1', 'pwd']).stdin_broadcast)
+        self.assertTrue(self._parse(['--stdin-broadcast', 'server-1', 'pwd']).stdin_broadcast)
+        self.assertRaises(ValueError, Setting().parse_args, ['color-ssh', '--stdin-broadcast', '-h', '-', 'pwd'],
+                          six.BytesIO(), six.BytesIO(b'server-1\n'))
+        self.assertEqual(self._parse(['--stdin-broadcast', '--stdin-spool', '/d', 'server-1', 'pwd']).stdin_spool, '/d')
+        self.assertRaises(ValueError, self._parse, ['--stdin-spool', '/d', 'server-1', 'pwd'])
+
+    def test_parse_args_stdin(self):
+        setting = Setting().parse_args(['color-ssh', '-h', '-', '-H', 'server-3', 'pwd'],
+                                       stdin=six.BytesIO(b'server-1\n\n  root@server-2:22 \n'))
+        self._check(setting, [
+            ('server-1', ['ssh', 'server-1', 'pwd'], []),
+            ('server-2', ['ssh', '-p', '22', 'root@server-2', 'pwd'], []),
+            ('server-3', ['ssh', 'server-3', 'pwd'], []),
+        ])
+
+    def test_parse_args_lazy(self):
+        consumed = []
+
+        def stdin():
+            for i in range(100000):
+                consumed.append(i)
+                yield ('server-%d\n' % i).encode('utf-8')
+
+        setting = Setting().parse_args(['color-ssh', '-h', '-', 'pwd'], stdin=stdin())
+        self.assertEqual(len(consumed), 1)
+        self.assertEqual(next(setting.tasks), ('server-0', ['ssh', 'server-0', 'pwd'], []))
+        self.assertEqual(next(setting.tasks), ('server-1', ['ssh', 'server-1', 'pwd'], []))
+        self.assertEqual(len(consumed), 2)
+
+        # host files are read lazily as well, unless the groups are selected
+        path = os.path.join(tempfile.mkdtemp(), 'hosts')
+        try:
+            with io.open(path, 'w') as f:
+                f.write('server-[0-99999]\n')
+                for i in range(100000):
+                    f.write('host-%d\n' % i)
+            for args in [['-h', path], ['-h', path, '--no-inventory-cache']]:
+                setting = Setting().parse_args(['color-ssh'] + args + ['pwd'])
+                self.assertFalse(isinstance(setting.tasks, list))
+                self.assertEqual(next(setting.tasks), ('server-0', ['ssh', 'server-0', 'pwd'], []))
+                self.assertEqual(next(setting.tasks), ('server-1', ['ssh', 'server-1', 'pwd'], []))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_detach_stdin(self):
+        r, w = os.pipe()
+        os.write(w, b'abc\n')
+        os.close(w)
+        with io.open(r, 'rb') as f:
+            g = color_ssh.detach_stdin(f)
+            self.assertEqual(os.read(r, 10), b'')
+            self.assertEqual(g.read(), b'abc\n')
+            g.close()
+
+        f = six.BytesIO(b'abc')
+        self.assertTrue(color_ssh.detach_stdin(f) is f)
+
+    def test_parse_args_distribute_by(self):
+        costs_path = os.path.join('tests', 'resources', 'test_color_ssh_costs.txt')
+        self._check(self._parse(['-H', 'server-11 server-12', '--distribute', 'echo', '--distribute-by', 'size',
+                                 '--cost-file', costs_path, 'x', 'y', 'z']), [
+            ('server-11', ['ssh', 'server-11', 'echo', 'x'], []),
+            ('server-12', ['ssh', 'server-12', 'echo', 'y', 'z'], []),
+        ])
+
+        # file sizes
+        p1 = os.path.join('tests', 'resources', 'test_01.txt')
+        p2 = os.path.join('tests', 'resources', 'test_color_ssh_01.sh')
+        self._check(self._parse(['-H', 'server-11 server-12', '--distribute', 'cat', '--distribute-by', 'size',
+                                 p1, p2, p1, 'not_exist']), [
+            ('server-11', ['ssh', 'server-11', 'cat', p2], []),
+            ('server-12', ['ssh', 'server-12', 'cat', p1, p1, 'not_exist'], []),
+        ])
+
+        # dynamic
+        setting = self._parse(['-H', 'server-11 server-12', '--distribute', 'echo', '--distribute-by', 'dynamic',
+                               '--chunk-size', '2', '--upload', 'x', 'y', 'z'])
+        self.assertEqual(setting.tasks, [])
+        hosts, batches, build_task = setting.work_queue
+        self.assertEqual(hosts, [[None, 'server-11', None], [None, 'server-12', None]])
+        self.assertEqual(batches, [['x', 'y'], ['z']])
+        self.assertEqual(build_task(hosts[1], ['z']), ('server-12', ['ssh', 'server-12', 'echo', 'z'], [
+            ['rsync', '-a', '--relative', 'z', 'server-12:']
+        ]))
+        for opts in [['--batch', '1'], ['--batch-percent', '50']]:
+            self.assertRaises(ValueError, self._parse, ['-H', 'server-11 server-12', '--distribute', 'echo',
+                                                        '--distribute-by', 'dynamic'] + opts + ['x', 'y'])
+
+    def test_parse_args_upload_tree(self):
+        setting = self._parse(['--upload-with', 'dir1/x /y', '--upload-tree', '2',
+                               '-H', 'server-1 server-2 root@server-3:1022 server-4 server-5 server-1', 'pwd'])
+        self._check(setting, [
+            ('server-1', ['ssh', 'server-1', 'pwd'], []),
+            ('server-2', ['ssh', 'server-2', 'pwd'], []),
+            ('server-3', ['ssh', '-p', '1022', 'root@server-3', 'pwd'], []),
+            ('server-4', ['ssh', 'server-4', 'pwd'], []),
+            ('server-5', ['ssh', 'server-5', 'pwd'], []),
+            ('server-1', ['ssh', 'server-1', 'pwd'], []),
+        ])
+        self.assertEqual(setting.upload_stages, [
+            [
+                ('server-1', ['rsync', '-a', '--relative', '/y', 'server-1:/'],
+                 [['rsync', '-a', '--relative', 'dir1/x', 'server-1:']]),
+                ('server-2', ['rsync', '-a', '--relative', '/y', 'server-2:/'],
+                 [['rsync', '-a', '--relative', 'dir1/x', 'server-2:']]),
+            ], [
+                ('server-3', ['ssh', 'server-1', "rsync -a --relative -e 'ssh -p 1022' /y root@server-3:/"],
+                 [['ssh', 'server-1', "rsync -a --relative -e 'ssh -p 1022' dir1/x root@server-3:"]]),
+                ('server-4', ['ssh', 'server-1', 'rsync -a --relative /y server-4:/'],
+                 [['ssh', 'server-1', 'rsync -a --relative dir1/x server-4:']]),
+                ('server-5', ['ssh', 'server-2', 'rsync -a --relative /y server-5:/'],
+                 [['ssh', 'server-2', 'rsync -a --relative dir1/x server-5:']]),
+            ]
+        ])
+        self.assertEqual(setting.upload_tree[('root', 'server-3', '1022')], (
+            (None, 'server-1', None), [
+                ['rsync', '-a', '--relative', '-e', 'ssh -p 1022', 'dir1/x', 'root@server-3:'],
+                ['rsync', '-a', '--relative', '-e', 'ssh -p 1022', '/y', 'root@server-3:/'],
+            ]))
+        self.assertEqual(setting.upload_tree[(None, 'server-1', None)][0], None)
+
+        # without upload-with
+        self.assertEqual(self._parse(['--upload-tree', '2', '-H', 'server-1 server-2', 'pwd']).upload_stages, [])
+
+    def test_parse_args_multiplex(self):
+        mux = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=~/.ssh/color-ssh-%C', '-o', 'ControlPersist=60']
+        rsh = "ssh -o ControlMaster=auto -o 'ControlPath=~/.ssh/color-ssh-%C' -o ControlPersist=60"
+
+        setting = self._parse(
+            ['--multiplex', '--upload-with=dir1/x', '-H', 'server-1 root@server-2:22 server-1', 'pwd'])
+        self._check(setting, [
+            ('server-1', ['ssh'] + mux + ['server-1', 'pwd'], [
+                ['rsync', '-a', '--relative', '-e', rsh, 'dir1/x', 'server-1:'],
+            ]),
+            ('server-2', ['ssh'] + mux + ['-p', '22', 'root@server-2', 'pwd'], [
+                ['rsync', '-a', '--relative', '-e', rsh + ' -p 22', 'dir1/x', 'root@server-2:'],
+            ]),
+            ('server-1', ['ssh'] + mux + ['server-1', 'pwd'], [
+                ['rsync', '-a', '--relative', '-e', rsh, 'dir1/x', 'server-1:'],
+            ]),
+        ])
+        self.assertEqual(setting.cleanup_commands, {
+            (None, 'server-1', None): ['ssh'] + mux + ['-O', 'exit', 'server-1'],
+            ('root', 'server-2', '22'): ['ssh'] + mux + ['-p', '22', '-O', 'exit', 'root@server-2'],
+        })
+
+        # persistent master connections
+        setting = self._parse(['--multiplex', '--control-path', '/tmp/cm-%h', '--control-persist', '10m',
+                               'server-1', 'pwd'])
+        self._check(setting, [
+            ('server-1', ['ssh', '-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/cm-%h', '-o', 'ControlPersist=10m',
+                          'server-1', 'pwd'], []),
+        ])
+        self.assertEqual(setting.cleanup_commands, {})
+
+        # no multiplexing
+        self.assertEqual(self._parse(['server-1', 'pwd']).cleanup_commands, {})
+
     def test_parse_args_error(self):
         with self.withBytesOutput() as (out, err):
             self.assertSystemExit(2, Setting().parse_args, ['color-ssh'], out)
             self.assertSystemExit(2, Setting().parse_args, ['color-ssh', 'server-1'], out)
             self.assertSystemExit(2, Setting().parse_args, ['color-ssh', '--label', 'x'], out)
             self.assertSystemExit(2, Setting().parse_args, ['color-ssh', '--host', '  ', 'pwd'], out)
+            self.assertSystemExit(2, Setting().parse_args, ['color-ssh', '--engine', 'xxx', 'server-1', 'pwd'], out)
+
+    def test_parse_args_host_ranges(self):
+        path = os.path.join(tempfile.mkdtemp(), 'hosts')
+        try:
+            with io.open(path, 'w') as f:
+                f.write('# inventory\nweb[1-2]\n[db]\nroot@db{a,b}:22\n')
+            self._check(self._parse(['-h', path, '-H', 'x[09-10]', 'pwd']), [
+                ('web1', ['ssh', 'web1', 'pwd'], []),
+                ('web2', ['ssh', 'web2', 'pwd'], []),
+                ('dba', ['ssh', '-p', '22', 'root@dba', 'pwd'], []),
+                ('dbb', ['ssh', '-p', '22', 'root@dbb', 'pwd'], []),
+                ('x09', ['ssh', 'x09', 'pwd'], []),
+                ('x10', ['ssh', 'x10', 'pwd'], []),
+            ])
+            self._check(self._parse(['-h', path, '-g', 'db', '--no-inventory-cache', 'pwd']), [
+                ('dba', ['ssh', '-p', '22', 'root@dba', 'pwd'], []),
+                ('dbb', ['ssh', '-p', '22', 'root@dbb', 'pwd'], []),
+            ])
+            self._check(self._parse(['s[1-2]', 'pwd']), [
+                ('s1', ['ssh', 's1', 'pwd'], []),
+                ('s2', ['ssh', 's2', 'pwd'], []),
+            ])
+            self.assertRaises(ValueError, self._parse, ['-h', path, '-g', 'xxx', 'pwd'])
+            self.assertRaises(ValueError, self._parse, ['-H', 'web1', '-g', 'db', 'pwd'])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
 
     def test_parse_host_error(self):
         self.assertRaises(ValueError, Setting._parse_host, '')
@@ -162,6 +408,85 @@ class TestSetting(TestCase):
         self.assertRaises(ValueError, Setting._parse_host, 'a@@c:0')
 
 
+class TestProgress(TestCase):
+    def test_progress(self):
+        out = six.BytesIO()
+        p = color_ssh.Progress(out, 3)
+        self.assertEqual(list(p.filter(['a', 'b'])), ['a', 'b'])
+        p.record(0)
+        p.record(1)
+        self.assertEqual(list(p.filter(['c'])), ['c'])
+        p.record(0)
+        # the second report is throttled
+        self.assertEqual(out.getvalue(), b'color-ssh: done 1/3, running 1, failed 0\n'
+                                         b'color-ssh: done 3/3, running 0, failed 1\n')
+
+        out = six.BytesIO()
+        p = color_ssh.Progress(out)
+        list(p.filter(['a', 'b']))
+        p.record(2)
+        self.assertEqual(out.getvalue(), b'color-ssh: done 1, running 1, failed 1\n')
+
+
+class TestRateLimiter(TestCase):
+    def test_acquire(self):
+        now = [0.0]
+
+        def sleep(t):
+            now[0] += t
+
+        limiter = color_ssh.RateLimiter(10, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual([round(limiter.acquire(), 3) for _ in range(3)], [0, 0.1, 0.1])
+        self.assertEqual(round(now[0], 3), 0.2)
+
+        # tokens are refilled while idle, up to the burst
+        now[0] += 10
+        self.assertEqual([round(limiter.acquire(), 3) for _ in range(2)], [0, 0.1])
+
+        limiter = color_ssh.RateLimiter(10, 3, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual([round(limiter.acquire(), 3) for _ in range(5)], [0, 0, 0, 0.1, 0.1])
+
+    def test_filter(self):
+        now = [0.0]
+
+        def sleep(t):
+            now[0] += t
+
+        limiter = color_ssh.RateLimiter(2, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual(list(limiter.filter(['a', 'b', 'c'])), ['a', 'b', 'c'])
+        self.assertEqual(now[0], 1.0)
+
+
+class TestRetrier(TestCase):
+    def test_should_retry(self):
+        retrier = color_ssh.Retrier(2, 1.0, rand=lambda: 0.5)
+        ok = {'setup': [{'command': 'x', 'time': 0.1, 'ret': 0}]}
+        ng = {'setup': [{'command': 'x', 'time': 0.1, 'ret': 1}]}
+        task = color_ssh.Task('a', ['x'], [], 'host-a')
+
+        self.assertEqual(retrier.should_retry(task, 0, 0, ok), None)
+        self.assertEqual(retrier.should_retry(task, 0, 1, ok), None)
+        self.assertEqual(retrier.should_retry(task, 0, 255, ok), 0.5)
+        self.assertEqual(retrier.should_retry(task, 1, 1, ng), 1.0)
+        self.assertEqual(retrier.should_retry(task, 2, 255, ok), None)
+        self.assertEqual(retrier.retried, ['host-a'])
+
+        # the backoff is capped
+        self.assertEqual(retrier.delay(10), 30.0)
+
+    def test_filter(self):
+        # retries are due immediately without the backoff
+        retrier = color_ssh.Retrier(1, 1.0, rand=lambda: 0.0)
+        record = {'setup': []}
+        started = []
+        for item in retrier.filter(['a', 'b', 'c']):
+            task, _, attempt = item
+            started.append((task, attempt))
+            self.assertEqual(retrier.retry(item, 0 if task == 'b' else 255, record), attempt == 0 and task != 'b')
+        self.assertEqual(started, [('a', 0), ('a', 1), ('b', 0), ('c', 0), ('c', 1)])
+        self.assertEqual(retrier.retried, ['a', 'c'])
+
+
 class TestMain(TestCase):
     def test_main_single_proc(self):
         # requires: POSIX environment, color-cat command
@@ -209,6 +534,416 @@ class TestMain(TestCase):
             self.assertEqual(sorted(err.read()),
                              sorted((g(b'def') + g(b'bar') + g('かきくけこ'.encode('utf-8')) + g(b'\xfd\xfc')) * 2))
 
+    def test_main_async(self):
+        def f(bs):
+            return b'\x1b[7m\x1b[35mtests/resources/test_color_ssh_01.sh\x1b[0m|\x1b[0m\x1b[35m' + bs + b'\x1b[0m\n'
+
+        def g(bs):
+            return b'\x1b[7m\x1b[35mtests/resources/test_color_ssh_01.sh\x1b[0m+\x1b[0m\x1b[35m' + bs + b'\x1b[0m\n'
+
+        with self.withBytesOutput() as (out, err):
+            path = os.path.join('tests', 'resources', 'test_color_ssh_01.sh')
+            args = ['color-ssh', '--engine', 'async', '--ssh', str('bash'), '-H', '%s %s' % (path, path), 'abc', 'def']
+            ret = color_ssh.main(args, stdout=out, stderr=err)
+            self.assertEqual(ret, 0)
+
+        self.assertEqual(sorted(out.getvalue()),
+                         sorted((f(b'abc') + f(b'foo') + f('あいうえお'.encode('utf-8')) + f(b'\xff\xfe')) * 2))
+        self.assertEqual(sorted(err.getvalue()),
+                         sorted((g(b'def') + g(b'bar') + g('かきくけこ'.encode('utf-8')) + g(b'\xfd\xfc')) * 2))
+
+    def test_main_dynamic(self):
+        with self.__with_temp_output() as (out, err):
+            args = ['color-ssh', '--ssh', str('echo'), '-H', 'a b', '--distribute', 'x', '--distribute-by', 'dynamic',
+                    '1', '2', '3', '4', '5']
+            ret = color_ssh.main(args, stdout=out, stderr=err)
+            self.assertEqual(ret, 0)
+
+            out.seek(0)
+            lines = out.read().splitlines()
+            self.assertEqual(len(lines), 5)
+            self.assertEqual(sorted(line[-7:-4] for line in lines), [b'x 1', b'x 2', b'x 3', b'x 4', b'x 5'])
+
+    def test_main_upload_tree(self):
+        # requires: POSIX environment, bash, GNU cp
+        bin_dir = os.path.abspath(os.path.join('tests', 'resources', 'fake_bin'))
+        path = os.path.join('tests', 'resources', 'test_01.txt')
+        root = tempfile.mkdtemp()
+        old_environ = os.environ.copy()
+        try:
+            os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+            os.environ['FAKE_SSH_ROOT'] = root
+
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--ssh', os.path.join(bin_dir, 'ssh'), '-H', 'h1 h2 h3 h4 h5',
+                        '--upload-with', path, '--upload-tree', '2', 'cat', path]
+                ret = color_ssh.main(args, stdout=out, stderr=err)
+                self.assertEqual(ret, 0)
+
+                out.seek(0)
+                self.assertEqual(len(out.read().splitlines()), 15)
+
+            with open(os.path.join(root, 'rsync.log')) as f:
+                self.assertEqual(sorted(f.read().splitlines()), ['h1 h3', 'h1 h4', 'h2 h5', 'local h1', 'local h2'])
+            for h in ['h1', 'h2', 'h3', 'h4', 'h5']:
+                self.assertTrue(os.path.exists(os.path.join(root, h, path)))
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+            shutil.rmtree(root)
+
+    def test_main_upload_tree_failure(self):
+        # requires: POSIX environment, bash, GNU cp
+        bin_dir = os.path.abspath(os.path.join('tests', 'resources', 'fake_bin'))
+        path = os.path.join('tests', 'resources', 'test_01.txt')
+        for engine in ['pool', 'async']:
+            root = tempfile.mkdtemp()
+            old_environ = os.environ.copy()
+            try:
+                os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+                os.environ['FAKE_SSH_ROOT'] = root
+                # the seed h1 is unreachable for rsync, and the relay from h2 to h5 fails
+                os.environ['FAKE_RSYNC_FAIL'] = 'h1 h2/h5'
+
+                with self.__with_temp_output() as (out, err):
+                    args = ['color-ssh', '--engine', engine, '--ssh', os.path.join(bin_dir, 'ssh'),
+                            '-H', 'h1 h2 h3 h4 h5', '--upload-with', path, '--upload-tree', '2', 'cat', path]
+                    ret = color_ssh.main(args, stdout=out, stderr=err)
+                    self.assertEqual(ret, 1)
+
+                    # every host but h1 runs the command with the files
+                    out.seek(0)
+                    self.assertEqual(sorted(set(line.split(b'\x1b[0m|')[0][-2:] for line in out.read().splitlines())),
+                                     [b'h2', b'h3', b'h4', b'h5'])
+                    err.seek(0)
+                    self.assertIn(b'Failed to execute setup command', err.read())
+
+                # the children of h1 get the files from local, and h5 gets them from local before the command
+                with open(os.path.join(root, 'rsync.log')) as f:
+                    self.assertEqual(sorted(f.read().splitlines()), ['local h2', 'local h3', 'local h4', 'local h5'])
+                self.assertFalse(os.path.exists(os.path.join(root, 'h1', path)))
+            finally:
+                os.environ.clear()
+                os.environ.update(old_environ)
+                shutil.rmtree(root)
+
+    def test_main_upload_tree_timeout(self):
+        # requires: POSIX environment, bash, GNU cp
+        bin_dir = os.path.abspath(os.path.join('tests', 'resources', 'fake_bin'))
+        path = os.path.join('tests', 'resources', 'test_01.txt')
+        root = tempfile.mkdtemp()
+        old_environ = os.environ.copy()
+        try:
+            os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+            os.environ['FAKE_SSH_ROOT'] = root
+            os.environ['FAKE_RSYNC_LATENCY'] = '1'
+
+            # each relay takes longer than the command may, but not than the setup commands may
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--ssh', os.path.join(bin_dir, 'ssh'), '-H', 'h1 h2 h3', '--timeout', '0.5',
+                        '--setup-timeout', '30', '--upload-with', path, '--upload-tree', '2', 'cat', path]
+                self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+
+            with open(os.path.join(root, 'rsync.log')) as f:
+                self.assertEqual(sorted(f.read().splitlines()), ['h1 h3', 'local h1', 'local h2'])
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+            shutil.rmtree(root)
+
+    def test_main_progress(self):
+        with self.__with_temp_output() as (out, err):
+            args = ['color-ssh', '--progress', '--ssh', str('true'), '-H', 'h1 h2 h3', 'x']
+            self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+            err.seek(0)
+            self.assertEqual(err.read().splitlines()[-1], b'color-ssh: done 3/3, running 0, failed 0')
+
+        # batches of the work queue
+        with self.__with_temp_output() as (out, err):
+            args = ['color-ssh', '--progress', '--ssh', str('true'), '-H', 'h1 h2', '--distribute', 'x',
+                    '--distribute-by', 'dynamic', '1', '2', '3', '4', '5']
+            self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+            err.seek(0)
+            self.assertEqual(err.read().splitlines()[-1], b'color-ssh: done 5/5, running 0, failed 0')
+
+    def test_main_stats(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for engine in ['pool', 'async']:
+                with self.__with_temp_output() as (out, err):
+                    args = ['color-ssh', '--stats', '--stats-json', path, '--engine', engine, '--ssh', str('echo'),
+                            '-H', 'h1 h2 h3', 'x']
+                    self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+                    err.seek(0)
+                    lines = err.read().splitlines()
+                    self.assertEqual(lines[0], b'color-ssh: stats for 3 hosts (failed: 0, retried: 0)')
+                    self.assertEqual(lines[5], b'  output   stdout 3 lines / 15 bytes, stderr 0 lines / 0 bytes')
+
+                with open(path) as f:
+                    data = json.load(f)
+                self.assertEqual(sorted(h['label'] for h in data['hosts']), ['h1', 'h2', 'h3'])
+                self.assertEqual([h['stdout_bytes'] for h in data['hosts']], [5, 5, 5])
+        finally:
+            os.remove(path)
+
+    def test_main_format_jsonl(self):
+        for engine in ['pool', 'async']:
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--format', 'jsonl', '--engine', engine, '-l', 'lab', '--ssh', str('echo'),
+                        '-H', 'h1 h2 h3', 'x']
+                self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+
+                out.seek(0)
+                err.seek(0)
+                records = [json.loads(line) for line in out.read().decode('utf-8').splitlines()]
+                self.assertEqual(sorted((r['host'], r['label'], r['stream'], r['line']) for r in records), [
+                    ('h1', 'lab', 'stdout', 'h1 x'),
+                    ('h2', 'lab', 'stdout', 'h2 x'),
+                    ('h3', 'lab', 'stdout', 'h3 x'),
+                ])
+                self.assertEqual(err.read(), b'')
+
+    def test_main_format_grouped(self):
+        def f(label, bs):
+            return b'\x1b[7m\x1b[%dm%s\x1b[0m|\x1b[0m\x1b[%dm%s\x1b[0m\n' % (label[1], label[0], label[1], bs)
+
+        # each host prints its lines slowly, so they would be interleaved without grouping
+        script = str("sh -c 'for i in 1 2 3; do echo $0 $i; sleep 0.1; done'")
+        for engine in ['pool', 'async']:
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--format', 'grouped', '--group-memory', '10', '--engine', engine,
+                        '--ssh', script, '-H', 'h1 h2', 'x']
+                self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+
+                out.seek(0)
+                blocks = [b''.join(f((h, c), h + b' ' + i) for i in [b'1', b'2', b'3'])
+                          for h, c in [(b'h1', 37), (b'h2', 31)]]
+                self.assertIn(out.read(), [blocks[0] + blocks[1], blocks[1] + blocks[0]])
+
+    def test_main_aggregate(self):
+        for engine in ['pool', 'async']:
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--aggregate', '--engine', engine, '--ssh', str('sh -c "echo same"'),
+                        '-H', 'web1 web2 web3', 'x']
+                self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+
+                out.seek(0)
+                self.assertEqual(out.read(), b'\x1b[7m\x1b[34mweb[1-3]\x1b[0m|\x1b[0m\x1b[34msame\x1b[0m\n')
+
+    def test_main_flush_interval(self):
+        # long lines from many hosts must not be mixed
+        line = 'x' * 10000
+        for interval in ['0.05', '0']:
+            for engine in ['pool', 'async']:
+                with self.__with_temp_output() as (out, err):
+                    args = ['color-ssh', '--flush-interval', interval, '--engine', engine, '-p', '8',
+                            '--ssh', str('sh -c "for i in 1 2 3 4 5; do echo %s; done"' % line),
+                            '-H', ' '.join('h%d' % i for i in range(16)), 'x']
+                    self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+
+                    out.seek(0)
+                    lines = out.read().splitlines()
+                    self.assertEqual(len(lines), 80)
+                    for x in lines:
+                        self.assertTrue(x.endswith(line.encode('ascii') + b'\x1b[0m'))
+                        self.assertEqual(x.count(b'|'), 1)
+
+    def test_main_connect_rate(self):
+        for engine in ['pool', 'async']:
+            with self.__with_temp_output() as (out, err):
+                t = time.time()
+                args = ['color-ssh', '--connect-rate', '20/s', '--engine', engine, '--ssh', str('true'),
+                        '-H', ' '.join('h%d' % i for i in range(11)), 'x']
+                self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+                self.assertGreaterEqual(time.time() - t, 0.5)
+
+    def test_main_retry(self):
+        # the first connection of each host (and batch) fails, so a batch may fail once on each host
+        d = tempfile.mkdtemp()
+        ssh = "sh -c 'f=\"%s/$0_$2\"; [ -e \"$f\" ] || { touch \"$f\"; exit 255; }; echo ok $0'" % d
+        try:
+            for i, opts in enumerate([['-p', '1'], ['--engine', 'async'], ['--distribute-by', 'dynamic'], []]):
+                hosts = ['r%d-%d' % (i, j) for j in range(1, 4)]
+                with self.__with_temp_output() as (out, err):
+                    args = ['color-ssh', '--ssh', ssh, '--retry', '3', '--retry-backoff', '0.01', '-H', ' '.join(hosts)]
+                    if '--distribute-by' in opts:
+                        args += opts + ['--distribute', 'x', '1', '2', '3']
+                    else:
+                        args += opts + ['x']
+                    self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+
+                    out.seek(0)
+                    self.assertEqual(len(out.read().splitlines()), 3)
+                    err.seek(0)
+                    lines = err.read().splitlines()
+                    self.assertTrue(lines[-1].startswith(b'color-ssh: retried '))
+
+            # retries are not counted as new hosts
+            for engine in ['pool', 'async']:
+                with self.__with_temp_output() as (out, err):
+                    args = ['color-ssh', '--ssh', ssh, '--retry', '3', '--retry-backoff', '0.01', '--progress',
+                            '--connect-rate', '100/s', '--engine', engine, '-H', 'p-%s' % engine, 'x']
+                    self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+                    err.seek(0)
+                    lines = [line for line in err.read().splitlines() if line.startswith(b'color-ssh: done ')]
+                    self.assertEqual(lines, [b'color-ssh: done 1/1, running 0, failed 0'])
+
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--ssh', ssh, '-H', 'n1 n2', 'x']
+                self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 255)
+        finally:
+            shutil.rmtree(d)
+
+    def test_main_resume(self):
+        d = tempfile.mkdtemp()
+        # hosts succeed only after their marker files are made
+        ssh = "sh -c '[ -e \"%s/$0\" ] && echo ok $0 $2'" % d
+
+        def run(args):
+            with self.__with_temp_output() as (out, err):
+                ret = color_ssh.main(['color-ssh', '--ssh', ssh] + args, stdout=out, stderr=err)
+                out.seek(0)
+                err.seek(0)
+                return ret, len(out.read().splitlines()), err.read().splitlines()
+
+        def touch(host):
+            io.open(os.path.join(d, host), 'w').close()
+
+        try:
+            for i, opts in enumerate([['-p', '1'], ['--engine', 'async']]):
+                journal = os.path.join(d, 'journal-%d' % i)
+                hosts = ['r%d-%d' % (i, j) for j in range(1, 5)]
+                args = ['--resume', journal, '-H', ' '.join(hosts)] + opts
+
+                touch(hosts[0])
+                touch(hosts[1])
+                self.assertEqual(run(args + ['x'])[:2], (1, 2))
+
+                # the succeeded hosts are skipped
+                touch(hosts[2])
+                ret, lines, err = run(args + ['x'])
+                self.assertEqual((ret, lines), (1, 1))
+                self.assertEqual(err[-1], ('color-ssh: skipped 2 hosts already succeeded in %s' % journal).encode())
+
+                # only the failed host runs
+                ret, lines, err = run(args + ['--only-failed', 'x'])
+                self.assertEqual((ret, lines), (1, 0))
+                self.assertEqual(err[-1], ('color-ssh: skipped 3 hosts not failed in %s' % journal).encode())
+                touch(hosts[3])
+                self.assertEqual(run(args + ['--only-failed', 'x'])[:2], (0, 1))
+                self.assertEqual(run(args + ['x'])[:2], (0, 0))
+
+                # other ssh options do not change the hosts in the journal
+                self.assertEqual(run(args + ['--connect-timeout', '5', 'x'])[:2], (0, 0))
+
+            # batches of the work queue are recorded instead of hosts
+            journal = os.path.join(d, 'journal-dynamic')
+            args = ['--resume', journal, '-H', 'q1 q2', '-p', '1', '--distribute-by', 'dynamic',
+                    '--distribute', 'x', '1', '2', '3']
+            self.assertEqual(run(args)[:2], (1, 0))
+            touch('q1')
+            self.assertEqual(run(args)[:2], (0, 3))
+            self.assertEqual(run(args)[:2], (0, 0))
+
+            self.assertEqual(run(['--only-failed', 'h1', 'x'])[0], 1)
+        finally:
+            shutil.rmtree(d)
+
+    def test_main_outdir(self):
+        d = tempfile.mkdtemp()
+        ssh = "sh -c 'seq 1 $1; echo err $0 >&2; exit $2'"
+        try:
+            for i, opts in enumerate([[], ['-p', '1'], ['--engine', 'async'], ['--outdir-compress', 'gzip']]):
+                outdir = os.path.join(d, str(i))
+                with self.__with_temp_output() as (out, err):
+                    args = ['color-ssh', '--ssh', ssh, '-H', 'h1 h2', '--outdir', outdir] + opts + ['20000', '3']
+                    self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 3)
+                    out.seek(0)
+                    lines = out.read().splitlines()
+                    self.assertEqual(len(lines), 2)
+                    status = b'exit 3, stdout 20000 lines / 108894 bytes, stderr 1 lines / 7 bytes\x1b[0m'
+                    self.assertTrue(all(line.endswith(status) for line in lines))
+                    err.seek(0)
+                    self.assertEqual(err.read(), b'')
+
+                ext = '.gz' if opts[-1:] == ['gzip'] else ''
+                self.assertEqual(sorted(os.listdir(outdir)), ['h1.err' + ext, 'h1.out' + ext, 'h2.err' + ext,
+                                                              'h2.out' + ext])
+                with (gzip.open if ext else io.open)(os.path.join(outdir, 'h2.err' + ext), 'rb') as f:
+                    self.assertEqual(f.read(), b'err h2\n')
+                with (gzip.open if ext else io.open)(os.path.join(outdir, 'h1.out' + ext), 'rb') as f:
+                    self.assertEqual(f.read(), ''.join('%d\n' % i for i in range(1, 20001)).encode('ascii'))
+
+            for args in [['--outdir', d, '--format', 'jsonl'], ['--outdir', d, '-l', 'x'], ['--outdir-compress', 'xz']]:
+                self.assertRaises(ValueError, Setting().parse_args, ['color-ssh'] + args + ['h1', 'x'])
+        finally:
+            shutil.rmtree(d)
+
+    def test_main_stdin_broadcast(self):
+        payload = b''.join(b'line %d\n' % i for i in range(20000))
+        ssh = "sh -c 'eval \"$1\"'"
+        for opts in [['-p', '1'], ['-p', '2'], ['--engine', 'async'], ['--retry', '1', '--retry-backoff', '0']]:
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--stdin-broadcast', '--ssh', ssh, '-H', 'h1 h2 h3'] + opts + ['wc -l']
+                ret = color_ssh.main(args, stdin=six.BytesIO(payload), stdout=out, stderr=err)
+                self.assertEqual(ret, 0)
+
+                out.seek(0)
+                lines = out.read().splitlines()
+                self.assertEqual(len(lines), 3)
+                self.assertTrue(all(b'20000' in line for line in lines))
+
+        # stdin larger than the ring, with hosts starting late or all at once
+        payload = b''.join(b'line %d\n' % i for i in range(600000))
+        d = tempfile.mkdtemp()
+        try:
+            for opts in [['-p', '2'], ['-p', '5', '--connect-rate', '20/s'], ['-p', '5'],
+                         ['-p', '5', '--engine', 'async'], ['-p', '2', '--stdin-spool', d]]:
+                with self.__with_temp_output() as (out, err):
+                    args = ['color-ssh', '--stdin-broadcast', '--ssh', ssh, '-H', 'h1 h2 h3 h4 h5'] + opts
+                    ret = color_ssh.main(args + ['wc -l'], stdin=six.BytesIO(payload), stdout=out, stderr=err)
+                    self.assertEqual(ret, 0)
+                    out.seek(0)
+                    lines = out.read().splitlines()
+                    self.assertEqual(len(lines), 5)
+                    self.assertTrue(all(b'600000' in line for line in lines))
+            self.assertEqual(os.listdir(d), [])
+        finally:
+            shutil.rmtree(d)
+
+    def test_main_max_fail(self):
+        for max_fail, opts, failures, skipped in [
+            (1, ['--batch', '2'], 2, 3),
+            (2, ['--batch', '2'], 4, 1),
+            (0, ['-p', '1'], 1, 4),
+            (1, ['--engine', 'async', '-p', '1'], 2, 3),
+        ]:
+            with self.__with_temp_output() as (out, err):
+                args = ['color-ssh', '--ssh', str('false'), '-H', 'h1 h2 h3 h4 h5', '--max-fail', str(max_fail)]
+                args += opts + ['x']
+                ret = color_ssh.main(args, stdout=out, stderr=err)
+                self.assertEqual(ret, 1)
+
+                err.seek(0)
+                self.assertEqual(err.read(), ('color-ssh: %d hosts failed (max-fail: %d), %d hosts skipped\n' % (
+                    failures, max_fail, skipped)).encode('utf-8'))
+
+        # batches of the work queue
+        with self.__with_temp_output() as (out, err):
+            args = ['color-ssh', '--ssh', str('false'), '-H', 'h1 h2', '-p', '1', '--max-fail', '1', '--distribute',
+                    'x', '--distribute-by', 'dynamic', '1', '2', '3', '4', '5']
+            self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 1)
+            err.seek(0)
+            self.assertEqual(err.read(), b'color-ssh: 2 batches failed (max-fail: 1), 3 batches skipped\n')
+
+        # no failures
+        with self.__with_temp_output() as (out, err):
+            args = ['color-ssh', '--ssh', str('true'), '-H', 'h1 h2 h3 h4 h5', '--batch', '2', '--max-fail', '0', 'x']
+            self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 0)
+            err.seek(0)
+            self.assertEqual(err.read(), b'')
+
     def test_main_load_error(self):
         with self.__with_temp_output() as (out, err):
             args = ['color-ssh', '-h', 'not_exist_file', '--ssh', str('./tests/resources/not_exist_command'), 'x', 'y']
@@ -245,6 +980,184 @@ class TestMain(TestCase):
             self.assertTrue(
                 b'RuntimeError: Failed to execute setup command: false\nlabel=lab, command=echo x\n' in err.read())
 
+    def test_run_task_setup(self):
+        def g(bs):
+            return b'\x1b[7m\x1b[33mlab\x1b[0m+\x1b[0m\x1b[33m' + bs + b'\x1b[0m\n'
+
+        with self.__with_temp_output() as (out, err):
+            ret = color_ssh.run_task(('lab', [str('echo'), str('x')], [[str('echo'), str('y')]]))
+            self.assertEqual(ret, 0)
+
+            out.seek(0)
+            err.seek(0)
+
+            self.assertEqual(out.read(), b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33my\x1b[0m\n'
+                                         b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33mx\x1b[0m\n')
+            self.assertEqual(err.read(), g(b"setup: ['echo', 'y']"))
+
+    def test_run_task_timeout(self):
+        def g(bs):
+            return b'\x1b[7m\x1b[33mlab\x1b[0m+\x1b[0m\x1b[33m' + bs + b'\x1b[0m\n'
+
+        cmd = [str('sh'), str('-c'), str('echo a; sleep 10 & sleep 10')]
+        with self.__with_temp_output() as (out, err):
+            t = time.time()
+            self.assertEqual(color_ssh.run_task(('lab', cmd, []), timeout=0.5), 124)
+            self.assertTrue(time.time() - t < 5)
+
+            out.seek(0)
+            err.seek(0)
+            self.assertEqual(out.read(), b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33ma\x1b[0m\n')
+            self.assertEqual(err.read(), g(('timed out after 0.5 seconds: %s' % cmd).encode('utf-8')))
+
+        # setup timeout
+        with self.__with_temp_output() as (out, err):
+            self.assertEqual(color_ssh.run_task(('lab', ['true'], [cmd]), timeout=5, setup_timeout=0.5), 124)
+
+        # not timed out
+        with self.__with_temp_output() as (out, err):
+            self.assertEqual(color_ssh.run_task(('lab', ['false'], [['true']]), timeout=5, setup_timeout=5), 1)
+
+    def test_main_timeout(self):
+        for engine in ['pool', 'async']:
+            with self.__with_temp_output() as (out, err):
+                t = time.time()
+                args = ['color-ssh', '--engine', engine, '--timeout', '0.5', '--ssh', str('sh -c "sleep 10"'),
+                        '-H', 'a b', 'x']
+                self.assertEqual(color_ssh.main(args, stdout=out, stderr=err), 124)
+                self.assertTrue(time.time() - t < 5)
+
+                err.seek(0)
+                self.assertEqual(err.read().count(b'timed out after 0.5 seconds'), 2)
+
+    def test_main_interrupt_with_timeout(self):
+        # requires: POSIX environment
+        root = tempfile.mkdtemp()
+        try:
+            code = 'import sys; from color_ssh import color_ssh; sys.exit(color_ssh.main(sys.argv))'
+            env = dict(os.environ, PYTHONPATH=os.path.abspath('src'))
+            for engine in ['pool', 'async']:
+                for hosts in ['a', 'a b']:
+                    marker = os.path.join(root, '%s-%d' % (engine, len(hosts)))
+                    args = ['--engine', engine, '--timeout', '30', '--ssh', str('sh -c "sleep 2; touch %s"' % marker),
+                            '-H', hosts, 'x']
+                    # SIGINT to the process group, as Ctrl-C on the terminal
+                    with io.open(os.devnull, 'wb') as null:
+                        proc = subprocess.Popen([sys.executable, '-c', code] + args, env=env, stdout=null,
+                                                stderr=null, preexec_fn=os.setsid)
+                    time.sleep(1)
+                    t = time.time()
+                    os.killpg(proc.pid, signal.SIGINT)
+                    self.assertEqual(proc.wait(), 130)
+                    self.assertTrue(time.time() - t < 1)
+                    time.sleep(1.5)
+                    self.assertFalse(os.path.exists(marker))
+        finally:
+            shutil.rmtree(root)
+
+    def test_main_interrupt_with_retry(self):
+        # requires: POSIX environment
+        code = 'import sys; from color_ssh import color_ssh; sys.exit(color_ssh.main(sys.argv))'
+        env = dict(os.environ, PYTHONPATH=os.path.abspath('src'))
+        for engine in ['pool', 'async']:
+            args = ['--engine', engine, '--retry', '2', '--ssh', str('sh -c "sleep 5"'), '-H', 'a b', 'x']
+            with io.open(os.devnull, 'wb') as null:
+                proc = subprocess.Popen([sys.executable, '-c', code] + args, env=env, stdout=null, stderr=null,
+                                        preexec_fn=os.setsid)
+            time.sleep(1)
+            t = time.time()
+            os.killpg(proc.pid, signal.SIGINT)
+            try:
+                # the retrier waiting for the running tasks does not keep it alive
+                while proc.poll() is None and time.time() - t < 3:
+                    time.sleep(0.05)
+                self.assertEqual(proc.returncode, 130)
+            finally:
+                if proc.poll() is None:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    proc.wait()
+
+    def test_main_interrupt_work_queue(self):
+        # requires: POSIX environment
+        root = tempfile.mkdtemp()
+        try:
+            code = 'import sys; from color_ssh import color_ssh; sys.exit(color_ssh.main(sys.argv))'
+            env = dict(os.environ, PYTHONPATH=os.path.abspath('src'))
+            for i, opts in enumerate([[], ['--timeout', '30'], ['--retry', '2']]):
+                marker = os.path.join(root, str(i))
+                args = opts + ['--ssh', str('sh -c "sleep 2; touch %s"' % marker), '-H', 'a b', '--distribute', 'x',
+                               '--distribute-by', 'dynamic', '1', '2', '3', '4', '5', '6']
+                with io.open(os.devnull, 'wb') as null:
+                    proc = subprocess.Popen([sys.executable, '-c', code] + args, env=env, stdout=null, stderr=null,
+                                            preexec_fn=os.setsid)
+                time.sleep(1)
+                t = time.time()
+                os.killpg(proc.pid, signal.SIGINT)
+                try:
+                    # neither the running batches nor the remaining ones touch the marker
+                    while proc.poll() is None and time.time() - t < 1:
+                        time.sleep(0.05)
+                    self.assertEqual(proc.returncode, 130)
+                    time.sleep(2.5)
+                    self.assertFalse(os.path.exists(marker))
+                finally:
+                    if proc.poll() is None:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                        proc.wait()
+        finally:
+            shutil.rmtree(root)
+
+    def test_run_cleanup(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'x')
+            color_ssh.run_cleanup([['./tests/resources/not_exist_command'], ['touch', path]])
+            self.assertTrue(os.path.exists(path))
+
+            # in parallel
+            t = time.time()
+            color_ssh.run_cleanup([['sleep', '0.5']] * 4, 4)
+            self.assertLess(time.time() - t, 1.5)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_main_cleanup(self):
+        # requires: POSIX environment, bash
+        ssh = os.path.abspath(os.path.join('tests', 'resources', 'fake_bin', 'ssh'))
+        # hosts read lazily from a file
+        fd, host_file = tempfile.mkstemp()
+        os.write(fd, b'h1\nh2\nh3\n')
+        os.close(fd)
+        try:
+            for opts, expected in [
+                (['-p', '1', '--max-fail', '0', '-H', 'h1 h2 h3', 'false'], ['exit h1']),
+                (['-p', '3', '-H', 'h1 h2 h3', 'true'], ['exit h1', 'exit h2', 'exit h3']),
+                (['-p', '3', '-H', 'h1 h2 h3', '--distribute', 'true', '--distribute-by', 'dynamic', 'x'], 1),
+                (['-p', '3', '-h', host_file, 'true'], ['exit h1', 'exit h2', 'exit h3']),
+                (['-p', '3', '--engine', 'async', '-h', host_file, 'true'], ['exit h1', 'exit h2', 'exit h3']),
+                (['-p', '1', '--max-fail', '0', '-h', host_file, 'false'], ['exit h1']),
+            ]:
+                root = tempfile.mkdtemp()
+                old_environ = os.environ.copy()
+                try:
+                    os.environ['FAKE_SSH_ROOT'] = root
+                    with self.__with_temp_output() as (out, err):
+                        color_ssh.main(['color-ssh', '--ssh', ssh, '--multiplex'] + opts, stdout=out, stderr=err)
+
+                    # only the hosts which started close their master connections
+                    with open(os.path.join(root, 'control.log')) as f:
+                        lines = sorted(f.read().splitlines())
+                    if isinstance(expected, int):
+                        self.assertEqual(len(lines), expected)
+                    else:
+                        self.assertEqual(lines, expected)
+                finally:
+                    os.environ.clear()
+                    os.environ.update(old_environ)
+                    shutil.rmtree(root)
+        finally:
+            os.remove(host_file)
+
     @staticmethod
     @contextmanager
     def __with_temp_output():
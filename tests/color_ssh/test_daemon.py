@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import sys
+import os
+import io
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+import unittest
+from mog_commons.unittest import TestCase
+from color_ssh import daemon
+from color_ssh.util.util import PY3
+
+
+@unittest.skipUnless(PY3, 'color-sshd requires Python 3.3 or later')
+class TestDaemon(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'sshd.sock')
+        self.old_environ = os.environ.copy()
+        os.environ['FAKE_SSH_ROOT'] = self.root
+
+        env = dict(os.environ, PYTHONPATH=os.path.abspath('src'))
+        code = 'import sys; from color_ssh import daemon; sys.exit(daemon.main(%r))' % [
+            'color-sshd', '--socket', self.path, '--control-persist', '1s']
+        self.proc = subprocess.Popen([sys.executable, '-c', code], env=env)
+        for _ in range(500):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(), 0)
+        self.assertFalse(os.path.exists(self.path))
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        shutil.rmtree(self.root)
+
+    def _submit(self, args):
+        """
+        :return: tuple of (exit code, stdout, stderr)
+        """
+        with tempfile.TemporaryFile() as out:
+            with tempfile.TemporaryFile() as err:
+                with io.open(os.devnull, 'rb') as null:
+                    ret = daemon.submit(args, self.path, [null.fileno(), out.fileno(), err.fileno()])
+                out.seek(0)
+                err.seek(0)
+                return ret, out.read(), err.read()
+
+    def test_submit(self):
+        ssh = os.path.abspath(os.path.join('tests', 'resources', 'fake_bin', 'ssh'))
+
+        ret, out, err = self._submit(['--ssh', ssh, '-H', 'h1 h2 h3', 'echo $FAKE_SSH_HOST'])
+        self.assertEqual(ret, 0)
+        self.assertEqual(sorted(line[-6:-4] for line in out.splitlines()), [b'h1', b'h2', b'h3'])
+        self.assertEqual(err, b'')
+
+        # the exit code and the environment of the client
+        os.environ['GREETING'] = 'hello'
+        ret, out, err = self._submit(['--ssh', ssh, '-H', 'h1', 'echo $GREETING; exit 3'])
+        self.assertEqual(ret, 3)
+        self.assertIn(b'hello', out)
+
+        ret, out, err = self._submit(['--no-such-option'])
+        self.assertEqual(ret, 2)
+        self.assertIn(b'no such option', err)
+
+    def test_slow_client(self):
+        ssh = os.path.abspath(os.path.join('tests', 'resources', 'fake_bin', 'ssh'))
+
+        # a client which connects and sends nothing does not block the other jobs
+        idle = daemon.socket.socket(daemon.socket.AF_UNIX, daemon.socket.SOCK_STREAM)
+        idle.connect(self.path)
+        try:
+            # a request sent in pieces
+            slow = daemon.socket.socket(daemon.socket.AF_UNIX, daemon.socket.SOCK_STREAM)
+            slow.connect(self.path)
+            with io.open(os.devnull, 'r+b') as null:
+                request = {'argv': ['--ssh', ssh, '-H', 'h1', 'exit 5'], 'cwd': os.getcwd(), 'env': dict(os.environ)}
+                data = daemon.json.dumps(request).encode('utf-8') + b'\n'
+                daemon._send_fds(slow, data[:10], [null.fileno()] * 3)
+
+            t = time.time()
+            ret, out, err = self._submit(['--ssh', ssh, '-H', 'h1', 'echo $FAKE_SSH_HOST'])
+            self.assertEqual(ret, 0)
+            self.assertIn(b'h1', out)
+            self.assertTrue(time.time() - t < 2)
+
+            slow.sendall(data[10:])
+            self.assertEqual(slow.recv(64), b'5\n')
+            slow.close()
+        finally:
+            idle.close()
+
+    def test_kill_on_disconnect(self):
+        ssh = os.path.abspath(os.path.join('tests', 'resources', 'fake_bin', 'ssh'))
+        marker = os.path.join(self.root, 'h1', 'done')
+
+        # a job whose client is gone is killed
+        sock = daemon.socket.socket(daemon.socket.AF_UNIX, daemon.socket.SOCK_STREAM)
+        sock.connect(self.path)
+        with io.open(os.devnull, 'r+b') as null:
+            request = {'argv': ['--ssh', ssh, '-H', 'h1', 'sleep 2; touch done'], 'cwd': os.getcwd(),
+                       'env': dict(os.environ)}
+            daemon._send_fds(sock, daemon.json.dumps(request).encode('utf-8') + b'\n', [null.fileno()] * 3)
+        time.sleep(0.5)
+        sock.close()
+        time.sleep(2.5)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_socket_path(self):
+        os.environ[daemon.SOCKET_ENV] = '/tmp/x.sock'
+        self.assertEqual(daemon.socket_path(), '/tmp/x.sock')
+        self.assertEqual(daemon.socket_path('/tmp/y.sock'), '/tmp/y.sock')
+        del os.environ[daemon.SOCKET_ENV]
+        self.assertEqual(daemon.socket_path(), os.path.expanduser(daemon.DEFAULT_SOCKET))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import time
+import marshal
+import shutil
+import tempfile
+from mog_commons.unittest import TestCase
+from color_ssh import inventory
+from color_ssh.inventory import expand_host, Inventory, load_inventory, cache_path, file_key, CACHE_VERSION
+from color_ssh.util.util import format_host_ranges
+
+
+class TestInventory(TestCase):
+    def test_expand_host(self):
+        self.assertEqual(list(expand_host('web01')), ['web01'])
+        self.assertEqual(list(expand_host('web[1-3]')), ['web1', 'web2', 'web3'])
+        self.assertEqual(list(expand_host('web[098-101,200]')), ['web098', 'web099', 'web100', 'web101', 'web200'])
+        self.assertEqual(list(expand_host('web[9-10]')), ['web9', 'web10'])
+        self.assertEqual(list(expand_host('root@db{a,b}[1-2].local:22')),
+                         ['root@dba1.local:22', 'root@dba2.local:22', 'root@dbb1.local:22', 'root@dbb2.local:22'])
+        self.assertEqual(list(expand_host('{web[1-2],db}-x')), ['web1-x', 'web2-x', 'db-x'])
+
+        # inverse of format_host_ranges
+        hosts = ['web%03d' % i for i in range(1, 121)] + ['web130']
+        self.assertEqual(list(expand_host(format_host_ranges(hosts))), hosts)
+
+        for s in ['web[1-', 'web[a-b]', 'web[3-1]', 'web[]', 'web{a', 'web[1]}']:
+            self.assertRaises(ValueError, lambda: list(expand_host(s)))
+
+    def test_compile(self):
+        inv = Inventory.compile([
+            'base # comment',
+            '',
+            '[web]',
+            'web[1-3]',
+            '[db]',
+            'db1',
+            'web2',
+            '[prod]',
+            '@db',
+            '@web',
+            'user@lb:2222',
+        ])
+        hosts = [h for _, h, _ in inv.select()]
+        self.assertEqual(hosts, ['base', 'web1', 'web2', 'web3', 'db1', 'web2', 'lb'])
+        self.assertEqual([h for _, h, _ in inv.select(['db'])], ['db1', 'web2'])
+        self.assertEqual([h for _, h, _ in inv.select(['web', 'db'])], ['web1', 'web2', 'web3', 'db1', 'web2'])
+        self.assertEqual(inv.select(['prod'])[-1], ['user', 'lb', '2222'])
+        self.assertEqual(len(inv.select(['prod'])), 6)
+        self.assertRaises(ValueError, inv.select, ['xxx'])
+
+        self.assertRaises(ValueError, Inventory.compile, ['@web'])
+        self.assertRaises(ValueError, Inventory.compile, ['[a]', '@b'])
+        self.assertRaises(ValueError, Inventory.compile, ['[a]', '@b', '[b]', '@a'])
+        self.assertRaises(ValueError, Inventory.compile, ['a:b'])
+
+    def test_load_inventory(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'hosts')
+        cache_dir = os.path.join(tmp, 'cache')
+        try:
+            with io.open(path, 'w') as f:
+                f.write('[web]\nweb[0001-2000]\n')
+            old = time.time() - 10
+            os.utime(path, (old, old))
+
+            inv = load_inventory(path, cache_dir)
+            self.assertEqual(len(inv.select(['web'])), 2000)
+            self.assertTrue(os.path.exists(cache_path(cache_dir, path)))
+
+            # loaded from the cache
+            cached = load_inventory(path, cache_dir)
+            self.assertEqual(cached.hosts, inv.hosts)
+            self.assertEqual(cached.select(['web'])[-1], [None, 'web2000', None])
+
+            # the cache is invalidated when the file changes
+            with io.open(path, 'w') as f:
+                f.write('[web]\nweb[0001-1000]\n')
+            os.utime(path, (old + 1, old + 1))
+            self.assertEqual(len(load_inventory(path, cache_dir).hosts), 1000)
+
+            # a broken cache is ignored
+            with io.open(cache_path(cache_dir, path), 'wb') as f:
+                f.write(b'xxx')
+            self.assertEqual(len(load_inventory(path, cache_dir).hosts), 1000)
+
+            # a truncated cache is ignored and rebuilt
+            with io.open(cache_path(cache_dir, path), 'rb') as f:
+                data = f.read()
+            for n in range(0, len(data), max(1, len(data) // 50)):
+                with io.open(cache_path(cache_dir, path), 'wb') as f:
+                    f.write(data[:n])
+                self.assertEqual(len(load_inventory(path, cache_dir).hosts), 1000)
+                with io.open(cache_path(cache_dir, path), 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+            # valid marshal data of another shape
+            key = file_key(path)
+            for x in [None, (CACHE_VERSION, key), (CACHE_VERSION, key, 'a', {1: 'u'}, {}, {}),
+                      (CACHE_VERSION, key, 1, {}, {}, {}), (CACHE_VERSION, key, 'a', [], {}, {}),
+                      (CACHE_VERSION, key, 'a', {}, {}, {'g': [0]})]:
+                with io.open(cache_path(cache_dir, path), 'wb') as f:
+                    f.write(marshal.dumps(x))
+                self.assertEqual(len(load_inventory(path, cache_dir).hosts), 1000)
+
+            # small or recently modified files are not cached
+            shutil.rmtree(cache_dir)
+            with io.open(path, 'w') as f:
+                f.write('web[0001-2000]\n')
+            load_inventory(path, cache_dir)
+            self.assertFalse(os.path.exists(cache_dir))
+            with io.open(path, 'w') as f:
+                f.write('web1\n')
+            os.utime(path, (old, old))
+            self.assertEqual(load_inventory(path, cache_dir).hosts, [[None, 'web1', None]])
+            self.assertFalse(os.path.exists(cache_dir))
+            self.assertEqual(load_inventory(path).hosts, [[None, 'web1', None]])
+        finally:
+            shutil.rmtree(tmp)
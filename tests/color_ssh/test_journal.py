@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import json
+import time
+import shutil
+import tempfile
+from mog_commons.unittest import TestCase
+from color_ssh.journal import Journal
+from color_ssh.color_ssh import Task
+from color_ssh.stats import Stats, new_record
+
+
+class TestJournal(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @staticmethod
+    def _record(host, ret, batch=None):
+        record = new_record(host, ['ssh', host, 'x'])
+        record['ret'] = ret
+        if batch is not None:
+            record['batch'] = batch
+        return record
+
+    def _lines(self):
+        with io.open(self.path, 'rb') as f:
+            return f.read().splitlines()
+
+    def test_add(self):
+        stats = Stats()
+        clock = [0.0]
+        j = Journal(self.path, stats=stats, flush_records=3, flush_interval=10, clock=lambda: clock[0])
+        j.open()
+        j.add(self._record('h1', 0))
+        j.add(self._record('h2', 1))
+        self.assertEqual(self._lines(), [])
+
+        # written in batches
+        j.add(self._record('h3', 0, ['a', 'b']))
+        self.assertEqual(len(self._lines()), 3)
+        self.assertEqual(json.loads(self._lines()[2].decode('utf-8')),
+                         {'batch': ['a', 'b'], 'label': 'h3', 'ret': 0, 'ts': 0.0})
+        j.add(self._record('h4', 0))
+        clock[0] = 10.0
+        j.add(self._record('h5', 0))
+        self.assertEqual(len(self._lines()), 5)
+        j.add(self._record('h6', 0))
+        j.close()
+        self.assertEqual(len(self._lines()), 6)
+        self.assertEqual(len(stats.records), 6)
+
+    def test_flush_interval(self):
+        # records are written in time even if no other record arrives
+        j = Journal(self.path, flush_interval=0.2)
+        j.open()
+        try:
+            j.add(self._record('h1', 0))
+            self.assertEqual(self._lines(), [])
+            time.sleep(0.5)
+            self.assertEqual(len(self._lines()), 1)
+        finally:
+            j.close()
+        self.assertEqual(len(self._lines()), 1)
+
+    def test_resume(self):
+        with io.open(self.path, 'wb') as f:
+            f.write(b'{"command": ["ssh", "h1", "x"], "label": "h1", "ret": 1, "ts": 0}\n'
+                    b'{"command": ["ssh", "h2", "x"], "label": "h2", "ret": 1, "ts": 0}\n'
+                    b'{"command": ["ssh", "h1", "x"], "label": "h1", "ret": 0, "ts": 1}\n'
+                    b'{"batch": ["a"], "label": "h1", "ret": 0, "ts": 1}\n'
+                    b'{"command": ["ssh", "h3", "x"], "lab')
+
+        tasks = [(h, ['ssh', h, 'x'], []) for h in ['h1', 'h2', 'h3']]
+        j = Journal(self.path)
+        self.assertEqual([t[0] for t in j.filter(tasks)], ['h2', 'h3'])
+        self.assertEqual(j.filter_batches([['a'], ['b']]), [['b']])
+        self.assertEqual(j.skipped, 2)
+
+        j = Journal(self.path, only_failed=True)
+        self.assertEqual([t[0] for t in j.filter(tasks)], ['h2'])
+        self.assertEqual(j.filter_batches([['a'], ['b']]), [])
+
+        # the torn line is terminated before appending
+        j.open()
+        j.add(self._record('h3', 0))
+        j.close()
+        self.assertEqual([t[0] for t in Journal(self.path).filter(tasks)], ['h2'])
+
+    def test_resume_target(self):
+        # hosts are identified by the user, host, port and remote command, whatever the ssh options are
+        j = Journal(self.path)
+        j.open()
+        record = new_record('h1', ['ssh', '-o', 'ConnectTimeout=5', 'h1', 'x'], ['u', 'h1', None, ['x']])
+        record['ret'] = 0
+        j.add(record)
+        j.close()
+
+        tasks = [Task('h1', ['ssh', 'u@h1', 'x'], [], 'h1', ('u', 'h1', None), ['x']),
+                 Task('h1', ['ssh', 'u@h1', 'y'], [], 'h1', ('u', 'h1', None), ['y']),
+                 Task('h1', ['ssh', '-p', '22', 'u@h1', 'x'], [], 'h1', ('u', 'h1', '22'), ['x'])]
+        self.assertEqual([t[1][-1] for t in Journal(self.path).filter(tasks)], ['y', 'x'])
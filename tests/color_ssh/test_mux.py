@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import time
+import threading
+import multiprocessing
+import six
+from mog_commons.unittest import TestCase
+from color_ssh.mux import Multiplexer, ConnectionStream, set_streams, get_streams
+
+
+class TestMultiplexer(TestCase):
+    def test_coalesce(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        with Multiplexer(out, err, interval=10) as mux:
+            a, b = mux.source(), mux.source()
+            a_out, a_err = a.streams()
+            b_out, _ = b.streams()
+            a_out.write(b'a1\n')
+            b_out.write(b'b1\nb')
+            a_err.write(b'e1\n')
+            a_out.write(b'a2\n')
+            time.sleep(0.1)
+
+            # nothing is written until the interval passes
+            self.assertEqual(out.getvalue(), b'')
+            b_out.write(b'2\n')
+            b.close()
+
+        self.assertEqual(out.getvalue(), b'a1\na2\nb1\nb2\n')
+        self.assertEqual(err.getvalue(), b'e1\n')
+
+    def test_partial_line(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        with Multiplexer(out, err, interval=0.01) as mux:
+            a = mux.source()
+            a_out, _ = a.streams()
+            a_out.write(b'abc')
+            time.sleep(0.1)
+            self.assertEqual(out.getvalue(), b'')
+            a_out.write(b'def\nxyz')
+            time.sleep(0.1)
+            self.assertEqual(out.getvalue(), b'abcdef\n')
+            a.close()
+        self.assertEqual(out.getvalue(), b'abcdef\nxyz\n')
+
+    def test_batch_size(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        with Multiplexer(out, err, interval=10, batch_size=10) as mux:
+            a_out, _ = mux.source().streams()
+            a_out.write(b'0123456789\n')
+            time.sleep(0.1)
+            self.assertEqual(out.getvalue(), b'0123456789\n')
+
+    def test_backpressure(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        with Multiplexer(out, err, interval=0.5, source_limit=4) as mux:
+            noisy_out, _ = mux.source().streams()
+            quiet_out, _ = mux.source().streams()
+            noisy_out.write(b'abcd\n')
+
+            # the noisy source blocks until its lines are written out
+            t = threading.Thread(target=noisy_out.write, args=(b'efgh\n',))
+            t.start()
+            t.join(0.1)
+            self.assertTrue(t.is_alive())
+
+            # the quiet source does not
+            quiet_out.write(b'x\n')
+            t.join()
+        self.assertEqual(out.getvalue(), b'abcd\nx\nefgh\n')
+
+    def test_non_blocking(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        with Multiplexer(out, err, interval=0.05, source_limit=4) as mux:
+            source = mux.source(block=False)
+            source.write(0, b'abcd\n')
+
+            # writers of a non-blocking source wait by themselves
+            source.write(0, b'efgh\n')
+            self.assertTrue(source.full())
+            while source.full():
+                time.sleep(0.01)
+            source.close()
+        self.assertEqual(out.getvalue(), b'abcd\nefgh\n')
+
+    def test_add_connection(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        with Multiplexer(out, err) as mux:
+            r, w = multiprocessing.Pipe(duplex=False)
+            t = mux.add_connection(r)
+            ConnectionStream(w, 0).write(b'abc\n')
+            ConnectionStream(w, 1).write(b'def\n')
+            w.close()
+            t.join()
+        self.assertEqual(out.getvalue(), b'abc\n')
+        self.assertEqual(err.getvalue(), b'def\n')
+
+    def test_streams(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        set_streams(out, err)
+        try:
+            self.assertEqual(get_streams(), (out, err))
+        finally:
+            set_streams(None)
+        self.assertNotEqual(get_streams(), (out, err))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import io
+import gzip
+import json
+import shutil
+import tempfile
+import six
+from mog_commons.unittest import TestCase
+from color_ssh.output import Output, TaskOutput, make_prefixes
+
+
+class TestOutput(TestCase):
+    def test_color(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        o = Output().open('server-1', 'lab', out, err)
+        o.write('stdout', [b'abc', b'def'])
+        o.write('stderr', [b'xyz'])
+        o.message('setup', 'setup: x')
+        o.message('error', 'Error\n')
+        self.assertEqual(o.copy(six.BytesIO(b'ghi\n'), 'stdout'), (1, 4))
+        o.close()
+
+        self.assertEqual(out.getvalue(), b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33mabc\x1b[0m\n'
+                                         b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33mdef\x1b[0m\n'
+                                         b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33mghi\x1b[0m\n')
+        self.assertEqual(err.getvalue(), b'\x1b[7m\x1b[33mlab\x1b[0m+\x1b[0m\x1b[33mxyz\x1b[0m\n'
+                                         b'\x1b[7m\x1b[33mlab\x1b[0m+\x1b[0m\x1b[33msetup: x\x1b[0m\n'
+                                         b'Error\n')
+
+    def test_task_output(self):
+        # only write_raw is overridden
+        class RawOutput(TaskOutput):
+            def __init__(self):
+                self.data = []
+
+            def write_raw(self, stream, data):
+                self.data.append((stream, data))
+
+        o = RawOutput()
+        o.write('stdout', [b'abc', b'def'])
+        o.message('setup', 'setup: x')
+        self.assertEqual(o.copy(six.BytesIO(b'ghi\n'), 'stderr'), (1, 4))
+        o.close(0)
+        self.assertEqual(o.data, [('stdout', b'abc\ndef\n'), ('stderr', b'ghi\n')])
+
+        # everything is discarded by the base class
+        o = TaskOutput()
+        o.write('stdout', [b'abc'])
+        o.write_raw('stdout', b'abc')
+        o.message('error', 'Error\n')
+        self.assertEqual(o.copy(six.BytesIO(b'abc\ndef'), 'stdout'), (2, 7))
+        o.close()
+
+    def test_palette(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        o = Output(palette='256').open('server-1', 'lab', out, err)
+        o.write('stdout', [b'abc'])
+        o.close()
+
+        prefix = make_prefixes('lab', '256')[0]
+        self.assertTrue(prefix.startswith(b'\x1b[7m\x1b[38;5;'))
+        self.assertEqual(out.getvalue(), prefix + b'abc\x1b[0m\n')
+
+    def test_jsonl(self):
+        out, err = six.BytesIO(), six.BytesIO()
+        o = Output('jsonl').open('server-1', 'lab', out, err)
+        o.write('stdout', [b'abc', '\u3042'.encode('utf-8')])
+        o.write('stderr', [b'\xff'])
+        self.assertEqual(o.copy(six.BytesIO(b'x\ny'), 'stdout'), (2, 3))
+        o.message('error', 'Error: e\nlabel=lab\n')
+        o.close()
+
+        records = [json.loads(line) for line in out.getvalue().decode('utf-8').splitlines()]
+        self.assertEqual([(r['host'], r['label'], r['stream'], r['line']) for r in records], [
+            ('server-1', 'lab', 'stdout', 'abc'),
+            ('server-1', 'lab', 'stdout', '\u3042'),
+            ('server-1', 'lab', 'stderr', '\ufffd'),
+            ('server-1', 'lab', 'stdout', 'x'),
+            ('server-1', 'lab', 'stdout', 'y'),
+            ('server-1', 'lab', 'error', 'Error: e'),
+            ('server-1', 'lab', 'error', 'label=lab'),
+        ])
+        self.assertTrue(all(isinstance(r['ts'], float) for r in records))
+        self.assertEqual(err.getvalue(), b'')
+
+    def test_grouped(self):
+        for group_memory in [1, 1 << 20]:
+            out, err = six.BytesIO(), six.BytesIO()
+            o = Output('grouped', group_memory).open('server-1', 'lab', out, err)
+            o.write('stdout', [b'abc'])
+            o.write('stderr', [b'xyz'])
+            o.copy(six.BytesIO(b'def\n'), 'stdout')
+            o.message('timeout', 'timed out')
+
+            # nothing is written until the task finishes
+            self.assertEqual(out.getvalue(), b'')
+            self.assertEqual(err.getvalue(), b'')
+
+            o.close()
+            self.assertEqual(out.getvalue(), b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33mabc\x1b[0m\n'
+                                             b'\x1b[7m\x1b[33mlab\x1b[0m|\x1b[0m\x1b[33mdef\x1b[0m\n')
+            self.assertEqual(err.getvalue(), b'\x1b[7m\x1b[33mlab\x1b[0m+\x1b[0m\x1b[33mxyz\x1b[0m\n'
+                                             b'\x1b[7m\x1b[33mlab\x1b[0m+\x1b[0m\x1b[33mtimed out\x1b[0m\n')
+
+    def test_aggregate(self):
+        def f(label, bs):
+            return make_prefixes(label)[0] + bs + b'\x1b[0m\n'
+
+        output = Output('aggregate', 4)
+        output.start()
+        directory = output.directory
+        try:
+            out, err = six.BytesIO(), six.BytesIO()
+            for host, lines in [('web01', [b'a', b'b']), ('web02', [b'a', b'b']), ('db1', [b'c']), ('web03', [b'a'])]:
+                o = output.open(host, host, out, err)
+                o.write('stdout', lines)
+                o.close()
+            self.assertEqual(out.getvalue(), b'')
+        finally:
+            output.finish(out, err)
+
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(out.getvalue(),
+                         f('web[01-02]', b'a') + f('web[01-02]', b'b') + f('db1', b'c') + f('web03', b'a'))
+        self.assertEqual(err.getvalue(), b'')
+
+    def test_aggregate_retry(self):
+        def f(label, bs):
+            return make_prefixes(label)[0] + bs + b'\x1b[0m\n'
+
+        output = Output('aggregate', 4)
+        output.start()
+        try:
+            out, err = six.BytesIO(), six.BytesIO()
+            # web01 failed first and was retried, and web02 ran two batches
+            for host, command, lines in [('web01', ['x'], [b'error']), ('web02', ['x', '1'], [b'a']),
+                                         ('web02', ['x', '2'], [b'b']), ('web01', ['x'], [b'a'])]:
+                o = output.open(host, host, out, err, command)
+                o.write('stdout', lines)
+                o.close()
+        finally:
+            output.finish(out, err)
+
+        self.assertEqual(out.getvalue(), f('web[01-02]', b'a') + f('web02', b'b'))
+
+    def test_outdir(self):
+        d = tempfile.mkdtemp()
+        try:
+            for compress, read in [(None, io.open), ('gzip', gzip.open)]:
+                outdir = os.path.join(d, str(compress))
+                output = Output(outdir=outdir, compress=compress)
+                output.start()
+                for _ in range(2):
+                    out, err = six.BytesIO(), six.BytesIO()
+                    o = output.open('server-1', 'lab/1', out, err)
+                    o.write('stdout', [b'abc'])
+                    self.assertEqual(o.copy(six.BytesIO(b'x' * 100000 + b'\ny'), 'stdout'), (2, 100002))
+                    o.message('setup', 'setup: x')
+                    o.close(3)
+                    output.finish(out, err)
+
+                    status = b'exit 3, stdout 3 lines / 100006 bytes, stderr 0 lines / 0 bytes\x1b[0m\n'
+                    self.assertEqual(out.getvalue(), make_prefixes('lab/1')[0] + status)
+                    self.assertEqual(err.getvalue(), make_prefixes('lab/1')[1] + b'setup: x\x1b[0m\n')
+
+                # appended, and no file for the empty stream
+                ext = '' if compress is None else '.gz'
+                self.assertEqual(sorted(os.listdir(outdir)), ['lab_1.out' + ext])
+                with read(os.path.join(outdir, 'lab_1.out' + ext), 'rb') as f:
+                    self.assertEqual(f.read(), (b'abc\n' + b'x' * 100000 + b'\ny') * 2)
+        finally:
+            shutil.rmtree(d)
+
+    def test_unknown_format(self):
+        self.assertRaises(AssertionError, Output, 'xml')
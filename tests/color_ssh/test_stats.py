@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function, absolute_import, unicode_literals
+
+import os
+import json
+import tempfile
+import six
+from mog_commons.unittest import TestCase
+from color_ssh.stats import Stats, new_record, add_output
+
+
+class TestStats(TestCase):
+    def _record(self, label, ret, queue, setup, time):
+        r = new_record(label, ['ssh', label, 'x'])
+        r['ret'] = ret
+        r['queue'] = queue
+        r['setup'] = [{'command': ['rsync'], 'time': t} for t in setup]
+        r['time'] = time
+        r['total'] = queue + sum(setup) + time
+        return r
+
+    def _stats(self):
+        return Stats([
+            self._record('h1', 0, 0.0, [], 1.0),
+            self._record('h2', 1, 0.5, [0.25, 0.25], 2.0),
+            self._record('h3', 0, 0.0, [1.0], 0.5),
+        ])
+
+    def test_add_output(self):
+        r = new_record('h', ['x'])
+        add_output(r, 'stdout', (2, 10))
+        add_output(r, 'stdout', (1, 5))
+        add_output(r, 'stderr', (3, 7))
+        self.assertEqual((r['stdout_lines'], r['stdout_bytes'], r['stderr_lines'], r['stderr_bytes']), (3, 15, 3, 7))
+
+    def test_summary(self):
+        self.assertEqual(Stats().summary(), {'hosts': 0, 'failed': 0, 'retried': 0})
+
+        s = self._stats().summary()
+        self.assertEqual((s['hosts'], s['failed']), (3, 1))
+        self.assertEqual(s['setup'], {'p50': 0.5, 'p95': 1.0, 'p99': 1.0, 'max': 1.0})
+        self.assertEqual(s['time'], {'p50': 1.0, 'p95': 2.0, 'p99': 2.0, 'max': 2.0})
+        self.assertEqual(s['total'], {'p50': 1.5, 'p95': 3.0, 'p99': 3.0, 'max': 3.0})
+        self.assertEqual(s['slowest'], ['h2', 'h3', 'h1'])
+
+    def test_report(self):
+        out = six.BytesIO()
+        self._stats().report(out)
+        self.assertEqual(out.getvalue().decode('utf-8').splitlines(), [
+            'color-ssh: stats for 3 hosts (failed: 1, retried: 0)',
+            '  queue    p50 0.000s  p95 0.500s  p99 0.500s  max 0.500s',
+            '  setup    p50 0.500s  p95 1.000s  p99 1.000s  max 1.000s',
+            '  command  p50 1.000s  p95 2.000s  p99 2.000s  max 2.000s',
+            '  total    p50 1.500s  p95 3.000s  p99 3.000s  max 3.000s',
+            '  output   stdout 0 lines / 0 bytes, stderr 0 lines / 0 bytes',
+            'color-ssh: slowest hosts',
+            '  h2  total 3.000s (queue 0.500s, setup 0.500s, command 2.000s) ret=1',
+            '  h3  total 1.500s (queue 0.000s, setup 1.000s, command 0.500s) ret=0',
+            '  h1  total 1.000s (queue 0.000s, setup 0.000s, command 1.000s) ret=0',
+        ])
+
+    def test_dump(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self._stats().dump(path)
+            with open(path) as f:
+                data = json.load(f)
+            self.assertEqual([h['label'] for h in data['hosts']], ['h1', 'h2', 'h3'])
+            self.assertEqual(data['summary']['hosts'], 3)
+        finally:
+            os.remove(path)
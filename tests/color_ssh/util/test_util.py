@@ -1,7 +1,8 @@
 from __future__ import division, print_function, absolute_import, unicode_literals
 
 from mog_commons.unittest import TestCase
-from color_ssh.util.util import distribute, exception_handler
+from color_ssh.util.util import shell_quote, distribute, distribute_by_cost, split_every, percentile, \
+    format_host_ranges, exception_handler, lru_cache
 
 
 class TestUtil(TestCase):
@@ -18,6 +19,11 @@ class TestUtil(TestCase):
 
         self.assertEqual(g(), 0)
 
+    def test_shell_quote(self):
+        self.assertEqual(shell_quote('abc'), 'abc')
+        self.assertEqual(shell_quote('a b'), "'a b'")
+        self.assertEqual(shell_quote("a'b"), "'a'\"'\"'b'")
+
     def test_distribute(self):
         self.assertEqual(distribute(0, []), [])
         self.assertEqual(distribute(0, ['a']), [])
@@ -39,3 +45,58 @@ class TestUtil(TestCase):
 
     def test_distribute_error(self):
         self.assertRaises(AssertionError, distribute, -1, [])
+
+    def test_distribute_by_cost(self):
+        self.assertEqual(distribute_by_cost(0, [], []), [])
+        self.assertEqual(distribute_by_cost(0, ['a'], [1]), [])
+        self.assertEqual(distribute_by_cost(1, [], []), [[]])
+        self.assertEqual(distribute_by_cost(1, ['a', 'b'], [1, 2]), [['a', 'b']])
+        self.assertEqual(distribute_by_cost(2, ['a', 'b', 'c', 'd'], [10, 1, 1, 1]), [['a'], ['b', 'c', 'd']])
+        self.assertEqual(distribute_by_cost(2, ['a', 'b', 'c', 'd', 'e'], [3, 3, 2, 2, 2]),
+                         [['a', 'c', 'e'], ['b', 'd']])
+        self.assertEqual(distribute_by_cost(3, ['a', 'b', 'c', 'd', 'e', 'f'], [1, 1, 1, 1, 1, 1]),
+                         [['a', 'd'], ['b', 'e'], ['c', 'f']])
+        self.assertEqual(distribute_by_cost(5, ['a', 'b'], [1, 1]), [['a'], ['b'], [], [], []])
+
+    def test_distribute_by_cost_error(self):
+        self.assertRaises(AssertionError, distribute_by_cost, -1, [], [])
+        self.assertRaises(AssertionError, distribute_by_cost, 1, ['a'], [])
+
+    def test_split_every(self):
+        self.assertEqual(list(split_every(1, [])), [])
+        self.assertEqual(list(split_every(2, ['a', 'b', 'c', 'd', 'e'])), [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(list(split_every(5, iter(['a', 'b']))), [['a', 'b']])
+        self.assertRaises(AssertionError, list, split_every(0, []))
+
+    def test_percentile(self):
+        self.assertEqual(percentile([3], 50), 3)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 0), 1)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 100), 5)
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+        self.assertRaises(AssertionError, percentile, [], 50)
+
+    def test_format_host_ranges(self):
+        self.assertEqual(format_host_ranges([]), '')
+        self.assertEqual(format_host_ranges(['web001']), 'web001')
+        self.assertEqual(format_host_ranges(['web%03d' % i for i in range(1, 121)] + ['web130']), 'web[001-120,130]')
+        self.assertEqual(format_host_ranges(['db2', 'x', 'db1', 'db4', 'db1']), 'db[1-2,4],x')
+        self.assertEqual(format_host_ranges(['web9.example.com', 'web10.example.com', 'web11.example.net']),
+                         'web[9-10].example.com,web11.example.net')
+        self.assertEqual(format_host_ranges(['a099', 'a100', 'a9', 'a010']), 'a[9,010,099-100]')
+
+    def test_lru_cache(self):
+        calls = []
+
+        @lru_cache(2)
+        def f(x, y):
+            calls.append((x, y))
+            return x + y
+
+        self.assertEqual([f(1, 2), f(1, 2), f(3, 4), f(1, 2), f(5, 6), f(1, 2), f(3, 4)], [3, 3, 7, 3, 11, 3, 7])
+        # (3, 4) was evicted as the least recently used
+        self.assertEqual(calls, [(1, 2), (3, 4), (5, 6), (3, 4)])
+        self.assertEqual(f.cache_size(), 2)
+        f.cache_clear()
+        self.assertEqual(f.cache_size(), 0)